@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for QuickTube's probe, download and conversion paths.
+
+Everything runs locally: ffmpeg generates synthetic test media (lavfi testsrc2 + sine)
+at several resolutions and durations, a local HTTP server serves it, and a stub yt-dlp
+"downloads" from that server while speaking the same progress/print-to-file protocol as
+the real one. Needs ffmpeg and ffprobe on PATH; yt-dlp is not used.
+
+    python3 benchmarks/run_benchmarks.py                      # full run, writes bench_results.json
+    python3 benchmarks/run_benchmarks.py --quick --only probe,convert
+    python3 benchmarks/run_benchmarks.py --compare old.json   # show changes against another commit's results
+
+Measured:
+    probe    check_if_playlist() latency, cold and with cached link info, single videos and playlists
+    e2e      download_media() end to end, without conversion and with a smart MKV conversion
+    convert  convert_video() fps per x264 preset and thread count, chunked parallel encoding (checked
+             to decode with every frame), smart (copy) and remux_video() times
+    batch    'quicktube.py batch' throughput at several --jobs levels, for MP4 and MP3 downloads, and a
+             pipelined run with conversions (checked to keep --jobs downloads running at once)
+"""
+import argparse
+import builtins
+import contextlib
+import functools
+import http.server
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRAME_RATE = 30
+
+# Stand-in for yt-dlp: info JSON for /media/<file> URLs, flat entries for /playlist/<count>
+# URLs, and downloads over HTTP with the progress template and --print-to-file records
+# QuickTube relies on. Written out with the interpreter running the benchmarks.
+STUB_YTDLP = r'''
+import json, os, subprocess, sys, time, urllib.parse, urllib.request
+
+args = sys.argv[1:]
+
+def option(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+def describe(url):
+    parts = urllib.parse.urlsplit(url)
+    name = os.path.splitext(os.path.basename(parts.path))[0]
+    copy = urllib.parse.parse_qs(parts.query).get("copy", [""])[0]
+    video_id = f"{name}-{copy}" if copy else name
+    return {"id": video_id, "title": video_id, "ext": "mp4", "extractor_key": "Generic", "extractor": "generic",
+            "webpage_url": url, "url": url, "protocol": "http", "duration": float(os.environ.get("STUB_DURATION", "0")) or None,
+            "vcodec": "avc1", "acodec": "mp4a", "format_id": "0",
+            # Processed single-video JSON from yt-dlp always carries these, set to null
+            "playlist_index": None, "playlist_id": None}
+
+def playlist_entries(url):
+    parts = urllib.parse.urlsplit(url)
+    count = int(parts.path.rstrip("/").rsplit("/", 1)[-1])
+    media = urllib.parse.parse_qs(parts.query).get("media", ["360p-5s.mp4"])[0]
+    base = f"{parts.scheme}://{parts.netloc}/media/{media}"
+    for index in range(count):
+        yield {"_type": "url", "ie_key": "Generic", "id": f"entry{index}", "url": f"{base}?copy={index}",
+               "playlist_id": f"bench{count}", "playlist_index": index + 1}
+
+url = args[-1]
+if "--load-info-json" in args:
+    with open(option("--load-info-json"), encoding="utf-8") as f:
+        url = json.load(f)["webpage_url"]
+is_playlist = "/playlist/" in url
+
+if "--flat-playlist" in args or "-J" in args or "--dump-single-json" in args:
+    if is_playlist:
+        for entry in playlist_entries(url):
+            print(json.dumps(entry), flush=True)
+            time.sleep(float(os.environ.get("STUB_PAGE_DELAY", "0")))
+    else:
+        print(json.dumps(describe(url)), flush=True)
+    sys.exit(0)
+
+templates = [args[i + 1] for i, arg in enumerate(args) if arg == "--progress-template"]
+download_prefix = next((t[len("download:"):t.index("%(")] for t in templates if t.startswith("download:")), None)
+post_prefix = next((t[len("postprocess:"):t.index("%(")] for t in templates if t.startswith("postprocess:")), None)
+items = [describe(entry["url"]) for entry in playlist_entries(url)] if is_playlist else [describe(url)]
+output = option("-o")
+for info in items:
+    ext = "mp3" if "-x" in args else "mp4"
+    path = output.replace("%(title)s", info["title"]).replace("%(ext)s", "mp4")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    active_dir = os.environ.get("STUB_ACTIVE_DIR")
+    if active_dir:
+        # One marker file per running download, so the benchmarks can see how many overlap
+        marker = os.path.join(active_dir, f"{os.getpid()}-{info['id']}")
+        open(marker, "w").close()
+        with open(active_dir + ".log", "a", encoding="utf-8") as log:
+            log.write(f"{len(os.listdir(active_dir))}\n")
+        time.sleep(float(os.environ.get("STUB_DOWNLOAD_DELAY", "0")))
+    with urllib.request.urlopen(info["url"]) as response, open(path + ".part", "wb") as f:
+        total = int(response.headers.get("Content-Length") or 0) or None
+        done, started = 0, time.monotonic()
+        while True:
+            block = response.read(256 * 1024)
+            status = "downloading" if block else "finished"
+            done += len(block)
+            f.write(block)
+            if download_prefix is not None:
+                elapsed = max(time.monotonic() - started, 1e-6)
+                progress = {"status": status, "downloaded_bytes": done, "total_bytes": total, "speed": done / elapsed,
+                            "eta": None, "fragment_index": None, "fragment_count": None, "filename": path}
+                print(f"{download_prefix}{info['id']}\t{json.dumps(progress)}", flush=True)
+            if not block:
+                break
+    os.replace(path + ".part", path)
+    if active_dir:
+        os.remove(marker)
+    if ext == "mp3":
+        # --audio-format best keeps the AAC stream, like yt-dlp does for an m4a source
+        native = option("--audio-format", "mp3") == "best"
+        final = os.path.splitext(path)[0] + (".m4a" if native else ".mp3")
+        if post_prefix is not None:
+            print(f"{post_prefix}{info['id']}\t" + json.dumps({"status": "started", "postprocessor": "ExtractAudio"}), flush=True)
+        codec = ["-c:a", "copy"] if native else ["-c:a", "libmp3lame", "-b:a", option("--audio-quality", "128K")]
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", path, "-vn"] + codec + [final], check=True)
+        os.remove(path)
+        if post_prefix is not None:
+            print(f"{post_prefix}{info['id']}\t" + json.dumps({"status": "finished", "postprocessor": "ExtractAudio"}), flush=True)
+        path = final
+    if "--print-to-file" in args:
+        record_file = args[args.index("--print-to-file") + 2].replace("%%", "%")
+        record = {"id": info["id"], "title": info["title"], "extractor_key": "Generic", "webpage_url": info["webpage_url"],
+                  "playlist_id": None, "playlist_index": None, "filepath": path}
+        with open(record_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+'''
+
+
+class MediaHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the synthetic media, optionally throttled per connection to mimic a network."""
+
+    rate = 0  # bytes/s per connection, 0 = unthrottled
+
+    def log_message(self, format, *args):
+        pass
+
+    def copyfile(self, source, outputfile):
+        if not self.rate:
+            return super().copyfile(source, outputfile)
+        chunk = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        while True:
+            block = source.read(chunk)
+            if not block:
+                return
+            outputfile.write(block)
+            sent += len(block)
+            delay = sent / self.rate - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def start_media_server(root, rate):
+    handler = type("Handler", (MediaHandler,), {"rate": rate})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=root))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def generate_media(media_dir, heights, durations):
+    """Create <height>p-<seconds>s.mp4 (H.264/AAC) and .mkv (MPEG-4/MP3, needs re-encoding) test files."""
+    os.makedirs(media_dir, exist_ok=True)
+    for height in heights:
+        width = height * 16 // 9 // 2 * 2
+        for duration in durations:
+            sources = ["-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={FRAME_RATE}:duration={duration}",
+                       "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}"]
+            variants = {
+                "mp4": ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-c:a", "aac"],
+                "mkv": ["-c:v", "mpeg4", "-q:v", "5", "-c:a", "libmp3lame"],
+            }
+            for ext, codecs in variants.items():
+                path = os.path.join(media_dir, f"{height}p-{duration}s.{ext}")
+                if not os.path.exists(path):
+                    subprocess.run(["ffmpeg", "-y", "-loglevel", "error"] + sources + codecs + ["-shortest", path], check=True)
+
+
+def load_quicktube(work_dir):
+    """Import a copy of quicktube.py living in work_dir, so its output/ folder is created there."""
+    path = os.path.join(work_dir, "quicktube.py")
+    shutil.copy(os.path.join(REPO_DIR, "quicktube.py"), path)
+    spec = importlib.util.spec_from_file_location("quicktube", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, path
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "samples": samples,
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "min": ordered[0],
+        "p95": ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))],
+    }
+
+
+def count_frames(path):
+    """Decode every video frame of path. Returns the frame count, or None when ffmpeg
+    reports a decoding error (e.g. a broken join between chunks)."""
+    result = subprocess.run(["ffmpeg", "-v", "error", "-nostats", "-i", path, "-map", "0:v:0", "-f", "null",
+                             "-progress", "pipe:1", "-"], capture_output=True, text=True)
+    frames = [int(line[len("frame="):]) for line in result.stdout.splitlines() if line.startswith("frame=")]
+    if result.returncode != 0 or result.stderr.strip() or not frames:
+        return None
+    return frames[-1]
+
+
+def timed(function, *args, **kwargs):
+    """Run function with its output swallowed; returns (seconds, result)."""
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+@contextlib.contextmanager
+def answers(*replies):
+    """Answer download_media()'s prompts with replies, in order."""
+    replies = iter(replies)
+    original = builtins.input
+    builtins.input = lambda prompt="": next(replies, "")
+    try:
+        yield
+    finally:
+        builtins.input = original
+
+
+class Benchmarks:
+    def __init__(self, args, work_dir, base_url):
+        self.args = args
+        self.work_dir = work_dir
+        self.base_url = base_url
+        self.media_dir = os.path.join(work_dir, "media")
+        self.results = []
+        self.qt, self.qt_path = load_quicktube(work_dir)
+        self.output_dir = self.qt.get_base_output_dir()
+
+    def add(self, benchmark, name, unit, samples, **params):
+        result = dict(benchmark=benchmark, name=name, unit=unit, params=params, **summarize(samples))
+        self.results.append(result)
+        print(f"   {benchmark:8} {name:40} median {result['median']:10.3f} {unit}", flush=True)
+
+    def media_url(self, height, duration, copy=None):
+        url = f"{self.base_url}/media/{height}p-{duration}s.mp4"
+        return f"{url}?copy={copy}" if copy is not None else url
+
+    def reset_output(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def run_probe(self):
+        """check_if_playlist(): first run per URL (yt-dlp started) and repeated (cached info)."""
+        qt = self.qt
+        height, duration = self.args.heights[0], self.args.durations[0]
+        for label, make_url in (("single", lambda i: self.media_url(height, duration, f"probe{i}")),
+                                ("playlist-100", lambda i: f"{self.base_url}/playlist/100?media={height}p-{duration}s.mp4&run={i}")):
+            cold, warm = [], []
+            for i in range(self.args.repeat):
+                url = make_url(i)
+                qt.invalidate_cached_info(url)
+                cold.append(timed(qt.check_if_playlist, url)[0])
+                warm.append(timed(qt.check_if_playlist, url)[0])
+            self.add("probe", f"{label}-cold", "s", cold)
+            if label == "single":
+                # Playlists aren't cached by the probe, only their entries are downloaded
+                self.add("probe", f"{label}-cached", "s", warm)
+
+    def run_e2e(self):
+        """download_media() as the interactive mode runs it, with the prompts answered."""
+        qt = self.qt
+        for height in self.args.heights:
+            duration = self.args.durations[-1]
+            for label, replies in (("download", ("3",)), ("download+smart-mkv", ("1", "2"))):
+                samples = []
+                for i in range(self.args.repeat):
+                    self.reset_output()
+                    url = self.media_url(height, duration, f"e2e{i}")
+                    with answers(*replies):
+                        samples.append(timed(qt.download_media, url, "mp4", "720", False)[0])
+                self.add("e2e", f"{label}-{height}p-{duration}s", "s", samples, height=height, duration=duration)
+
+    def run_convert(self):
+        """convert_video() fps for each preset and thread count, plus smart copies and remuxes."""
+        qt = self.qt
+        encode_args = qt.get_video_encode_args
+        scratch = os.path.join(self.work_dir, "convert")
+        duration = self.args.durations[-1]
+        frames = duration * FRAME_RATE
+        for height in self.args.heights:
+            os.makedirs(scratch, exist_ok=True)
+            source = os.path.join(scratch, f"{height}p.mkv")
+            shutil.copy(os.path.join(self.media_dir, f"{height}p-{duration}s.mkv"), source)
+            for preset in self.args.presets:
+                def with_preset(target, threads, preset=preset):
+                    encode = encode_args(target, threads)
+                    encode[encode.index("-preset") + 1] = preset
+                    return encode
+
+                qt.get_video_encode_args = with_preset
+                for threads in self.args.threads:
+                    qt.CPU_BUDGET.total = qt.CPU_BUDGET.job_threads = threads
+                    samples = []
+                    for _ in range(self.args.repeat):
+                        elapsed, output = timed(qt.convert_video, source, "mp4", full=True)
+                        if output is None:
+                            raise RuntimeError(f"convert_video failed for {source} ({preset}, {threads} threads)")
+                        os.remove(output)
+                        samples.append(frames / elapsed)
+                    self.add("convert", f"full-{height}p-{preset}-{threads}t", "fps", samples,
+                             height=height, preset=preset, threads=threads, frames=frames)
+            qt.get_video_encode_args = encode_args
+
+            # Chunked mode: split on keyframes, encode the chunks in parallel, join them again.
+            # The joined file must decode without errors and keep every frame.
+            threads = max(max(self.args.threads), 2 * qt.CHUNK_THREADS)
+            qt.CPU_BUDGET.total = qt.CPU_BUDGET.job_threads = threads
+            qt.CHUNKED_TRANSCODE = "on"
+            samples = []
+            try:
+                for _ in range(self.args.repeat):
+                    first_span = len(qt.METRICS.spans)
+                    elapsed, output = timed(qt.convert_video, source, "mp4", full=True)
+                    chunked = any(span["stage"] == "convert" and span.get("mode") == "chunked" and span["exit_code"] == 0
+                                  for span in qt.METRICS.spans[first_span:])
+                    if output is None or not chunked:
+                        raise RuntimeError(f"chunked convert_video failed for {source}")
+                    decoded = count_frames(output)
+                    if decoded != frames:
+                        raise RuntimeError(f"chunked output of {source} has {decoded} decodable frames, expected {frames}")
+                    os.remove(output)
+                    samples.append(frames / elapsed)
+            finally:
+                qt.CHUNKED_TRANSCODE = "off"
+            self.add("convert", f"chunked-{height}p-{threads}t", "fps", samples,
+                     height=height, threads=threads, workers=qt.get_chunk_workers(threads), frames=frames)
+
+            copy_source = os.path.join(scratch, f"{height}p.mp4")
+            shutil.copy(os.path.join(self.media_dir, f"{height}p-{duration}s.mp4"), copy_source)
+            for label, function in (("smart-copy", lambda: qt.convert_video(copy_source, "mkv")),
+                                    ("remux", lambda: qt.remux_video(copy_source, "mkv"))):
+                samples = []
+                for _ in range(self.args.repeat):
+                    elapsed, output = timed(function)
+                    if output is None:
+                        raise RuntimeError(f"{label} failed for {copy_source}")
+                    os.remove(output)
+                    samples.append(elapsed)
+                self.add("convert", f"{label}-{height}p-{duration}s", "s", samples, height=height, duration=duration)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def run_batch(self):
+        """Wall time of 'quicktube.py batch' for the same URL list at each --jobs level,
+        as MP4 downloads and as MP3 downloads (which also go through the encoder pool), plus a
+        pipelined run with conversions."""
+        height, duration = self.args.heights[0], self.args.durations[0]
+        size = os.path.getsize(os.path.join(self.media_dir, f"{height}p-{duration}s.mp4"))
+        for file_type, prefix in (("mp4", ""), ("mp3", "mp3-")):
+            for jobs in self.args.concurrency:
+                samples = []
+                for run in range(self.args.repeat):
+                    self.reset_output()
+                    url_file = os.path.join(self.work_dir, "urls.txt")
+                    with open(url_file, "w", encoding="utf-8") as f:
+                        for i in range(self.args.batch_size):
+                            f.write(self.media_url(height, duration, f"batch-{file_type}{jobs}-{run}-{i}") + "\n")
+                    started = time.perf_counter()
+                    completed = subprocess.run([sys.executable, self.qt_path, "batch", url_file, "--jobs", str(jobs), "--type", file_type],
+                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    elapsed = time.perf_counter() - started
+                    if completed.returncode != 0:
+                        raise RuntimeError(f"{file_type} batch with --jobs {jobs} exited with {completed.returncode}")
+                    samples.append(self.args.batch_size / elapsed)
+                result_params = dict(jobs=jobs, type=file_type, items=self.args.batch_size, item_bytes=size, height=height, duration=duration)
+                self.add("batch", f"{prefix}jobs-{jobs}", "items/s", samples, **result_params)
+                self.results[-1]["mib_per_s"] = self.results[-1]["median"] * size / (1024 * 1024)
+
+        # Pipelined batch with conversions: --jobs alone limits the downloads, so all of them must
+        # overlap even with no room to queue converted files (--queue-size 0, one converter).
+        # The stub holds each download open for a moment and counts the ones running.
+        jobs = max(self.args.concurrency)
+        active_dir = os.path.join(self.work_dir, "active")
+        samples = []
+        for run in range(self.args.repeat):
+            self.reset_output()
+            shutil.rmtree(active_dir, ignore_errors=True)
+            os.makedirs(active_dir)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(active_dir + ".log")
+            url_file = os.path.join(self.work_dir, "urls.txt")
+            with open(url_file, "w", encoding="utf-8") as f:
+                for i in range(jobs * 2):
+                    f.write(self.media_url(height, duration, f"pipeline{jobs}-{run}-{i}") + "\n")
+            env = dict(os.environ, STUB_ACTIVE_DIR=active_dir, STUB_DOWNLOAD_DELAY="1")
+            started = time.perf_counter()
+            completed = subprocess.run([sys.executable, self.qt_path, "batch", url_file, "--jobs", str(jobs), "--convert", "mkv",
+                                        "--convert-jobs", "1", "--queue-size", "0"],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+            elapsed = time.perf_counter() - started
+            if completed.returncode != 0:
+                raise RuntimeError(f"pipelined batch with --jobs {jobs} exited with {completed.returncode}")
+            with open(active_dir + ".log", encoding="utf-8") as f:
+                peak = max(int(line) for line in f)
+            if peak < jobs:
+                raise RuntimeError(f"pipelined batch with --jobs {jobs} ran at most {peak} downloads at once")
+            samples.append(jobs * 2 / elapsed)
+        self.add("batch", f"pipeline-jobs-{jobs}", "items/s", samples, jobs=jobs, convert="mkv", queue_size=0, items=jobs * 2)
+
+
+def describe_environment():
+    def first_line(command):
+        try:
+            return subprocess.run(command, capture_output=True, text=True, cwd=REPO_DIR).stdout.splitlines()[0].strip()
+        except (OSError, IndexError):
+            return None
+
+    return {
+        "commit": first_line(["git", "rev-parse", "HEAD"]),
+        "dirty": bool(first_line(["git", "status", "--porcelain", "--", "quicktube.py"])),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": first_line(["ffmpeg", "-hide_banner", "-version"]),
+    }
+
+
+def compare(baseline_path, results, threshold):
+    """Print each result's change against a previous run. Returns the number of regressions."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["benchmark"], r["name"]): r for r in json.load(f)["results"]}
+    regressions = 0
+    print(f"\n📊 Compared with {baseline_path}:")
+    for result in results:
+        old = baseline.get((result["benchmark"], result["name"]))
+        if old is None or not old["median"]:
+            continue
+        change = (result["median"] - old["median"]) / old["median"] * 100
+        # Seconds should go down, rates (fps, items/s) up
+        worse = change > threshold if result["unit"] == "s" else change < -threshold
+        if result["unit"] == "s" and abs(result["median"] - old["median"]) < 0.005:
+            # Below timer noise (e.g. cache hits)
+            worse = False
+        regressions += worse
+        marker = "❌" if worse else "  "
+        print(f"{marker} {result['benchmark']:8} {result['name']:40} {old['median']:10.3f} → {result['median']:10.3f} {result['unit']:8} ({change:+.1f}%)")
+    return regressions
+
+
+def parse_list(kind):
+    return lambda text: [kind(item) for item in text.split(",") if item.strip()]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Offline QuickTube benchmarks (needs ffmpeg).")
+    parser.add_argument("--only", type=parse_list(str), default=["probe", "e2e", "convert", "batch"],
+                        help="comma-separated benchmarks to run: probe,e2e,convert,batch (default: all)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results (default: bench_results.json)")
+    parser.add_argument("--compare", metavar="JSON", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression (default: 10)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (default: 3)")
+    parser.add_argument("--heights", type=parse_list(int), default=[360, 720, 1080], help="test media resolutions (default: 360,720,1080)")
+    parser.add_argument("--durations", type=parse_list(int), default=[5, 30], help="test media lengths in seconds (default: 5,30)")
+    parser.add_argument("--presets", type=parse_list(str), default=["ultrafast", "veryfast", "medium"], help="x264 presets for convert (default: ultrafast,veryfast,medium)")
+    parser.add_argument("--threads", type=parse_list(int), default=sorted({1, 2, 4, os.cpu_count() or 1}), help="encoder thread counts for convert")
+    parser.add_argument("--concurrency", type=parse_list(int), default=[1, 2, 4, 8], help="--jobs levels for batch (default: 1,2,4,8)")
+    parser.add_argument("--batch-size", type=int, default=16, help="URLs per batch run (default: 16)")
+    parser.add_argument("--rate", type=float, default=0, help="per-connection speed of the media server in MiB/s (default: unthrottled)")
+    parser.add_argument("--quick", action="store_true", help="small run for a smoke test: 360p, 5s media, one repeat")
+    parser.add_argument("--keep", metavar="DIR", help="work in DIR and keep it (generated media is reused between runs)")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.heights, args.durations, args.repeat = [360], [5], 1
+        args.presets, args.threads, args.concurrency, args.batch_size = ["ultrafast"], sorted({1, os.cpu_count() or 1}), [1, 4], 8
+    unknown = set(args.only) - {"probe", "e2e", "convert", "batch"}
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        print("❌ ffmpeg and ffprobe must be on PATH to generate and convert the test media.")
+        return 2
+    if os.name == "nt":
+        print("❌ The stub yt-dlp is a script with a #! line; run the benchmarks on Linux or macOS.")
+        return 2
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix="quicktube-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, "yt-dlp")
+    with open(stub, "w", encoding="utf-8") as f:
+        f.write(f"#!{sys.executable}\n{STUB_YTDLP}")
+    os.chmod(stub, 0o755)
+    # Isolate QuickTube from the user's cache, archive and journal, and use the stub yt-dlp
+    os.environ.update({
+        "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        "QUICKTUBE_ENGINE": "binary",
+        "QUICKTUBE_CACHE_DIR": os.path.join(work_dir, "cache"),
+        "QUICKTUBE_ARCHIVE": "off",
+        "QUICKTUBE_JOURNAL": "off",
+        "QUICKTUBE_STREAM_CACHE": "off",
+    })
+
+    server = None
+    try:
+        print(f"🎞️  Generating test media in {work_dir}...", flush=True)
+        generate_media(os.path.join(work_dir, "media"), args.heights, args.durations)
+        server, base_url = start_media_server(work_dir, args.rate * 1024 * 1024)
+        bench = Benchmarks(args, work_dir, base_url)
+        for name in ("probe", "e2e", "convert", "batch"):
+            if name in args.only:
+                print(f"⏱️  {name}", flush=True)
+                getattr(bench, f"run_{name}")()
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"meta": describe_environment(), "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "keep")},
+              "results": bench.results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results written to {args.output}")
+    if args.compare:
+        return 1 if compare(args.compare, bench.results, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,14 +1,37 @@
+import time
+STARTUP_STARTED = time.perf_counter()
 import subprocess
 import os
 import re
 import sys
 import shlex
+import threading
+import contextlib
+import functools
+import argparse
+import collections
+import hashlib
+import importlib
+import json
+import queue
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http import HTTPStatus
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+# asyncio (only used by the job server) and yt_dlp take a while to load, they are imported where they are used
+STARTUP_IMPORTED = time.perf_counter()
 
 
 DEBUG_MODE = "--debug" in sys.argv or os.getenv("QUICKTUBE_DEBUG", "").strip().lower() in {"1", "true", "yes", "on"}
 
+@functools.lru_cache(maxsize=None)
 def get_ffmpeg_path():
-    """Get the path to ffmpeg binary (bundled or system)"""
+    """Get the path to ffmpeg binary (bundled or system), resolved once per run"""
     if getattr(sys, 'frozen', False):
         # Running as compiled executable
         base_path = sys._MEIPASS
@@ -19,8 +42,9 @@ def get_ffmpeg_path():
     # Fall back to system ffmpeg
     return "ffmpeg"
 
+@functools.lru_cache(maxsize=None)
 def get_ytdlp_path():
-    """Get the path to yt-dlp binary (bundled or system)"""
+    """Get the path to yt-dlp binary (bundled or system), resolved once per run"""
     if getattr(sys, 'frozen', False):
         # Running as compiled executable
         base_path = sys._MEIPASS
@@ -31,26 +55,240 @@ def get_ytdlp_path():
     # Fall back to system yt-dlp
     return "yt-dlp"
 
+def get_cache_dir(*parts):
+    """Get (and create) QuickTube's cache directory, or a subfolder of it.
+    QUICKTUBE_CACHE_DIR overrides the platform default."""
+    base = os.getenv("QUICKTUBE_CACHE_DIR", "").strip()
+    if not base:
+        if os.name == 'nt':
+            base = os.path.join(os.getenv("LOCALAPPDATA") or os.path.expanduser("~"), "QuickTube", "cache")
+        elif sys.platform == 'darwin':
+            base = os.path.join(os.path.expanduser("~"), "Library", "Caches", "QuickTube")
+        else:
+            base = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "quicktube")
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_env_number(name, default):
+    """Read a numeric setting from the environment, falling back to default on bad values."""
+    try:
+        return float(os.getenv(name, ""))
+    except ValueError:
+        return default
+
+# Extracted info JSON holds signed stream URLs that expire after a few hours
+METADATA_CACHE_TTL = get_env_number("QUICKTUBE_CACHE_TTL", 2 * 60 * 60)
+METADATA_CACHE_MAX_BYTES = get_env_number("QUICKTUBE_CACHE_MAX_MB", 100) * 1024 * 1024
+METADATA_CACHE_ENABLED = os.getenv("QUICKTUBE_NO_CACHE", "").strip().lower() not in {"1", "true", "yes", "on"}
+
+def normalize_url(url):
+    """Normalize a URL into a cache key (YouTube links are keyed by video/playlist ID)."""
+    url = url.strip()
+    parts = urlsplit(url if "://" in url else "https://" + url)
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path
+    query = parse_qsl(parts.query, keep_blank_values=True)
+
+    if host in ("youtube.com", "youtu.be", "youtube-nocookie.com"):
+        params = dict(query)
+        video_id = params.get("v")
+        segments = [segment for segment in path.split("/") if segment]
+        if host == "youtu.be" and segments:
+            video_id = segments[0]
+        elif len(segments) >= 2 and segments[0] in ("shorts", "live", "embed"):
+            video_id = segments[1]
+        list_id = params.get("list")
+        if list_id:
+            return f"youtube:list={list_id}" + (f"&v={video_id}" if video_id else "")
+        if video_id:
+            return f"youtube:v={video_id}"
+
+    # Drop tracking parameters and the fragment, sort the rest for a stable key
+    query = sorted((key, value) for key, value in query if not key.startswith("utm_"))
+    return urlunsplit((parts.scheme.lower(), host, path.rstrip("/") or "/", urlencode(query), ""))
+
+def write_file_atomic(path, text):
+    """Write text to path through a temporary file and os.replace(), so other threads and
+    processes never read a half-written file. Raises OSError."""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def metadata_cache_path(url):
+    """Get the cache file path for a URL's info JSON."""
+    key = hashlib.sha1(normalize_url(url).encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir("info"), f"{key}.info.json")
+
+def lookup_cached_info(url):
+    """Return (path, info) for a fresh cached info JSON, or (None, None) on a miss.
+    File mtime is the fetch time (TTL), atime is the last use (LRU)."""
+    if not METADATA_CACHE_ENABLED:
+        return None, None
+    try:
+        path = metadata_cache_path(url)
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    now = time.time()
+    if now - stat.st_mtime > METADATA_CACHE_TTL:
+        invalidate_cached_info(url)
+        return None, None
+    try:
+        with open(path, encoding="utf-8") as f:
+            info = json.load(f)
+        os.utime(path, (now, stat.st_mtime))
+    except (OSError, ValueError):
+        invalidate_cached_info(url)
+        return None, None
+    return path, info
+
+def store_cached_info(url, info_json):
+    """Save raw info JSON text for a URL, then evict old entries."""
+    if not METADATA_CACHE_ENABLED:
+        return None
+    try:
+        path = metadata_cache_path(url)
+        write_file_atomic(path, info_json)
+    except OSError:
+        return None
+    prune_metadata_cache()
+    return path
+
+def invalidate_cached_info(url):
+    """Drop the cached info JSON for a URL (e.g. after its stream URLs expired)."""
+    try:
+        os.remove(metadata_cache_path(url))
+    except OSError:
+        pass
+
+def prune_metadata_cache():
+    """Remove expired entries, then least recently used ones until the cache fits its size limit."""
+    try:
+        cache_dir = get_cache_dir("info")
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    now = time.time()
+    entries = []
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if now - stat.st_mtime > METADATA_CACHE_TTL:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= METADATA_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+PLAYLIST_FIRST_ENTRY_TIMEOUT = 20
+
+def is_playlist_entry(info):
+    """True for an entry of a flat playlist enumeration, False for a single video's info.
+    A single video's processed info has "playlist_index": null, so only a set index counts."""
+    return info.get("_type") in ("url", "url_transparent") or info.get("playlist_index") is not None
+
+def iter_playlist_entries(url, first_entry_timeout=PLAYLIST_FIRST_ENTRY_TIMEOUT):
+    """Lazily enumerate a URL with yt-dlp --flat-playlist, one JSON object per entry.
+    Playlist entries are yielded as yt-dlp pages through the playlist, so consumers can
+    start on the first items while enumeration continues. A single video yields its full
+    info instead. Only the first entry is subject to the timeout; closing the generator
+    stops yt-dlp."""
+    if get_ytdlp_engine() == "module":
+        ydl, _ = get_warm_ytdl("enumerate", {
+            "quiet": True, "no_warnings": True, "nocheckcertificate": True,
+            "noplaylist": False, "socket_timeout": first_entry_timeout, "extract_flat": "in_playlist",
+        })
+        info = ydl.extract_info(url, download=False, process=False)
+        if info.get("_type") in ("playlist", "multi_video"):
+            for entry in info.get("entries") or ():
+                if entry:
+                    entry = dict(entry)
+                    entry.setdefault("playlist_id", info.get("id"))
+                    yield ydl.sanitize_info(entry)
+        else:
+            yield ydl.sanitize_info(ydl.process_ie_result(info, download=False))
+        return
+
+    command = [get_ytdlp_path(), "--flat-playlist", "-j", "--no-warnings", "--no-check-certificate", "--yes-playlist", url]
+    if DEBUG_MODE:
+        print(f"🐛 Debug mode: {format_command(command)}", flush=True)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               text=True, encoding="utf-8", errors="replace", bufsize=1)
+    timer = threading.Timer(first_entry_timeout, process.kill)
+    timer.start()
+    try:
+        for line in process.stdout:
+            timer.cancel()
+            line = line.strip()
+            if line.startswith("{"):
+                yield json.loads(line)
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
 def check_if_playlist(url):
-    """Check if URL is a playlist by probing with yt-dlp."""
-    ytdlp_cmd = get_ytdlp_path()
+    """Check if URL is a playlist by probing with yt-dlp (a single video's info JSON is cached for the download).
+    Returns as soon as the first entry is known instead of waiting for the whole playlist."""
     try:
-        import json
-        # Probe with playlist support to detect if it's a playlist
-        result = subprocess.run(
-            [ytdlp_cmd, "--dump-single-json", "--no-warnings", "--no-check-certificate", "--yes-playlist", url],
-            capture_output=True,
-            text=True,
-            timeout=20
-        )
-        if result.returncode == 0:
-            info = json.loads(result.stdout)
+        _, info = lookup_cached_info(url)
+        if info is not None:
             # Check if it's a playlist type or has multiple entries
             return info.get('_type') == 'playlist' or 'entries' in info
+        engine = get_ytdlp_engine()
+        with METRICS.span(url, "probe", engine=engine) as span:
+            entries = iter_playlist_entries(url)
+            try:
+                first = next(entries, None)
+            finally:
+                entries.close()
+            span["exit_code"] = 0 if first is not None else 1
+        if first is None:
+            return False
+        if is_playlist_entry(first):
+            return True
+        store_cached_info(url, json.dumps(first))
         return False
     except Exception:
         return False
 
+def get_cached_info_for_download(url, is_playlist):
+    """Get a cached info JSON path usable with --load-info-json for this download, if any."""
+    path, info = lookup_cached_info(url)
+    if path is None:
+        return None
+    # A cached playlist can't stand in for a single-item download
+    if not is_playlist and (info.get('_type') == 'playlist' or 'entries' in info):
+        return None
+    return path
+
 def extract_video_url(playlist_url):
     """Extracts the single video URL from a playlist URL (YouTube-specific fallback)."""
     match = re.search(r"v=([a-zA-Z0-9_-]+)", playlist_url)
@@ -58,15 +296,118 @@ def extract_video_url(playlist_url):
         return f"https://www.youtube.com/watch?v={match.group(1)}"
     return playlist_url
 
-def get_cpu_thread_count():
-    """Get optimal thread count for encoding (use half of available cores to prevent overheating)"""
+def read_cgroup_cpu_limit():
+    """CPU limit of this container from its cgroup quota (v2 cpu.max, v1 cfs_quota_us), or None."""
+    cgroup_paths = [""]
+    try:
+        with open("/proc/self/cgroup", encoding="utf-8") as f:
+            for line in f:
+                _, controllers, path = line.rstrip("\n").split(":", 2)
+                if controllers == "" or "cpu" in controllers.split(","):
+                    cgroup_paths.insert(0, path.lstrip("/"))
+    except (OSError, ValueError):
+        pass
+    for path in cgroup_paths:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        try:
+            with open(os.path.join("/sys/fs/cgroup", path, "cpu.max"), encoding="utf-8") as f:
+                quota, period = f.read().split()[:2]
+            if quota == "max":
+                return None
+            return int(quota) / int(period)
+        except (OSError, ValueError):
+            pass
+        # cgroup v1: quota of -1 means unlimited
+        for controller in ("cpu", "cpu,cpuacct", "cpuacct,cpu"):
+            base = os.path.join("/sys/fs/cgroup", controller, path)
+            try:
+                with open(os.path.join(base, "cpu.cfs_quota_us"), encoding="utf-8") as f:
+                    quota = int(f.read())
+                with open(os.path.join(base, "cpu.cfs_period_us"), encoding="utf-8") as f:
+                    period = int(f.read())
+            except (OSError, ValueError):
+                continue
+            return quota / period if quota > 0 and period > 0 else None
+    return None
+
+def get_load_average():
+    """1-minute load average (from /proc/loadavg where available), or None."""
+    try:
+        with open("/proc/loadavg", encoding="utf-8") as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+def get_cpu_budget_size():
+    """Number of CPU threads QuickTube may keep busy in total (QUICKTUBE_CPUS overrides).
+    Inside a container this is the cgroup quota; on a desktop it's half of the usable
+    cores, to prevent overheating."""
+    override = get_env_number("QUICKTUBE_CPUS", 0)
+    if override >= 1:
+        return int(override)
     try:
-        import multiprocessing
-        cores = multiprocessing.cpu_count()
-        # Use half the cores (minimum 1, maximum 4) to prevent device overheating
-        return str(max(1, min(cores // 2, 4)))
-    except:
-        return "2"  # Safe default
+        cores = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cores = os.cpu_count() or 2
+    limit = read_cgroup_cpu_limit()
+    if limit:
+        return max(1, min(cores, int(limit + 0.5)))
+    return max(1, cores // 2)
+
+class CpuBudget:
+    """Global pool of CPU threads handed out to concurrent ffmpeg and yt-dlp jobs.
+    Threads used by other programs (load average above our own usage) are kept free."""
+
+    def __init__(self, total, job_threads=None):
+        self.total = total
+        # Threads a single job asks for (QUICKTUBE_THREADS / --threads), default: the whole pool
+        self.job_threads = job_threads
+        self.in_use = 0
+        self.condition = threading.Condition()
+        # Load of other programs before we started anything
+        self.startup_load = get_load_average()
+
+    def available(self):
+        load = get_load_average()
+        if load is None or self.startup_load is None:
+            return max(0, self.total - self.in_use)
+        # The load average lags behind and still counts our encoders that just finished, so
+        # other programs are never taken to use more than they did at startup. Only whole
+        # threads count as busy.
+        external = int(min(self.startup_load, max(0.0, load - self.in_use)))
+        return max(0, self.total - self.in_use - external)
+
+    @contextlib.contextmanager
+    def reserve(self, wanted=None, minimum=1):
+        """Reserve up to wanted threads (at least minimum, waiting for them if the pool is
+        busy) for the duration of the block; yields the number granted. A job is never
+        kept waiting while nothing of ours is running, even on a loaded machine."""
+        wanted = max(minimum, min(wanted or self.job_threads or self.total, self.total))
+        with self.condition:
+            while self.in_use and self.available() < minimum:
+                # Re-check now and then, the load of other programs changes too
+                self.condition.wait(1.0)
+            granted = max(minimum, min(wanted, self.available()))
+            self.in_use += granted
+        if DEBUG_MODE and granted:
+            print(f"🐛 Debug mode: CPU budget {granted} thread(s), {self.in_use}/{self.total} in use", flush=True)
+        try:
+            yield granted
+        finally:
+            with self.condition:
+                self.in_use -= granted
+                self.condition.notify_all()
+
+CPU_BUDGET = CpuBudget(get_cpu_budget_size(), int(get_env_number("QUICKTUBE_THREADS", 0)) or None)
+
+def get_cpu_thread_count():
+    """Get the thread count for one encode without reserving it: the per-job setting, or the
+    whole CPU budget (use CPU_BUDGET.reserve() when other jobs may run at the same time)."""
+    return str(CPU_BUDGET.job_threads or CPU_BUDGET.total)
 
 
 def format_command(command):
@@ -76,9 +417,791 @@ def format_command(command):
     except AttributeError:
         return " ".join(shlex.quote(arg) for arg in command)
 
-def convert_video(input_file, target_format):
+PROGRESS_MARKER = "[quicktube-progress]"
+PROGRESS_FIELDS = ("status", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "speed", "eta", "fragment_index", "fragment_count", "filename")
+
+def get_progress_template():
+    """Get the yt-dlp --progress-template values that print machine-readable progress lines."""
+    fields = ",".join(PROGRESS_FIELDS)
+    return [
+        f"download:{PROGRESS_MARKER} download\t%(info.id)s\t%(progress.{{{fields}}})j",
+        f"postprocess:{PROGRESS_MARKER} postprocess\t%(info.id)s\t%(progress.{{status,postprocessor}})j",
+    ]
+
+def make_download_event(status, job=None, video_id=None):
+    """Turn a yt-dlp progress dict (hook or template output) into a download event."""
+    event = {"event": "download", "job": job, "id": video_id, "time": time.time()}
+    for field in PROGRESS_FIELDS:
+        event[field] = status.get(field)
+    if event["total_bytes"] is None:
+        event["total_bytes"] = event.pop("total_bytes_estimate")
+    else:
+        event.pop("total_bytes_estimate")
+    return event
+
+def make_postprocess_event(status, job=None, video_id=None):
+    """Turn a yt-dlp postprocessor status (e.g. Merger started/finished) into an event."""
+    return {"event": "postprocess", "job": job, "id": video_id, "time": time.time(),
+            "status": status.get("status"), "postprocessor": status.get("postprocessor")}
+
+def parse_ytdlp_progress_line(line, job=None):
+    """Parse a line printed through get_progress_template(); returns an event or None."""
+    line = line.strip()
+    if not line.startswith(PROGRESS_MARKER):
+        return None
+    try:
+        kind, video_id, payload = line[len(PROGRESS_MARKER):].strip().split("\t", 2)
+        status = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(status, dict):
+        return None
+    if video_id == "NA":
+        video_id = None
+    if kind == "postprocess":
+        return make_postprocess_event(status, job, video_id)
+    return make_download_event(status, job, video_id)
+
+def parse_ffmpeg_progress_line(block, line, job=None):
+    """Add one line of ffmpeg '-progress pipe:1' output (key=value blocks ending in progress=...)
+    to block. Returns a convert event when the line completes a block, else None."""
+    key, sep, value = line.strip().partition("=")
+    if not sep:
+        return None
+    block[key] = value.strip()
+    if key != "progress":
+        return None
+    event = {"event": "convert", "job": job, "time": time.time(), "status": "finished" if value.strip() == "end" else "converting"}
+    for field in ("frame", "total_size"):
+        try:
+            event[field] = int(block[field])
+        except (KeyError, ValueError):
+            event[field] = None
+    try:
+        event["fps"] = float(block["fps"])
+    except (KeyError, ValueError):
+        event["fps"] = None
+    try:
+        # out_time_us is microseconds (older ffmpeg also reports it as out_time_ms)
+        event["out_time"] = int(block.get("out_time_us") or block["out_time_ms"]) / 1000000
+    except (KeyError, ValueError):
+        event["out_time"] = None
+    try:
+        event["speed"] = float(block.get("speed", "").rstrip("x"))
+    except ValueError:
+        event["speed"] = None
+    block.clear()
+    return event
+
+def parse_ffmpeg_progress(stream, job=None):
+    """Yield convert events from ffmpeg '-progress pipe:1' output."""
+    block = {}
+    for line in stream:
+        event = parse_ffmpeg_progress_line(block, line, job)
+        if event is not None:
+            yield event
+
+def format_bytes(size):
+    """Format a byte count for display (e.g. 12.3 MiB)."""
+    if size is None:
+        return "?"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024 or unit == "GiB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+
+def format_seconds(seconds):
+    """Format a duration as H:MM:SS or M:SS."""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+class ProgressDisplay:
+    """Render progress events as a single updating terminal line.
+    'single' shows the latest event, 'aggregate' sums all active jobs (batch mode)."""
+
+    def __init__(self, mode="single"):
+        self.mode = mode
+        self.active = {}
+        self.line_length = 0
+        self.last_render = 0.0
+        self.lock = threading.Lock()
+        self.enabled = sys.stdout.isatty()
+
+    def update(self, event):
+        with self.lock:
+            key = (event["event"], event.get("job"), event.get("id"))
+            if event.get("status") in ("finished", "error"):
+                self.active.pop(key, None)
+            else:
+                self.active[key] = event
+            # Redraw at most 10 times per second
+            if not self.enabled or (event["time"] - self.last_render < 0.1 and key in self.active):
+                return
+            self.last_render = event["time"]
+            self._draw(self.format_line(event))
+
+    def format_line(self, event):
+        if self.mode == "aggregate":
+            downloads = [e for e in self.active.values() if e["event"] == "download"]
+            converts = [e for e in self.active.values() if e["event"] == "convert"]
+            speed = sum(e.get("speed") or 0 for e in downloads)
+            return f"⬇️  {len(downloads)} downloading at {format_bytes(speed)}/s · 🔄 {len(converts)} converting"
+        if event["event"] == "download":
+            done, total = event.get("downloaded_bytes"), event.get("total_bytes")
+            percent = f"{done * 100 / total:5.1f}%" if done is not None and total else "  ?  %"
+            return (f"⬇️  {percent} of {format_bytes(total)} at {format_bytes(event.get('speed'))}/s"
+                    f" ETA {format_seconds(event.get('eta'))}")
+        if event["event"] == "convert":
+            speed = f"{event['speed']:.2f}x" if event.get("speed") is not None else "?x"
+            done = format_seconds(event.get("out_time"))
+            if event.get("duration") and event.get("out_time") is not None:
+                done = f"{min(100.0, event['out_time'] * 100 / event['duration']):5.1f}% ({done} of {format_seconds(event['duration'])})"
+            return f"🔄 {done} converted · frame {event.get('frame') or 0} · {event.get('fps') or 0:.0f} fps · {speed}"
+        if event["event"] == "postprocess" and event.get("status") == "started":
+            return f"⚙️  {event.get('postprocessor')}..."
+        return ""
+
+    def _draw(self, text):
+        padding = " " * max(0, self.line_length - len(text))
+        sys.stdout.write("\r" + text + padding)
+        sys.stdout.flush()
+        self.line_length = len(text)
+
+    def clear(self):
+        """Erase the progress line so regular output starts on a clean line."""
+        with self.lock:
+            if self.enabled and self.line_length:
+                sys.stdout.write("\r" + " " * self.line_length + "\r")
+                sys.stdout.flush()
+                self.line_length = 0
+
+    def print_line(self, text):
+        self.clear()
+        print(text, flush=True)
+
+class ProgressSink:
+    """Write progress events as JSON lines to a file, tcp://host:port, udp://host:port or unix:/path."""
+
+    def __init__(self, target):
+        self.target = target
+        self.lock = threading.Lock()
+        self.file = self.sock = self.address = None
+        if target.startswith(("tcp://", "udp://")):
+            host, _, port = target[6:].rpartition(":")
+            self.address = (host.strip("[]") or "127.0.0.1", int(port))
+            if target.startswith("tcp://"):
+                self.sock = socket.create_connection(self.address, timeout=5)
+            else:
+                self.sock = socket.socket(socket.AF_INET6 if ":" in self.address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        elif target.startswith("unix:"):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(target[5:])
+        else:
+            self.file = open(target, "a", encoding="utf-8")
+
+    def write(self, event):
+        data = json.dumps(event, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file:
+                self.file.write(data)
+                self.file.flush()
+            elif self.target.startswith("udp://"):
+                self.sock.sendto(data.encode("utf-8"), self.address)
+            else:
+                self.sock.sendall(data.encode("utf-8"))
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+            if self.sock:
+                self.sock.close()
+
+PROGRESS_DISPLAY = ProgressDisplay()
+PROGRESS_SINK = None
+
+def open_progress_sink(target):
+    """Start writing progress events to target (see ProgressSink); returns False if it can't be opened."""
+    global PROGRESS_SINK
+    try:
+        PROGRESS_SINK = ProgressSink(target)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Cannot open progress log {target}: {e}")
+        return False
+
+def emit_progress(event, show=True):
+    """Send a progress event to the terminal display and the progress log (if any)."""
+    global PROGRESS_SINK
+    if show:
+        PROGRESS_DISPLAY.update(event)
+    if PROGRESS_SINK is not None:
+        try:
+            PROGRESS_SINK.write(event)
+        except OSError as e:
+            # Don't let a dead log reader break downloads
+            PROGRESS_DISPLAY.print_line(f"⚠️  Progress log stopped: {e}")
+            PROGRESS_SINK = None
+
+class MetricsRecorder:
+    """Collect per-stage timing spans (probe, download, merge, convert, ...) and counters.
+    Spans are appended to a JSONL file as they finish; totals can be written as a
+    Prometheus textfile and printed as a summary table."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.counters = {"bytes_downloaded": 0, "retries": 0, "archive_hits": 0, "jobs_ok": 0, "jobs_failed": 0}
+        self.open_postprocessors = {}
+        self.jsonl_path = os.getenv("QUICKTUBE_METRICS_JSONL", "").strip() or None
+        self.prom_path = os.getenv("QUICKTUBE_METRICS_PROM", "").strip() or None
+
+    @contextlib.contextmanager
+    def span(self, job, stage, **fields):
+        """Time a stage; the caller may set span["exit_code"] and other fields on the yielded dict."""
+        span = {"type": "span", "job": job, "stage": stage, "start": time.time(), "exit_code": None}
+        span.update(fields)
+        started = time.monotonic()
+        try:
+            yield span
+        finally:
+            span["duration"] = time.monotonic() - started
+            self.add_span(span)
+
+    def add_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+        self.write_jsonl(span)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_job(self, job, ok, elapsed):
+        self.count("jobs_ok" if ok else "jobs_failed")
+        self.write_jsonl({"type": "job", "job": job, "ok": ok, "duration": elapsed, "end": time.time()})
+
+    def on_progress(self, event):
+        """Progress hook: count downloaded bytes and turn postprocessor start/finish into spans."""
+        if event["event"] == "download" and event.get("status") == "finished":
+            self.count("bytes_downloaded", event.get("downloaded_bytes") or event.get("total_bytes") or 0)
+        elif event["event"] == "postprocess":
+            key = (event.get("job"), event.get("id"), event.get("postprocessor"))
+            if event.get("status") == "started":
+                with self.lock:
+                    self.open_postprocessors[key] = (event["time"], time.monotonic())
+            elif event.get("status") == "finished":
+                with self.lock:
+                    opened = self.open_postprocessors.pop(key, None)
+                if opened:
+                    postprocessor = event.get("postprocessor") or "postprocess"
+                    stage = {"Merger": "merge", "ExtractAudio": "extract_audio"}.get(postprocessor, postprocessor.lower())
+                    self.add_span({"type": "span", "job": event.get("job"), "id": event.get("id"), "stage": stage,
+                                   "start": opened[0], "duration": time.monotonic() - opened[1], "exit_code": 0})
+
+    def write_jsonl(self, record):
+        if not self.jsonl_path:
+            return
+        try:
+            with self.lock, open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"⚠️  Cannot write metrics to {self.jsonl_path}: {e}")
+            self.jsonl_path = None
+
+    def stage_totals(self):
+        """Return {stage: (count, total_seconds, max_seconds, failures)}."""
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            count, total, longest, failures = totals.get(span["stage"], (0, 0.0, 0.0, 0))
+            failed = span.get("exit_code") not in (0, None)
+            totals[span["stage"]] = (count + 1, total + span["duration"], max(longest, span["duration"]), failures + failed)
+        return totals
+
+    def write_prometheus(self, path=None):
+        """Write the totals in Prometheus text format (atomically, for the node_exporter textfile collector)."""
+        path = path or self.prom_path
+        if not path:
+            return
+        lines = [
+            "# HELP quicktube_stage_duration_seconds Time spent per stage.",
+            "# TYPE quicktube_stage_duration_seconds summary",
+        ]
+        totals = self.stage_totals()
+        for stage, (count, total, _, _) in sorted(totals.items()):
+            lines.append(f'quicktube_stage_duration_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'quicktube_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        lines += ["# HELP quicktube_stage_failures_total Stages that ended with a non-zero exit code.",
+                  "# TYPE quicktube_stage_failures_total counter"]
+        for stage, (_, _, _, failures) in sorted(totals.items()):
+            lines.append(f'quicktube_stage_failures_total{{stage="{stage}"}} {failures}')
+        with self.lock:
+            counters = dict(self.counters)
+        lines += [
+            "# HELP quicktube_bytes_downloaded_total Bytes downloaded by yt-dlp.",
+            "# TYPE quicktube_bytes_downloaded_total counter",
+            f"quicktube_bytes_downloaded_total {counters['bytes_downloaded']}",
+            "# HELP quicktube_retries_total Download retries.",
+            "# TYPE quicktube_retries_total counter",
+            f"quicktube_retries_total {counters['retries']}",
+            "# HELP quicktube_archive_hits_total Downloads skipped because the archive already had them.",
+            "# TYPE quicktube_archive_hits_total counter",
+            f"quicktube_archive_hits_total {counters['archive_hits']}",
+            "# HELP quicktube_jobs_total Finished jobs by result.",
+            "# TYPE quicktube_jobs_total counter",
+            f'quicktube_jobs_total{{result="ok"}} {counters["jobs_ok"]}',
+            f'quicktube_jobs_total{{result="failed"}} {counters["jobs_failed"]}',
+        ]
+        try:
+            write_file_atomic(path, "\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"⚠️  Cannot write metrics to {path}: {e}")
+
+    def print_summary(self):
+        """Print a per-stage timing table."""
+        totals = self.stage_totals()
+        if not totals:
+            return
+        print("\n🐛 Debug mode: stage timings")
+        print(f"   {'stage':<16}{'count':>7}{'total s':>11}{'avg s':>10}{'max s':>10}{'failed':>8}")
+        for stage, (count, total, longest, failures) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            print(f"   {stage:<16}{count:>7}{total:>11.2f}{total / count:>10.2f}{longest:>10.2f}{failures:>8}")
+        with self.lock:
+            counters = dict(self.counters)
+        print(f"   downloaded {format_bytes(counters['bytes_downloaded'])}, {counters['retries']} retries")
+
+    def flush(self):
+        """Export totals and, in debug mode, print the summary table."""
+        self.write_prometheus()
+        if DEBUG_MODE:
+            self.print_summary()
+
+METRICS = MetricsRecorder()
+
+def run_ffmpeg(command, timeout, job=None, show_progress=True, duration=None, stdin=None, progress_hooks=()):
+    """Run an ffmpeg command that has '-progress pipe:1', emitting convert events
+    (with the input duration, when known, so progress can be shown as a percentage)
+    and passing them to progress_hooks.
+    Returns the exit code; raises subprocess.TimeoutExpired after timeout seconds."""
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, text=True, errors="replace")
+    for hook in progress_hooks:
+        if hasattr(hook, "attach_process"):
+            hook.attach_process(process)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        try:
+            for event in parse_ffmpeg_progress(process.stdout, job):
+                event["duration"] = duration
+                emit_progress(event, show_progress)
+                for hook in progress_hooks:
+                    hook(event)
+        finally:
+            detach_process_hooks(progress_hooks)
+        returncode = process.wait()
+    finally:
+        timer.cancel()
+        if show_progress:
+            PROGRESS_DISPLAY.clear()
+    if timed_out:
+        raise subprocess.TimeoutExpired(command, timeout)
+    return returncode
+
+@functools.lru_cache(maxsize=None)
+def get_ffprobe_path():
+    """Get the path to ffprobe binary (bundled, next to ffmpeg, or system), resolved once per run"""
+    ffprobe_name = "ffprobe.exe" if os.name == 'nt' else "ffprobe"
+    if getattr(sys, 'frozen', False):
+        bundled_ffprobe = os.path.join(sys._MEIPASS, ffprobe_name)
+        if os.path.exists(bundled_ffprobe):
+            return bundled_ffprobe
+    ffmpeg_cmd = get_ffmpeg_path()
+    if os.path.isabs(ffmpeg_cmd):
+        sibling = os.path.join(os.path.dirname(ffmpeg_cmd), ffprobe_name)
+        if os.path.exists(sibling):
+            return sibling
+    # Fall back to system ffprobe
+    return "ffprobe"
+
+TOOL_INFO_LOCK = threading.Lock()
+
+def resolve_executable(command):
+    """Absolute path of a tool command (bundled path or PATH lookup), or None if it isn't installed."""
+    if os.path.isabs(command):
+        return command if os.path.exists(command) else None
+    return shutil.which(command)
+
+def parse_ffmpeg_listing(text):
+    """Names from 'ffmpeg -encoders'/'-muxers' output (the table after the dashed line)."""
+    names = set()
+    listing = False
+    for line in text.splitlines():
+        fields = line.split()
+        if not listing:
+            listing = bool(fields) and set(fields[0]) == {"-"}
+            continue
+        if len(fields) >= 2:
+            names.update(fields[1].split(","))
+    return sorted(names)
+
+def discover_tool_info(tool, path):
+    """Run a tool to find its version (and for ffmpeg its encoders and muxers)."""
+    def run(*args):
+        try:
+            return subprocess.run([path, *args], capture_output=True, text=True, errors="replace", timeout=30).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return ""
+
+    if tool != "ffmpeg":
+        return {"version": run("--version").strip() or None}
+    version = run("-hide_banner", "-version").split()
+    return {
+        "version": version[2] if version[:2] == ["ffmpeg", "version"] and len(version) > 2 else None,
+        "encoders": parse_ffmpeg_listing(run("-hide_banner", "-encoders")),
+        "muxers": parse_ffmpeg_listing(run("-hide_banner", "-muxers")),
+    }
+
+@functools.lru_cache(maxsize=None)
+def get_tool_info(tool):
+    """Version of "ffmpeg" or "yt-dlp" (for ffmpeg also its encoders and muxers), or {} if the
+    tool is missing. Kept in the cache folder per binary path, size and modification time,
+    so the tool is only run again after it was updated."""
+    path = resolve_executable({"ffmpeg": get_ffmpeg_path, "yt-dlp": get_ytdlp_path}[tool]())
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        stat = None
+    if stat is None:
+        return {}
+    key = f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+    cache_file = os.path.join(get_cache_dir(), "tools.json")
+
+    def load():
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    with TOOL_INFO_LOCK:
+        info = load().get(key)
+    if isinstance(info, dict):
+        return info
+    info = discover_tool_info(tool, path)
+    with TOOL_INFO_LOCK:
+        # Forget what older versions of the same binary supported
+        cache = {name: value for name, value in load().items() if name.partition("|")[0] != path}
+        cache[key] = info
+        try:
+            write_file_atomic(cache_file, json.dumps(cache))
+        except OSError:
+            pass
+    return info
+
+def ffmpeg_supports(encoder=None, muxer=None):
+    """Whether the ffmpeg in use has this encoder and/or muxer. True when ffmpeg's
+    capabilities can't be read, so a missing listing never blocks a conversion."""
+    info = get_tool_info("ffmpeg")
+    if encoder and info.get("encoders") and encoder not in info["encoders"]:
+        return False
+    if muxer and info.get("muxers") and muxer not in info["muxers"]:
+        return False
+    return True
+
+def probe_media_streams(input_file):
+    """Read stream and container info with ffprobe (or, without it, from 'ffmpeg -i').
+    Returns the parsed JSON or None."""
+    command = [get_ffprobe_path(), "-v", "error", "-show_streams", "-show_format", "-of", "json", input_file]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=30)
+        if result.returncode == 0:
+            return json.loads(result.stdout)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        pass
+    # Some ffmpeg builds (e.g. the one bundled on Apple Silicon) come without ffprobe
+    try:
+        result = subprocess.run([get_ffmpeg_path(), "-hide_banner", "-i", input_file],
+                                capture_output=True, text=True, errors="replace", timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return parse_ffmpeg_stream_info(result.stderr)
+
+def parse_ffmpeg_stream_info(text):
+    """Build the ffprobe fields plan_conversion() needs from the input summary that
+    'ffmpeg -i' prints. Returns {"streams", "format"}, or None when no stream is listed."""
+    streams = []
+    for match in re.finditer(r"^\s*Stream #0:(\d+)\S*: (\w+): (\w+)(.*)$", text, re.MULTILINE):
+        index, kind, codec, details = match.groups()
+        stream = {"index": int(index), "codec_type": kind.lower(), "codec_name": codec,
+                  "disposition": {"attached_pic": int("(attached pic)" in details)}}
+        if stream["codec_type"] == "video":
+            # e.g. " (High) (avc1 / 0x31637661), yuv420p(progressive), 1280x720 [SAR 1:1 DAR 16:9], ..."
+            fields = details.split(", ")
+            pix_fmt = re.match(r"\w+", fields[1]) if len(fields) > 1 else None
+            if pix_fmt:
+                stream["pix_fmt"] = pix_fmt.group(0)
+            size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", details)
+            if size:
+                stream["width"], stream["height"] = int(size.group(1)), int(size.group(2))
+        streams.append(stream)
+    if not streams:
+        return None
+    probe = {"streams": streams, "format": {}}
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", text)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        probe["format"]["duration"] = str(int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+    return probe
+
+def plan_conversion(probe):
+    """Decide per stream whether it can be copied into an H.264/AAC output or must be re-encoded.
+    Returns {"video", "audio", "copy_video", "copy_audio", "duration"} (streams are ffprobe dicts)."""
+    streams = probe.get("streams") or []
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"
+                  and not (stream.get("disposition") or {}).get("attached_pic")), None)
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+    try:
+        duration = float((probe.get("format") or {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return {
+        "video": video,
+        "audio": audio,
+        # 8-bit 4:2:0 H.264 is what the full encode produces, so it can be kept as is
+        "copy_video": video is not None and video.get("codec_name") == "h264" and video.get("pix_fmt") in ("yuv420p", "yuvj420p"),
+        "copy_audio": audio is not None and audio.get("codec_name") == "aac",
+        "duration": duration,
+    }
+
+def describe_plan(plan):
+    """Describe a conversion plan for the terminal (e.g. 'video: h264 → copy · audio: opus → AAC')."""
+    parts = []
+    if plan["video"] is not None:
+        parts.append(f"video: {plan['video'].get('codec_name')} → {'copy' if plan['copy_video'] else 'H.264'}")
+    if plan["audio"] is not None:
+        parts.append(f"audio: {plan['audio'].get('codec_name')} → {'copy' if plan['copy_audio'] else 'AAC'}")
+    return " · ".join(parts) or "no audio/video streams found"
+
+def get_video_encode_args(target_format, thread_count):
+    """Get the libx264 settings used for every full conversion."""
+    # Common ffmpeg settings to reduce CPU usage and prevent overheating:
+    # - ultrafast preset: fastest encoding, lowest CPU usage
+    # - threads: limit CPU threads used
+    # - crf 23: good quality with reasonable file size
+    args = ["-threads", thread_count, "-c:v", "libx264"]
+    if target_format == "mp4":
+        args += ["-profile:v", "high", "-level", "4.1"]
+    return args + ["-preset", "ultrafast", "-crf", "23", "-pix_fmt", "yuv420p"]
+
+def build_smart_convert_command(ffmpeg_cmd, input_file, output_file, target_format, thread_count, plan):
+    """Build an ffmpeg command that copies compatible streams and re-encodes only the rest."""
+    command = [ffmpeg_cmd, "-y", "-i", input_file]
+    if plan["video"] is not None:
+        command += ["-map", f"0:{plan['video']['index']}"]
+    if plan["audio"] is not None:
+        command += ["-map", f"0:{plan['audio']['index']}"]
+    if plan["video"] is not None:
+        command += ["-c:v", "copy"] if plan["copy_video"] else get_video_encode_args(target_format, thread_count)
+    if plan["audio"] is not None:
+        command += ["-c:a", "copy"] if plan["copy_audio"] else ["-c:a", "aac"]
+    if target_format == "mp4":
+        command += ["-movflags", "+faststart"]
+    return command + ["-loglevel", "error", "-nostats", "-progress", "pipe:1", output_file]
+
+CHUNKED_TRANSCODE = os.getenv("QUICKTUBE_CHUNKED", "off").strip().lower() or "off"
+CHUNK_THREADS = 2  # libx264 threads per chunk encoder; more chunks scale better than more threads
+CHUNKED_MIN_DURATION = 120  # auto mode: inputs shorter than this aren't worth splitting
+
+def get_chunk_workers(threads=None):
+    """Number of chunks encoded at once (QUICKTUBE_CHUNK_WORKERS, default: the granted
+    threads, or the whole CPU budget, / CHUNK_THREADS)."""
+    workers = int(get_env_number("QUICKTUBE_CHUNK_WORKERS", 0))
+    if workers < 1:
+        workers = (threads or CPU_BUDGET.total) // CHUNK_THREADS
+    return max(1, workers)
+
+def should_chunk_transcode(plan):
+    """Check whether a conversion should use transcode_chunked() (QUICKTUBE_CHUNKED=off|on|auto)."""
+    if CHUNKED_TRANSCODE in ("", "0", "off", "false", "no") or not plan or not plan["duration"]:
+        return False
+    if plan["video"] is None or plan["copy_video"] or get_chunk_workers() < 2:
+        return False
+    if CHUNKED_TRANSCODE == "auto" and plan["duration"] < CHUNKED_MIN_DURATION:
+        return False
+    # Splitting needs the segment muxer, which minimal ffmpeg builds leave out
+    return ffmpeg_supports(muxer="segment")
+
+def transcode_chunked(input_file, output_file, target_format, plan, job=None, workers=None):
+    """Encode the video in parallel: split it on keyframes, encode the chunks concurrently
+    with the usual libx264 settings and join them losslessly with the concat demuxer.
+    The audio is encoded (or copied) in one piece alongside. Returns True on success."""
+    ffmpeg_cmd = get_ffmpeg_path()
+    workers = workers or get_chunk_workers()
+    work_dir = tempfile.mkdtemp(prefix=".quicktube-chunks-", dir=os.path.dirname(os.path.abspath(output_file)))
+    quiet = ["-loglevel", "error", "-nostats"]
+    try:
+        # 1. Split the video stream at keyframes (stream copy, no re-encoding).
+        #    A few chunks per worker keeps all cores busy until the end.
+        chunk_length = max(10.0, plan["duration"] / (workers * 3))
+        split = [ffmpeg_cmd, "-y", "-i", input_file, "-map", f"0:{plan['video']['index']}", "-an", "-sn", "-dn",
+                 "-c", "copy", "-f", "segment", "-segment_time", f"{chunk_length:.3f}", "-reset_timestamps", "1",
+                 *quiet, os.path.join(work_dir, "chunk_%05d.mkv")]
+        if DEBUG_MODE:
+            print("🐛 Debug mode: split command")
+            print(format_command(split))
+        if subprocess.run(split, timeout=600).returncode != 0:
+            return False
+        chunks = sorted(name for name in os.listdir(work_dir) if name.startswith("chunk_"))
+        if not chunks:
+            return False
+
+        # 2. Encode chunks (and the audio track) in parallel - each job is its own ffmpeg process
+        def encode_chunk(name):
+            command = [ffmpeg_cmd, "-y", "-i", os.path.join(work_dir, name)]
+            command += get_video_encode_args(target_format, str(CHUNK_THREADS))
+            command += quiet + [os.path.join(work_dir, "encoded_" + name)]
+            return subprocess.run(command, timeout=600).returncode
+
+        def encode_audio():
+            codec = ["-c:a", "copy"] if plan["copy_audio"] else ["-c:a", "aac"]
+            command = [ffmpeg_cmd, "-y", "-i", input_file, "-map", f"0:{plan['audio']['index']}", "-vn", *codec,
+                       *quiet, os.path.join(work_dir, "audio.mka")]
+            return subprocess.run(command, timeout=600).returncode
+
+        print(f"⚡ Encoding {len(chunks)} chunks with {workers} parallel encoders...")
+        job = job or os.path.basename(input_file)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(encode_chunk, name): name for name in chunks}
+            if plan["audio"] is not None:
+                futures[pool.submit(encode_audio)] = "audio"
+            done = 0
+            for future in as_completed(futures):
+                if future.result() != 0:
+                    print(f"❌ Encoding {futures[future]} failed.")
+                    for other in futures:
+                        other.cancel()
+                    return False
+                if futures[future] != "audio":
+                    done += 1
+                    emit_progress({"event": "convert", "job": job, "time": time.time(), "status": "converting",
+                                   "frame": None, "total_size": None, "fps": None, "speed": None,
+                                   "out_time": plan["duration"] * done / len(chunks), "duration": plan["duration"]})
+
+        # 3. Join the encoded chunks and the audio without re-encoding
+        list_file = os.path.join(work_dir, "chunks.txt")
+        with open(list_file, "w", encoding="utf-8") as f:
+            for name in chunks:
+                f.write(f"file 'encoded_{name}'\n")
+        concat = [ffmpeg_cmd, "-y", "-f", "concat", "-safe", "0", "-i", list_file]
+        if plan["audio"] is not None:
+            concat += ["-i", os.path.join(work_dir, "audio.mka"), "-map", "0:v", "-map", "1:a"]
+        concat += ["-c", "copy"]
+        if target_format == "mp4":
+            concat += ["-movflags", "+faststart"]
+        concat += quiet + [output_file]
+        PROGRESS_DISPLAY.clear()
+        return subprocess.run(concat, timeout=600).returncode == 0
+    except (OSError, subprocess.TimeoutExpired) as e:
+        PROGRESS_DISPLAY.clear()
+        print(f"❌ Chunked encoding error: {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def get_converted_path(input_file, target_format, suffix="_converted"):
+    """Output path of a conversion: the downloaded file's name with suffix and the new extension."""
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(os.path.dirname(input_file), f"{base_name}{suffix}.{target_format}")
+
+def build_convert_command(input_file, output_file, target_format, thread_count, plan):
+    """Build the ffmpeg command of a conversion from its plan (see plan_conversion()).
+    Returns (mode, command): "smart" when some streams are copied, else "full"."""
+    ffmpeg_cmd = get_ffmpeg_path()
+    if plan and (plan["copy_video"] or plan["copy_audio"]):
+        return "smart", build_smart_convert_command(ffmpeg_cmd, input_file, output_file, target_format, thread_count, plan)
+    # Nothing can be copied (or ffprobe is unavailable) - full encode
+    command = [ffmpeg_cmd, "-y", "-i", input_file] + get_video_encode_args(target_format, thread_count) + ["-c:a", "aac"]
+    if target_format == "mp4":
+        command += ["-movflags", "+faststart"]
+    command += ["-loglevel", "error", "-nostats", "-progress", "pipe:1", output_file]
+    return "full", command
+
+def build_remux_command(input_file, output_file, target_format):
+    """Build the ffmpeg command that copies all streams into another container."""
+    command = [
+        get_ffmpeg_path(), "-y", "-i", input_file,
+        "-c", "copy",  # Copy all streams without re-encoding
+    ]
+    if target_format == "mp4":
+        command += ["-movflags", "+faststart"]
+    return command + ["-loglevel", "error", "-nostats", "-progress", "pipe:1", output_file]
+
+PARTIAL_MARKER = ".quicktube-part"
+ORPHAN_AGE = 5 * 60  # partial outputs untouched this long belong to a process that died
+
+def get_partial_path(output_file):
+    """Temporary name ffmpeg writes to before the output is renamed into place
+    (keeps the extension, ffmpeg picks the container from it)."""
+    base, ext = os.path.splitext(output_file)
+    return f"{base}{PARTIAL_MARKER}{ext}"
+
+@contextlib.contextmanager
+def atomic_output(output_file):
+    """Yield the partial path for output_file. The caller renames it into place with
+    os.replace() once the output is complete; whatever is left over is removed, so a failed
+    or interrupted conversion never leaves a half-written file under the final name."""
+    partial_file = get_partial_path(output_file)
+    try:
+        yield partial_file
+    finally:
+        try:
+            os.remove(partial_file)
+        except OSError:
+            pass
+
+def cleanup_partial_outputs(root):
+    """Remove partial outputs and chunk folders that a crashed run left behind under root.
+    yt-dlp's own .part files are kept, downloads resume from them."""
+    now = time.time()
+    removed = 0
+    for folder, dirs, files in os.walk(root):
+        for name in list(dirs):
+            if name.startswith(".quicktube-chunks-"):
+                path = os.path.join(folder, name)
+                try:
+                    if now - os.path.getmtime(path) > ORPHAN_AGE:
+                        shutil.rmtree(path, ignore_errors=True)
+                        removed += 1
+                except OSError:
+                    pass
+                dirs.remove(name)
+        for name in files:
+            if PARTIAL_MARKER in name:
+                path = os.path.join(folder, name)
+                try:
+                    if now - os.path.getmtime(path) > ORPHAN_AGE:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+    return removed
+
+def convert_video(input_file, target_format, job=None, full=False):
     """Converts the video to the specified format using H.264 for video and AAC for audio.
-    Uses resource-efficient settings to prevent device overheating."""
+    Streams that already use those codecs are copied instead of re-encoded, unless full is set.
+    Encoder threads come from the shared CPU budget, so parallel jobs don't oversubscribe the CPU."""
     # Get the current file extension
     current_ext = os.path.splitext(input_file)[1][1:].lower()
     
@@ -87,253 +1210,1717 @@ def convert_video(input_file, target_format):
         print(f"⚠️  File is already in {target_format.upper()} format. No conversion needed.")
         return input_file
     
-    # Use the base name of the downloaded file for the converted output
-    base_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(os.path.dirname(input_file), f"{base_name}_converted.{target_format}")
+    output_file = get_converted_path(input_file, target_format)
 
-    # Get ffmpeg path (bundled or system)
-    ffmpeg_cmd = get_ffmpeg_path()
-    thread_count = get_cpu_thread_count()
+    if target_format not in ("mp4", "mkv"):
+        print("❌ Unsupported format. No conversion performed.")
+        return None
 
-    # Common ffmpeg settings to reduce CPU usage and prevent overheating:
-    # - ultrafast preset: fastest encoding, lowest CPU usage
-    # - threads: limit CPU threads used
-    # - crf 23: good quality with reasonable file size
-    if target_format == "mp4":
-        command = [
-            ffmpeg_cmd, "-y", "-i", input_file,
-            "-threads", thread_count,
-            "-vcodec", "libx264", "-profile:v", "high", "-level", "4.1",
-            "-acodec", "aac",
-            "-preset", "ultrafast",  # Much faster, less CPU intensive
-            "-crf", "23",
-            "-pix_fmt", "yuv420p",
-            "-movflags", "+faststart",
-            "-loglevel", "error", "-stats",
-            output_file
-        ]
-    elif target_format == "mkv":
-        command = [
-            ffmpeg_cmd, "-y", "-i", input_file,
-            "-threads", thread_count,
-            "-c:v", "libx264", "-c:a", "aac",
-            "-preset", "ultrafast",  # Much faster, less CPU intensive
-            "-crf", "23",
-            "-pix_fmt", "yuv420p",
-            "-loglevel", "error", "-stats",
-            output_file
-        ]
+    # Inspect the streams to see what actually needs re-encoding
+    probe = probe_media_streams(input_file)
+    plan = plan_conversion(probe) if probe else None
+    if plan and full:
+        plan["copy_video"] = plan["copy_audio"] = False
+    if not (plan and (plan["copy_video"] or plan["video"] is None)) and not ffmpeg_supports(encoder="libx264"):
+        print("❌ This ffmpeg build has no H.264 encoder (libx264). Try the quick copy instead.")
+        return None
+
+    job = job or os.path.basename(input_file)
+    # Stream copies barely use the CPU, encodes get their share of the budget
+    copy_only = bool(plan) and plan["copy_video"] and (plan["copy_audio"] or plan["audio"] is None)
+    with CPU_BUDGET.reserve(1 if copy_only else None) as threads, atomic_output(output_file) as partial_file:
+        thread_count = str(threads)
+        mode, command = build_convert_command(input_file, partial_file, target_format, thread_count, plan)
+        if mode == "smart":
+            print(f"🔍 {describe_plan(plan)}")
+
+        if should_chunk_transcode(plan):
+            workers = get_chunk_workers(threads)
+            print(f"🔄 Converting to {target_format.upper()} (parallel chunks)...")
+            with METRICS.span(job, "convert", target=target_format, threads=workers * CHUNK_THREADS, mode="chunked") as span:
+                ok = transcode_chunked(input_file, partial_file, target_format, plan, job, workers)
+                span["exit_code"] = 0 if ok else 1
+            if ok:
+                os.replace(partial_file, output_file)
+                print(f"✅ Successfully converted to {target_format.upper()}!")
+                return output_file
+            print("⚠️  Chunked encoding failed, falling back to a single encoder...")
+
+        if mode == "smart" and plan["copy_video"]:
+            print(f"🔄 Converting to {target_format.upper()} (copying video, only re-encoding what's needed)...")
+        else:
+            print(f"🔄 Converting to {target_format.upper()} (using {thread_count} CPU threads)...")
+
+        if DEBUG_MODE:
+            print("🐛 Debug mode: ffmpeg command")
+            print(format_command(command))
+
+        try:
+            # ffmpeg reports progress on stdout, errors still go straight to the terminal
+            duration = plan["duration"] if plan else None
+            with METRICS.span(job, "convert", target=target_format, threads=threads, mode=mode) as span:
+                returncode = run_ffmpeg(command, 600, job=job, duration=duration)  # 10 minute timeout for larger files
+                span["exit_code"] = returncode
+
+            if returncode == 0:
+                os.replace(partial_file, output_file)
+                print(f"✅ Successfully converted to {target_format.upper()}!")
+                return output_file
+            else:
+                print(f"❌ Conversion failed.")
+                return None
+        except subprocess.TimeoutExpired:
+            print("❌ Conversion timeout (exceeded 10 minutes).")
+            return None
+        except Exception as e:
+            print(f"❌ Conversion error: {str(e)}")
+            return None
+
+def remux_video(input_file, target_format, job=None):
+    """Remux video to another container without re-encoding (fast, no quality loss)."""
+    current_ext = os.path.splitext(input_file)[1][1:].lower()
+    
+    if current_ext == target_format.lower():
+        print(f"⚠️  File is already in {target_format.upper()} format. No remux needed.")
+        return input_file
+    
+    output_file = get_converted_path(input_file, target_format, "_remuxed")
+
+    print(f"🔄 Remuxing to {target_format.upper()} (no re-encoding, instant)...")
+    try:
+        job = job or os.path.basename(input_file)
+        with atomic_output(output_file) as partial_file:
+            # Copy streams without re-encoding - very fast, no quality loss
+            command = build_remux_command(input_file, partial_file, target_format)
+
+            with METRICS.span(job, "remux", target=target_format) as span:
+                returncode = run_ffmpeg(command, 120, job=job)  # 2 minute timeout (remux is fast)
+                span["exit_code"] = returncode
+            if returncode == 0:
+                os.replace(partial_file, output_file)
+
+        if returncode == 0:
+            print(f"✅ Successfully remuxed to {target_format.upper()}!")
+            return output_file
+        else:
+            print(f"❌ Remux failed.")
+            return None
+    except subprocess.TimeoutExpired:
+        print("❌ Remux timeout.")
+        return None
+    except Exception as e:
+        print(f"❌ Remux error: {str(e)}")
+        return None
+
+def encode_mp3(input_file, quality, job=None, show_progress=True):
+    """Encode a downloaded audio (or video) file to an MP3 next to it and remove the source.
+    libmp3lame is single-threaded, so each encode takes one thread from the CPU budget and
+    files encode in parallel instead. Returns the MP3 path, or None when encoding failed."""
+    output_file = os.path.splitext(input_file)[0] + ".mp3"
+    if input_file == output_file:
+        return input_file
+    if not ffmpeg_supports(encoder="libmp3lame"):
+        print("❌ This ffmpeg build has no MP3 encoder (libmp3lame).")
+        return None
+
+    job = job or os.path.basename(input_file)
+    probe = probe_media_streams(input_file)
+    duration = plan_conversion(probe)["duration"] if probe else None
+    bitrate = AUDIO_QUALITY_MAP.get(quality, "128k")
+    with CPU_BUDGET.reserve(1), atomic_output(output_file) as partial_file:
+        command = [get_ffmpeg_path(), "-y", "-i", input_file, "-map", "0:a:0", "-map_metadata", "0",
+                   "-c:a", "libmp3lame", "-b:a", bitrate,
+                   "-loglevel", "error", "-nostats", "-progress", "pipe:1", partial_file]
+        if DEBUG_MODE:
+            print("🐛 Debug mode: ffmpeg command")
+            print(format_command(command))
+        try:
+            with METRICS.span(job, "encode", target="mp3", threads=1) as span:
+                returncode = run_ffmpeg(command, 60 * 60, job=job, show_progress=show_progress, duration=duration)
+                span["exit_code"] = returncode
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"❌ MP3 encoding error: {e}")
+            return None
+        if returncode != 0:
+            print(f"❌ MP3 encoding failed: {os.path.basename(input_file)}")
+            return None
+        os.replace(partial_file, output_file)
+    try:
+        os.remove(input_file)
+    except OSError:
+        pass
+    return output_file
+
+def encode_audio_records(video_url, quality, is_playlist, records, show_progress=True):
+    """Encode the files of a deferred MP3 download (see run_ytdlp_download()) to MP3,
+    as many at once as the CPU budget has threads, and archive the results.
+    Returns (records with their MP3 paths, number of files that failed)."""
+    records = [dict(record) for record in records]
+    workers = max(1, min(len(records), CPU_BUDGET.total))
+
+    def encode(record):
+        # Each file is its own progress job, several of them encode at the same time
+        job = video_url if len(records) == 1 else os.path.basename(record["filepath"])
+        return encode_mp3(record["filepath"], quality, job=job, show_progress=show_progress)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="quicktube-mp3") as pool:
+        paths = list(pool.map(encode, records))
+    encoded = []
+    for record, path in zip(records, paths):
+        if path:
+            record["filepath"] = path
+            encoded.append(record)
+    archive_download(video_url, "mp3", quality, is_playlist, encoded)
+    return encoded, len(records) - len(encoded)
+
+AUDIO_QUALITY_MAP = {"64": "64k", "128": "128k", "192": "192k", "320": "320k"}
+# MP3 "quality" that keeps the source audio stream (usually AAC or Opus) without re-encoding
+AUDIO_PASSTHROUGH = "original"
+# Container that holds each audio codec as-is, for passthrough output
+NATIVE_AUDIO_EXTS = {"mp4a": "m4a", "aac": "m4a", "opus": "opus", "vorbis": "ogg", "mp3": "mp3", "flac": "flac"}
+VIDEO_QUALITY_MAP = {"144": "144", "240": "240", "360": "360", "480": "480", "720": "720", "1080": "1080", "1440": "1440", "2160": "2160"}
+
+def is_audio_passthrough(file_type, quality):
+    """True when an audio download keeps the source codec instead of becoming an MP3."""
+    return file_type == "mp3" and quality == AUDIO_PASSTHROUGH
+
+def get_native_audio_ext(acodec):
+    """File extension for an audio stream copied without re-encoding (mka for anything unusual)."""
+    return NATIVE_AUDIO_EXTS.get((acodec or "").split(".")[0].lower(), "mka")
+
+def get_base_output_dir():
+    """Get the base output directory (next to the executable, .app bundle or script)."""
+    if getattr(sys, 'frozen', False):
+        # Running as compiled executable
+        if sys.platform == 'darwin':
+            # macOS: For .app bundles, save to output folder next to the .app
+            # sys.executable is inside QuickTube.app/Contents/MacOS/QuickTube
+            # We need to go up 3 levels to get to the parent directory of the .app
+            executable_path = os.path.abspath(sys.executable)
+            if '.app/Contents/MacOS' in executable_path:
+                # Inside an app bundle - go to parent of .app
+                app_bundle = executable_path.split('.app/Contents/MacOS')[0] + '.app'
+                base_dir = os.path.dirname(app_bundle)
+            else:
+                # Not in app bundle (shouldn't happen, but fallback)
+                base_dir = os.path.dirname(executable_path)
+            return os.path.join(base_dir, "output")
+        # Windows/Linux: Use executable's directory
+        base_dir = os.path.dirname(sys.executable)
+        return os.path.join(base_dir, "output")
+    # Running as script - use script's directory
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, "output")
+
+def show_output_dir_error(output_dir, error):
+    """Print the 'cannot create output folder' help box."""
+    print("\n" + "="*60)
+    print("❌ ERROR: Cannot create output folder")
+    print("="*60)
+    print(f"\n⚠️  Could not create folder: {output_dir}")
+    print(f"\n💡 Error: {error}")
+    print("\n📋 SOLUTION:")
+    print("   1. Check folder permissions")
+    print("   2. Try running from a different location\n")
+    print("="*60 + "\n")
+
+def prepare_output_dir(file_type):
+    """Create output/<file_type> and return it, falling back to output/.
+    Raises OSError (with .filename set) if no output folder can be created."""
+    output_dir = get_base_output_dir()
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except (OSError, PermissionError) as e:
+        e.filename = output_dir
+        raise
+
+    # Store the base output directory as fallback
+    base_output_dir = output_dir
+
+    # Try to create subdirectory based on file type
+    if file_type == "mp3":
+        output_dir = os.path.join(output_dir, "mp3")
+    elif file_type == "mp4":
+        output_dir = os.path.join(output_dir, "mp4")
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except (OSError, PermissionError):
+        # Fallback to base output directory
+        print(f"\n⚠️  Could not create subfolder: {output_dir}")
+        print(f"    Falling back to: {base_output_dir}")
+        output_dir = base_output_dir
+    return output_dir
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+def get_format_selector(file_type, quality):
+    """Get the yt-dlp format selector for a download (MP3 extracts from the best audio)."""
+    if file_type == "mp3":
+        return "bestaudio/best"
+    resolution = VIDEO_QUALITY_MAP.get(quality, "720")
+    # IMPROVED FORMAT SELECTION with fallback for platforms with limited formats:
+    # 1. Prefer split video/audio streams at or below the requested resolution
+    # 2. Fall back to combined mp4 if needed
+    # 3. Use any available format only as a last resort
+    return (
+        f"bestvideo[height<={resolution}]+140/"
+        f"bestvideo[height<={resolution}]+bestaudio[ext=m4a]/"
+        f"bestvideo[height<={resolution}]+bestaudio"
+    )
+
+MP4_VIDEO_CODECS = ("avc1", "h264")
+MP4_AUDIO_CODECS = ("mp4a", "aac")
+
+def get_format_size(fmt, duration):
+    """Size of a format in bytes: reported, approximate or estimated from its bitrate."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    bitrate = fmt.get("tbr") or fmt.get("abr")
+    if not size and bitrate and duration:
+        size = bitrate * 1000 / 8 * duration
+    return size or 0
+
+def score_video_format(fmt, target_height, largest, duration):
+    """Higher is better: resolution up to the target first, then MP4-copyable codecs, then size."""
+    height = fmt.get("height") or 0
+    score = 100 * min(height, target_height) / target_height
+    codec = fmt.get("vcodec") or ""
+    # H.264 is merged into MP4 as is and never needs a conversion afterwards
+    if codec.startswith(MP4_VIDEO_CODECS):
+        score += 25
+    elif codec.startswith("av01"):
+        score -= 10
+    if largest:
+        score -= 15 * get_format_size(fmt, duration) / largest
+    if fmt.get("protocol") in ("http", "https"):
+        score += 2
+    return score
+
+def score_audio_format(fmt, file_type, bitrate, largest, duration):
+    """Higher is better: enough bitrate, AAC for MP4 (copied as is), then size.
+    MP3 re-encodes anyway, so only bitrate and size count there."""
+    abr = fmt.get("abr") or fmt.get("tbr") or 0
+    if file_type == "mp3":
+        score = 50 * min(abr, bitrate) / bitrate
     else:
-        print("❌ Unsupported format. No conversion performed.")
+        score = 20 * min(abr, 160) / 160
+        if (fmt.get("acodec") or "").startswith(MP4_AUDIO_CODECS):
+            score += 25
+    if largest:
+        score -= 15 * get_format_size(fmt, duration) / largest
+    return score
+
+def plan_formats(info, file_type, quality):
+    """Pick exact format IDs from a probed info dict for the target container.
+    Prefers streams that are copied straight into MP4 (H.264 + AAC), single-file formats
+    that need no merge, and smaller files at the same resolution. Returns a plan dict
+    ({"selector", "formats", "score", "duration", "alternatives"}) or None without usable formats."""
+    formats = [fmt for fmt in (info or {}).get("formats") or []
+               if fmt.get("format_id") and not fmt.get("has_drm") and fmt.get("protocol") != "mhtml"]
+    if not formats:
+        return None
+    duration = info.get("duration")
+    has_video = lambda fmt: fmt.get("vcodec") not in (None, "none")
+    has_audio = lambda fmt: fmt.get("acodec") not in (None, "none")
+    audio_only = [fmt for fmt in formats if has_audio(fmt) and not has_video(fmt)]
+    candidates = []
+
+    if file_type == "mp3":
+        # A passthrough keeps the stream as it is, so aim for the best one offered
+        audio_quality = "320" if is_audio_passthrough(file_type, quality) else quality
+        bitrate = int(AUDIO_QUALITY_MAP.get(audio_quality, "128k").rstrip("kK"))
+        pool = audio_only or [fmt for fmt in formats if has_audio(fmt)]
+        largest = max(get_format_size(fmt, duration) for fmt in pool) if pool else 0
+        for fmt in pool:
+            candidates.append((score_audio_format(fmt, file_type, bitrate, largest, duration), [fmt]))
+    else:
+        target_height = int(VIDEO_QUALITY_MAP.get(quality, "720"))
+        videos = [fmt for fmt in formats if has_video(fmt)]
+        fitting = [fmt for fmt in videos if (fmt.get("height") or 0) <= target_height]
+        if not fitting and videos:
+            # Nothing small enough, take the lowest resolution offered
+            lowest = min(fmt.get("height") or 0 for fmt in videos)
+            fitting = [fmt for fmt in videos if (fmt.get("height") or 0) == lowest]
+        largest_video = max((get_format_size(fmt, duration) for fmt in fitting), default=0)
+        largest_audio = max((get_format_size(fmt, duration) for fmt in audio_only), default=0)
+        audio_scores = [(score_audio_format(fmt, file_type, 0, largest_audio, duration), fmt) for fmt in audio_only]
+        best_audio = max(audio_scores, key=lambda item: item[0], default=None)
+        for fmt in fitting:
+            video_score = score_video_format(fmt, target_height, largest_video, duration)
+            if has_audio(fmt):
+                # Single file with both streams: no merge step
+                audio_score = score_audio_format(fmt, file_type, 0, 0, duration)
+                candidates.append((video_score + audio_score + 10, [fmt]))
+            elif best_audio:
+                candidates.append((video_score + best_audio[0], [fmt, best_audio[1]]))
+    if not candidates:
         return None
+    candidates.sort(key=lambda item: item[0], reverse=True)
+    score, chosen = candidates[0]
+    return {
+        "selector": "+".join(fmt["format_id"] for fmt in chosen),
+        "formats": chosen,
+        "score": score,
+        "duration": duration,
+        "alternatives": [("+".join(fmt["format_id"] for fmt in picked), alt_score) for alt_score, picked in candidates[1:4]],
+    }
+
+def describe_format_plan(plan):
+    """Explain the planner's choice for debug output."""
+    lines = [f"🐛 Debug mode: format plan {plan['selector']} (score {plan['score']:.1f})"]
+    for fmt in plan["formats"]:
+        size = get_format_size(fmt, plan["duration"])
+        parts = [fmt["format_id"], fmt.get("ext") or "?"]
+        if fmt.get("vcodec") not in (None, "none"):
+            parts.append(f"{fmt.get('height') or '?'}p {fmt.get('vcodec')}")
+        if fmt.get("acodec") not in (None, "none"):
+            parts.append(f"{fmt.get('acodec')} {fmt.get('abr') or '?'}k")
+        if size:
+            parts.append(format_bytes(size))
+        lines.append("   " + ", ".join(str(part) for part in parts))
+    if plan["alternatives"]:
+        lines.append("   next best: " + ", ".join(f"{selector} ({score:.1f})" for selector, score in plan["alternatives"]))
+    return "\n".join(lines)
+
+def get_planned_format_selector(video_url, file_type, quality):
+    """Exact format IDs from plan_formats() when the link's formats were probed (and cached),
+    with the generic selector as fallback; None when nothing was probed."""
+    _, info = lookup_cached_info(video_url)
+    if info is None or info.get("_type") == "playlist" or "entries" in info:
+        return None
+    plan = plan_formats(info, file_type, quality)
+    if plan is None:
+        return None
+    if DEBUG_MODE:
+        print(describe_format_plan(plan), flush=True)
+    return f"{plan['selector']}/{get_format_selector(file_type, quality)}"
+
+def get_host_key(url):
+    """Group links by site for per-host settings (www./m. prefixes and short links folded in)."""
+    host = (urlsplit(url).hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return {"youtu.be": "youtube.com", "fb.watch": "facebook.com", "twitter.com": "x.com"}.get(host, host) or "local"
+
+class FragmentTuner:
+    """Adaptive --concurrent-fragments per host. Each fragmented (DASH/HLS) download reports
+    its throughput; the setting doubles while that pays off, halves after throttling
+    (retries, HTTP 429) and settles on the fewest connections within 10% of the best rate.
+    Learned settings are kept in fragments.json in the cache folder."""
+
+    DEFAULT = 4
+    EXPLORE_EVERY = 8  # re-check a higher setting every N runs, links change
+
+    def __init__(self, minimum=1, maximum=16, fixed=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.fixed = fixed
+        self.lock = threading.Lock()
+        self.state = None
+
+    def path(self):
+        return os.path.join(get_cache_dir(), "fragments.json")
+
+    def load(self):
+        if self.state is None:
+            try:
+                with open(self.path(), encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {}
+        return self.state
+
+    def save(self):
+        try:
+            write_file_atomic(self.path(), json.dumps(self.state))
+        except OSError:
+            pass
+
+    def clamp(self, fragments):
+        return max(self.minimum, min(self.maximum, fragments))
+
+    def choose(self, url):
+        """Fragment concurrency for the next download from this URL's host."""
+        if self.fixed:
+            return self.fixed
+        with self.lock:
+            host = self.load().get(get_host_key(url))
+            if not host:
+                return self.clamp(self.DEFAULT)
+            best = self.clamp(host["best"])
+            higher = self.clamp(best * 2)
+            throttled_at = host.get("throttled", {}).get(str(higher), 0)
+            if higher != best and time.time() - throttled_at > 24 * 60 * 60:
+                if str(higher) not in host["rates"] or host["runs"] % self.EXPLORE_EVERY == 0:
+                    return higher
+            return best
+
+    def record(self, url, fragments, rate, throttled):
+        """Feed back one download's throughput (bytes/s) at the given setting."""
+        key = get_host_key(url)
+        with self.lock:
+            host = self.load().setdefault(key, {"best": self.DEFAULT, "rates": {}, "throttled": {}, "runs": 0})
+            host["runs"] += 1
+            rates = host["rates"]
+            if throttled:
+                host["throttled"][str(fragments)] = time.time()
+                rates[str(fragments)] = rates.get(str(fragments), rate) * 0.5
+                if fragments <= host["best"]:
+                    host["best"] = self.clamp(fragments // 2)
+            else:
+                previous = rates.get(str(fragments))
+                rates[str(fragments)] = rate if previous is None else (previous + rate) / 2
+                top = max(rates.values())
+                host["best"] = min(int(n) for n, n_rate in rates.items() if n_rate >= 0.9 * top)
+            self.save()
+            best = host["best"]
+        if DEBUG_MODE:
+            print(f"🐛 Debug mode: {key} {fragments} fragments -> {format_bytes(rate)}/s"
+                  f"{' (throttled)' if throttled else ''}, best setting now {best}", flush=True)
+
+    def meter(self, url, fragments):
+        return FragmentMeter(self, url, fragments)
+
+class FragmentMeter:
+    """Progress hook measuring one download's throughput for FragmentTuner."""
+
+    def __init__(self, tuner, url, fragments):
+        self.tuner = tuner
+        self.url = url
+        self.fragments = fragments
+        self.fragmented = False
+        self.started = None
+        self.last = None
+        self.bytes = {}
+
+    def __call__(self, event):
+        if event["event"] != "download":
+            return
+        if event.get("fragment_count"):
+            self.fragmented = True
+        self.started = self.started or event["time"]
+        self.last = event["time"]
+        name = event.get("filename") or event.get("id")
+        self.bytes[name] = max(self.bytes.get(name, 0), event.get("downloaded_bytes") or 0)
+
+    def finish(self, outcome):
+        """Report the run; only fragmented downloads long enough to measure count."""
+        total = sum(self.bytes.values())
+        elapsed = (self.last or 0) - (self.started or 0)
+        throttled = bool(outcome.get("retries"))
+        if not self.fragmented or (outcome["returncode"] != 0 and not throttled):
+            return
+        if throttled or (total >= 1024 * 1024 and elapsed >= 1):
+            self.tuner.record(self.url, self.fragments, total / max(elapsed, 0.001), throttled)
+
+FRAGMENT_TUNER = FragmentTuner(
+    minimum=int(get_env_number("QUICKTUBE_FRAGMENTS_MIN", 1)),
+    maximum=int(get_env_number("QUICKTUBE_FRAGMENTS_MAX", 16)),
+    fixed=int(get_env_number("QUICKTUBE_FRAGMENTS", 0)) or None,
+)
+
+def parse_rate(text):
+    """Parse a rate like 500K, 2.5M or 1G (bytes per second, as yt-dlp's --limit-rate) into bytes/s."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*", str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid rate {text!r} (use e.g. 500K, 2M)")
+    return float(match.group(1)) * 1024 ** " kmg".index(match.group(2).lower() or " ")
+
+class BandwidthManager:
+    """Global token-bucket budget for download bandwidth. The total rate is split among the
+    downloads that are transferring right now, by priority (equal priorities = fair share),
+    and recomputed on every progress update, so shares rebalance as jobs start and finish."""
+
+    ACTIVE_WINDOW = 2.0  # seconds without progress before a job stops counting for the split
+    BURST = 0.5  # seconds of its rate a job may save up
+
+    def __init__(self, total=None):
+        self.total = total
+        self.slots = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def register(self, job, priority=1.0):
+        """Give a download its slot for the duration of the block; the slot is its progress hook."""
+        slot = BandwidthSlot(self, job, max(0.01, priority))
+        with self.lock:
+            self.slots.append(slot)
+        try:
+            yield slot
+        finally:
+            with self.lock:
+                self.slots.remove(slot)
+
+    def share(self, slot, now=None):
+        """Current rate of a slot: its priority's part of the total among active slots."""
+        now = now or time.monotonic()
+        active = [other for other in self.slots if other is slot or now - other.last_active < self.ACTIVE_WINDOW]
+        return self.total * slot.priority / sum(other.priority for other in active)
+
+    def consume(self, slot, amount):
+        """Take amount bytes from the slot's bucket; returns how long the job should pause."""
+        with self.lock:
+            now = time.monotonic()
+            slot.last_active = now
+            rate = self.share(slot, now)
+            slot.tokens = min(rate * self.BURST, slot.tokens + rate * (now - slot.updated))
+            slot.updated = now
+            slot.tokens -= amount
+            return -slot.tokens / rate if slot.tokens < 0 else 0.0
+
+class BandwidthSlot:
+    """One download's place in the bandwidth budget, used as its progress hook. The in-process
+    engine calls hooks on the download thread, so sleeping there throttles it; a yt-dlp or
+    streaming ffmpeg process (see attach_process) is paused with SIGSTOP/SIGCONT instead."""
+
+    def __init__(self, manager, job, priority):
+        self.manager = manager
+        self.job = job
+        self.priority = priority
+        self.tokens = 0.0
+        self.updated = self.last_active = time.monotonic()
+        self.seen = {}
+        self.process = None
+        self.resume_timer = None
+        # Guards process and resume_timer between the reading thread and the resume timer
+        self.process_lock = threading.Lock()
+
+    def attach_process(self, process):
+        self.process = process
+
+    def detach_process(self):
+        """Let go of the process before it is reaped: a pending SIGCONT could otherwise reach
+        another process that got its PID. A paused process is resumed right away."""
+        with self.process_lock:
+            timer, self.resume_timer = self.resume_timer, None
+            if timer is not None:
+                timer.cancel()
+                self.resume(self.process)
+            self.process = None
+
+    def __call__(self, event):
+        if not self.manager.total:
+            return
+        if event["event"] == "download":
+            name = event.get("filename") or event.get("id")
+            done = event.get("downloaded_bytes") or 0
+        elif event["event"] == "convert":
+            # A streaming ffmpeg reads from the network itself; what it has written out so far
+            # stands in for what it has read
+            name = "ffmpeg"
+            done = event.get("total_size") or 0
+        else:
+            return
+        amount = max(0, done - self.seen.get(name, 0))
+        self.seen[name] = done
+        # Short pauses keep connections alive and the job counted as active
+        pause = min(self.manager.consume(self, amount), 1.0)
+        if pause <= 0:
+            return
+        if self.process is None:
+            time.sleep(pause)
+            return
+        with self.process_lock:
+            if self.process is None or self.resume_timer is not None or not can_pause_processes():
+                return
+            try:
+                os.kill(self.process.pid, signal.SIGSTOP)
+            except OSError:
+                return
+            self.schedule_resume(self.process, pause)
+
+    def schedule_resume(self, process, pause):
+        self.resume_timer = threading.Timer(pause, self.wake, [process])
+        self.resume_timer.daemon = True
+        self.resume_timer.start()
+
+    def wake(self, process):
+        """Resume a paused process once its share has caught up with what it read. Processes
+        report progress only now and then (ffmpeg every half second), so a single pause may
+        not cover it; check again every second until it does."""
+        with self.process_lock:
+            if self.process is not process:
+                # Detached meanwhile, and resumed by detach_process()
+                return
+            pause = min(self.manager.consume(self, 0), 1.0)
+            if pause > 0:
+                self.schedule_resume(process, pause)
+                return
+            self.resume_timer = None
+            self.resume(process)
+
+    def resume(self, process):
+        try:
+            os.kill(process.pid, signal.SIGCONT)
+        except OSError:
+            pass
+
+    def start_rate(self):
+        """Fixed --limit-rate for yt-dlp processes that can't be paused (Windows): the share at start."""
+        if not self.manager.total or can_pause_processes():
+            return None
+        with self.manager.lock:
+            return int(self.manager.share(self))
+
+def can_pause_processes():
+    return hasattr(signal, "SIGSTOP") and hasattr(signal, "SIGCONT")
+
+def detach_process_hooks(progress_hooks):
+    """Tell hooks that control a process (see BandwidthSlot) that it is about to be reaped."""
+    for hook in progress_hooks:
+        if hasattr(hook, "detach_process"):
+            hook.detach_process()
+
+def get_rate_limit_setting():
+    """Total download rate from QUICKTUBE_RATE_LIMIT (e.g. 5M), or None for unlimited."""
+    value = os.getenv("QUICKTUBE_RATE_LIMIT", "").strip()
+    if not value:
+        return None
+    try:
+        return parse_rate(value) or None
+    except ValueError as e:
+        print(f"⚠️  Ignoring QUICKTUBE_RATE_LIMIT: {e}")
+        return None
+
+BANDWIDTH = BandwidthManager(get_rate_limit_setting())
+
+FILE_RECORD_FIELDS = ("id", "title", "extractor_key", "webpage_url", "playlist_id", "playlist_index", "filepath")
+
+def build_ytdlp_command(video_url, file_type, quality, is_playlist, output_dir, show_progress=True, info_json=None, print_file=None, archive_file=None, format_selector=None, fragments=4, limit_rate=None):
+    """Build the yt-dlp command line for a download job.
+    With info_json, yt-dlp reuses that extracted info instead of extracting the URL again.
+    With print_file, yt-dlp appends one JSON file record per finished item to that file.
+    With archive_file, items listed in that yt-dlp download archive are skipped.
+    format_selector overrides the generic selector (e.g. exact IDs from plan_formats()) and
+    fragments sets how many DASH/HLS fragments are fetched at once and limit_rate caps the
+    download speed in bytes/s."""
+    # Filename template uses YouTube video title and extension
+    filename = os.path.join(output_dir, "%(title)s.%(ext)s")
+
+    # Get yt-dlp path (bundled or system)
+    ytdlp_cmd = get_ytdlp_path()
+
+    # Enhanced command with:
+    # - Cleaner progress bar (single line updates)
+    # - Anti-blocking measures
+    # - Reduced CPU usage for merging
+    # - Concurrent downloads for faster speeds
+    command = [
+        ytdlp_cmd, "-o", filename,
+        "--no-warnings",
+        "--no-check-certificate",
+        # Concurrent fragment downloads (faster for DASH/HLS streams, tuned by FragmentTuner)
+        "--concurrent-fragments", str(fragments),
+        # Progress as one machine-readable line per update, rendered by ProgressDisplay
+        "--progress", "--newline",
+    ]
+    for template in get_progress_template():
+        command += ["--progress-template", template]
+    if show_progress:
+        command.append("--console-title")
+    command += [
+        # Add user agent to avoid blocking
+        "--user-agent", USER_AGENT,
+        # Retry on failures
+        "--retries", "3",
+        "--fragment-retries", "3",
+        # Pick up .part files left by an interrupted run instead of starting over
+        "--continue",
+    ]
+
+    if is_audio_passthrough(file_type, quality):
+        # "best" copies the audio stream out (AAC to .m4a, Opus to .opus) without re-encoding
+        command += ["-x", "--audio-format", "best"]
+        if format_selector:
+            command += ["-f", format_selector]
+    elif file_type == "mp3":
+        bitrate = AUDIO_QUALITY_MAP.get(quality, "128K")
+        command += ["-x", "--audio-format", "mp3", "--audio-quality", bitrate]
+        if format_selector:
+            command += ["-f", format_selector]
+    elif file_type == "mp4":
+        command += ["-f", format_selector or get_format_selector(file_type, quality), "--merge-output-format", "mp4"]
+
+    if not is_playlist:
+        command.append("--no-playlist")
+
+    if limit_rate:
+        command += ["--limit-rate", str(int(limit_rate))]
+
+    if archive_file:
+        command += ["--download-archive", archive_file]
+        if YTDLP_BREAK_ON_EXISTING:
+            command.append("--break-on-existing")
+
+    if print_file:
+        # Record the final path (after merging/extraction and moving) of every item as JSON.
+        # --print-to-file keeps stdout untouched so the progress bar still shows.
+        template = "after_move:%(.{" + ",".join(FILE_RECORD_FIELDS) + "})j"
+        command += ["--print-to-file", template, print_file.replace("%", "%%")]
+
+    if info_json:
+        command += ["--load-info-json", info_json]
+    else:
+        command.append(video_url)
+    return command
+
+def build_ytdl_params(file_type, quality, is_playlist, output_dir, show_progress=True, archive_file=None):
+    """Build YoutubeDL options equivalent to build_ytdlp_command() for the in-process engine."""
+    params = {
+        "outtmpl": os.path.join(output_dir, "%(title)s.%(ext)s"),
+        "no_warnings": True,
+        "nocheckcertificate": True,
+        "concurrent_fragment_downloads": 4,
+        "quiet": not show_progress,
+        # Progress comes from the hooks and is rendered by ProgressDisplay
+        "noprogress": True,
+        "consoletitle": show_progress,
+        "http_headers": {"User-Agent": USER_AGENT},
+        "retries": 3,
+        "fragment_retries": 3,
+        "continuedl": True,
+        "noplaylist": not is_playlist,
+        # Match the CLI default: skip broken playlist entries but report failure at the end
+        "ignoreerrors": "only_download",
+    }
+    if archive_file:
+        params["download_archive"] = archive_file
+        params["break_on_existing"] = YTDLP_BREAK_ON_EXISTING
+    ffmpeg_cmd = get_ffmpeg_path()
+    if os.path.isabs(ffmpeg_cmd):
+        params["ffmpeg_location"] = ffmpeg_cmd
+
+    if is_audio_passthrough(file_type, quality):
+        params["format"] = get_format_selector(file_type, quality)
+        params["postprocessors"] = [{"key": "FFmpegExtractAudio", "preferredcodec": "best"}]
+    elif file_type == "mp3":
+        bitrate = AUDIO_QUALITY_MAP.get(quality, "128K")
+        params["format"] = get_format_selector(file_type, quality)
+        params["postprocessors"] = [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "mp3",
+            "preferredquality": bitrate.rstrip("kK"),
+        }]
+    elif file_type == "mp4":
+        params["format"] = get_format_selector(file_type, quality)
+        params["merge_output_format"] = "mp4"
+    return params
+
+YTDLP_MODULE = None
+YTDLP_ENGINE = os.getenv("QUICKTUBE_ENGINE", "auto").strip().lower() or "auto"
+YTDLP_INSTANCES = threading.local()
+
+def load_ytdlp_module():
+    """Import the yt_dlp package if it is available, otherwise return None.
+    Imported by name so PyInstaller doesn't pull it into builds that bundle the binary."""
+    global YTDLP_MODULE
+    if YTDLP_MODULE is None:
+        try:
+            YTDLP_MODULE = importlib.import_module("yt_dlp")
+        except Exception:
+            YTDLP_MODULE = False
+    return YTDLP_MODULE or None
+
+def get_ytdlp_engine():
+    """Pick the yt-dlp engine: 'module' (in-process) or 'binary' (subprocess).
+    QUICKTUBE_ENGINE=auto|module|binary; module falls back to binary when yt_dlp isn't importable."""
+    if YTDLP_ENGINE == "binary":
+        return "binary"
+    if load_ytdlp_module() is not None:
+        return "module"
+    if YTDLP_ENGINE == "module" and DEBUG_MODE:
+        print("🐛 Debug mode: yt_dlp module not importable, using the yt-dlp binary")
+    return "binary"
+
+def get_warm_ytdl(key, params):
+    """Get this thread's YoutubeDL instance for a set of options, creating it on first use.
+    Returns (ydl, state); state["hooks"] holds the progress callbacks of the running job
+    (called with progress events), state["files"] collects its file records and
+    state["retries"] counts its retries and throttling errors."""
+    instances = getattr(YTDLP_INSTANCES, "instances", None)
+    if instances is None:
+        instances = YTDLP_INSTANCES.instances = {}
+    if key not in instances:
+        yt_dlp = load_ytdlp_module()
+        state = {"hooks": [], "files": None, "job": None, "retries": 0}
+        show_output = not params.get("quiet")
+
+        # Fragment downloads may call these from worker threads, so route via the instance state
+        def dispatch_progress(status):
+            event = make_download_event(status, state["job"], (status.get("info_dict") or {}).get("id"))
+            for hook in list(state["hooks"]):
+                hook(event)
+
+        def dispatch_postprocess(status):
+            event = make_postprocess_event(status, state["job"], (status.get("info_dict") or {}).get("id"))
+            for hook in list(state["hooks"]):
+                hook(event)
+
+        class FileRecorder(yt_dlp.postprocessor.PostProcessor):
+            """Collect the final path of every item once it has been moved into place."""
+            def run(self, info):
+                if state.get("files") is not None:
+                    state["files"].append(make_file_record(info))
+                return [], info
+
+        class OutputLogger:
+            """yt-dlp's screen and error output. Retries are counted like is_ytdlp_retry() does
+            for the binary's output (yt-dlp reports them as screen messages, which quiet drops,
+            so output is filtered here instead)."""
+            def debug(self, message):
+                if is_ytdlp_retry(message):
+                    state["retries"] += 1
+                    METRICS.count("retries")
+                if show_output and not message.startswith("[debug] "):
+                    PROGRESS_DISPLAY.print_line(message)
+
+            info = warning = debug
+
+            def error(self, message):
+                if is_ytdlp_retry(message):
+                    state["retries"] += 1
+                    METRICS.count("retries")
+                print(message, file=sys.stderr, flush=True)
+
+        params = dict(params, quiet=False, logger=OutputLogger(),
+                      progress_hooks=[dispatch_progress], postprocessor_hooks=[dispatch_postprocess])
+        ydl = yt_dlp.YoutubeDL(params)
+        ydl.add_post_processor(FileRecorder(), when="after_move")
+        instances[key] = (ydl, state)
+    return instances[key]
+
+def make_file_record(info):
+    """Pick the reported fields of a finished item out of a yt-dlp info dict."""
+    return {field: info.get(field) for field in FILE_RECORD_FIELDS}
+
+def parse_file_records(text):
+    """Parse the JSON lines written by --print-to-file into file records."""
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Plain path (e.g. an older yt-dlp without dict templates)
+            record = {"filepath": line}
+        if isinstance(record, dict) and record.get("filepath"):
+            records.append(record)
+    return records
+
+def run_ytdlp_in_process(video_url, file_type, quality, is_playlist, output_dir, show_progress=True, info_json=None, progress_hooks=(), job=None, archive_file=None, format_selector=None, fragments=None):
+    """Run a download on a warm in-process YoutubeDL instance. Returns {"returncode", "error", "retries", "files"}."""
+    params = build_ytdl_params(file_type, quality, is_playlist, output_dir, show_progress, archive_file)
+    key = (file_type, quality, is_playlist, output_dir, show_progress, archive_file)
+    return run_warm_download(key, params, video_url, info_json, progress_hooks, job, format_selector, fragments)
+
+def run_warm_download(key, params, video_url, info_json=None, progress_hooks=(), job=None, format_selector=None, fragments=None):
+    """Download video_url (or info_json) on the warm instance for key/params.
+    format_selector and fragments replace the instance's format selection and fragment
+    concurrency for this download only."""
+    yt_dlp = load_ytdlp_module()
+    ydl, state = get_warm_ytdl(key, params)
+    if fragments:
+        # Downloaders read it from the params when they start
+        ydl.params["concurrent_fragment_downloads"] = fragments
+    default_selector = ydl.format_selector
+    if format_selector:
+        # Swapped per download so the warm instance doesn't have to be rebuilt for every plan
+        ydl.format_selector = ydl.build_format_selector(format_selector)
+    state["hooks"] = list(progress_hooks)
+    state["job"] = job
+    state["files"] = files = []
+    state["retries"] = 0
+    # download() returns a sticky error code, reset it since the instance is reused across jobs
+    ydl._download_retcode = 0
+    try:
+        if info_json:
+            returncode = ydl.download_with_info_file(info_json)
+        else:
+            returncode = ydl.download([video_url])
+        return {"returncode": returncode, "error": None if returncode == 0 else "yt-dlp reported errors",
+                "retries": state["retries"], "files": files}
+    except yt_dlp.utils.DownloadError as e:
+        return {"returncode": 1, "error": str(e).strip(), "retries": state["retries"], "files": files}
+    finally:
+        state["hooks"] = []
+        state["files"] = None
+        ydl.format_selector = default_selector
+
+def run_ytdlp_process(command, show_progress=True, progress_hooks=(), job=None):
+    """Run the yt-dlp binary, turning its progress lines into events for progress_hooks.
+    Other output is shown when show_progress is set. Returns {"returncode", "error", "retries"}."""
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    for hook in progress_hooks:
+        # Hooks that control the process (e.g. BandwidthSlot pausing it) get a handle
+        if hasattr(hook, "attach_process"):
+            hook.attach_process(process)
+    tail = collections.deque(maxlen=20)
+    retries = 0
+    try:
+        for line in process.stdout:
+            event = parse_ytdlp_progress_line(line, job)
+            if event is not None:
+                for hook in progress_hooks:
+                    hook(event)
+                continue
+            line = line.rstrip()
+            if not line:
+                continue
+            tail.append(line)
+            if is_ytdlp_retry(line):
+                retries += 1
+                METRICS.count("retries")
+            if show_progress:
+                PROGRESS_DISPLAY.print_line(line)
+    finally:
+        detach_process_hooks(progress_hooks)
+    returncode = process.wait()
+    return {"returncode": returncode, "error": get_ytdlp_error(returncode, tail), "retries": retries}
+
+def is_ytdlp_retry(line):
+    """Whether a yt-dlp output line reports a retry or throttling (counted for FragmentTuner)."""
+    return "Retrying" in line or "HTTP Error 429" in line
+
+def get_ytdlp_error(returncode, tail):
+    """Error message for a yt-dlp run from the last lines of its output, or None if it succeeded."""
+    if returncode == 0:
+        return None
+    # Keep the last error line from yt-dlp for the summary
+    errors = [line for line in tail if line.startswith("ERROR")]
+    return (errors or list(tail) or [f"yt-dlp exited with code {returncode}"])[-1]
+
+def run_ytdlp_binary(video_url, file_type, quality, is_playlist, output_dir, show_progress=True, info_json=None, progress_hooks=(), job=None, archive_file=None, format_selector=None, fragments=4, limit_rate=None):
+    """Run a download with the yt-dlp binary. Returns {"returncode", "error", "files"}."""
+    fd, print_file = tempfile.mkstemp(prefix="quicktube-", suffix=".jsonl")
+    os.close(fd)
+    try:
+        command = build_ytdlp_command(video_url, file_type, quality, is_playlist, output_dir, show_progress, info_json, print_file, archive_file, format_selector, fragments, limit_rate)
+        if DEBUG_MODE:
+            print("\n🐛 Debug mode: yt-dlp command")
+            print(format_command(command), flush=True)
+        outcome = run_ytdlp_process(command, show_progress, progress_hooks, job)
+        with open(print_file, encoding="utf-8", errors="replace") as f:
+            outcome["files"] = parse_file_records(f.read())
+        return outcome
+    finally:
+        try:
+            os.remove(print_file)
+        except OSError:
+            pass
+
+def run_ytdlp_download(video_url, file_type, quality, is_playlist, output_dir, show_progress=True, progress_hooks=(), job=None, priority=1.0, defer_encode=False):
+    """Download with the selected engine, reusing the cached info JSON from the probe when possible.
+    Progress events go to emit_progress() and to any extra progress_hooks.
+    Returns {"returncode", "error", "engine", "files"}; files holds one record
+    (id, title, filepath, ...) per finished item, in download order.
+    Items found in the download archive are skipped and new ones are added to it.
+    With a bandwidth budget set, the job gets its priority's share of it.
+    With defer_encode, an MP3 download keeps the source audio and sets outcome["encode"];
+    the caller encodes (and archives) it with encode_audio_records(), off the download slot."""
+    job = job or video_url
+    archived = find_archived_file(video_url, file_type, quality, is_playlist)
+    if archived:
+        if show_progress:
+            print(f"✅ Already downloaded: {os.path.basename(archived)}")
+        METRICS.count("archive_hits")
+        return {"returncode": 0, "error": None, "engine": "archive", "skipped": True,
+                "files": [{"id": None, "title": None, "filepath": archived}]}
+    with BANDWIDTH.register(job, priority) as bandwidth_slot:
+        progress_hooks = list(progress_hooks) + [bandwidth_slot]
+        return download_with_engine(video_url, file_type, quality, is_playlist, output_dir, show_progress,
+                                    progress_hooks, job, bandwidth_slot.start_rate(),
+                                    defer_encode and file_type == "mp3" and not is_audio_passthrough(file_type, quality))
+
+def download_with_engine(video_url, file_type, quality, is_playlist, output_dir, show_progress, progress_hooks, job, limit_rate=None, defer_encode=False):
+    """Body of run_ytdlp_download(): stream cache or yt-dlp, with retries and archiving."""
+    progress_hooks = [emit_progress, METRICS.on_progress] + list(progress_hooks)
+    if not is_playlist and METADATA_CACHE_ENABLED:
+        # Batch and sync jobs aren't probed up front: extract the link once here, so the format
+        # planner has its formats and the download (or stream cache) loads the same info. Without
+        # the cache the probe's info can't be passed on, so the planner is skipped instead.
+        check_if_playlist(video_url)
+    if STREAM_CACHE_ENABLED and not is_playlist:
+        # The raw streams are local already, so the MP3 is encoded straight from them
+        outcome = download_via_stream_cache(video_url, file_type, quality, output_dir, show_progress, progress_hooks, job)
+        if show_progress:
+            PROGRESS_DISPLAY.clear()
+        if outcome is not None:
+            outcome["engine"] = "stream-cache"
+            if outcome["returncode"] == 0:
+                archive_download(video_url, file_type, quality, is_playlist, outcome["files"])
+            return outcome
+    # A deferred MP3 downloads the source audio as-is; the archive still tracks the MP3 quality
+    download_quality = AUDIO_PASSTHROUGH if defer_encode else quality
+    engine = get_ytdlp_engine()
+    archive = get_download_archive()
+    archive_file = archive.ytdlp_archive_file(file_type, quality) if archive else None
+    fragments = FRAGMENT_TUNER.choose(video_url)
+    meter = FRAGMENT_TUNER.meter(video_url, fragments)
+    progress_hooks.append(meter)
+    # Reuse the info JSON from the playlist probe so the page is only extracted once
+    info_json = get_cached_info_for_download(video_url, is_playlist)
+    # Plan for the requested bitrate even when the encode is deferred, so the smallest source
+    # that covers it is fetched rather than the best one
+    format_selector = None if is_playlist else get_planned_format_selector(video_url, file_type, quality)
+    # yt-dlp mostly waits on the network; it takes a thread from the budget (for merging and
+    # audio extraction) when one is free but never waits for one
+    with CPU_BUDGET.reserve(1, minimum=0):
+        for attempt_info_json in ([info_json, None] if info_json else [None]):
+            with METRICS.span(job, "download", engine=engine, cached_info=bool(attempt_info_json)) as span:
+                if engine == "module":
+                    if DEBUG_MODE:
+                        print(f"🐛 Debug mode: in-process yt-dlp for {attempt_info_json or video_url}", flush=True)
+                    outcome = run_ytdlp_in_process(video_url, file_type, download_quality, is_playlist, output_dir, show_progress, attempt_info_json, progress_hooks, job, archive_file, format_selector, fragments)
+                else:
+                    outcome = run_ytdlp_binary(video_url, file_type, download_quality, is_playlist, output_dir, show_progress, attempt_info_json, progress_hooks, job, archive_file, format_selector, fragments, limit_rate)
+                span["exit_code"] = outcome["returncode"]
+            if show_progress:
+                PROGRESS_DISPLAY.clear()
+            if outcome["returncode"] == 0 or not attempt_info_json:
+                break
+            # Cached stream URLs may have expired - extract again from the page
+            if show_progress:
+                print("\n⚠️  Cached video info is stale, retrying with a fresh lookup...")
+            invalidate_cached_info(video_url)
+            METRICS.count("retries")
+    outcome["engine"] = engine
+    meter.finish(outcome)
+    outcome["encode"] = defer_encode and outcome["returncode"] == 0
+    if outcome["returncode"] == 0 and not defer_encode:
+        archive_download(video_url, file_type, quality, is_playlist, outcome["files"])
+    return outcome
+
+class DownloadArchive:
+    """SQLite index of downloaded items (video ID, type, quality, path, size, checksum) and of
+    synced playlists. Lookups are primary-key queries, so checking an item is O(1)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.exports = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+                extractor TEXT NOT NULL, video_id TEXT NOT NULL, file_type TEXT NOT NULL, quality TEXT NOT NULL,
+                path TEXT NOT NULL, size INTEGER, checksum TEXT, title TEXT, playlist_id TEXT, downloaded_at REAL,
+                PRIMARY KEY (extractor, video_id, file_type, quality))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS playlists (
+                url TEXT NOT NULL, file_type TEXT NOT NULL, quality TEXT NOT NULL, playlist_id TEXT, title TEXT,
+                last_synced REAL, PRIMARY KEY (url, file_type, quality))""")
+
+    def lookup(self, extractor, video_id, file_type, quality):
+        """Return the archived path of an item if it is still on disk, else None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT path FROM items WHERE extractor = ? AND video_id = ? AND file_type = ? AND quality = ?",
+                (extractor.lower(), video_id, file_type, quality)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+        return None
+
+    def add(self, record, file_type, quality):
+        """Archive a finished item (a file record from yt-dlp) with its size and SHA-256."""
+        path = record.get("filepath")
+        if not path or not record.get("id") or not record.get("extractor_key"):
+            return
+        try:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        extractor = record["extractor_key"].lower()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                extractor, record["id"], file_type, quality, path, size, digest.hexdigest(),
+                record.get("title"), record.get("playlist_id"), time.time()))
+            export = self.exports.get((file_type, quality))
+        if export:
+            with open(export, "a", encoding="utf-8") as f:
+                f.write(f"{extractor} {record['id']}\n")
+
+    def ytdlp_archive_file(self, file_type, quality):
+        """Get a yt-dlp --download-archive file listing the items that are still on disk,
+        so yt-dlp skips them (e.g. playlist entries) before extracting them.
+        Written once per run and appended to as items are added."""
+        key = (file_type, quality)
+        with self.lock:
+            if key in self.exports:
+                return self.exports[key]
+            rows = self.db.execute("SELECT extractor, video_id, path FROM items WHERE file_type = ? AND quality = ?",
+                                   key).fetchall()
+            fd, path = tempfile.mkstemp(prefix="quicktube-archive-", suffix=".txt")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for extractor, video_id, item_path in rows:
+                    if os.path.exists(item_path):
+                        f.write(f"{extractor} {video_id}\n")
+            self.exports[key] = path
+            return path
+
+    def add_playlist(self, url, file_type, quality, playlist_id=None, title=None):
+        """Remember a downloaded playlist so 'sync' can fetch its new entries later."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?, ?)",
+                            (url, file_type, quality, playlist_id, title, time.time()))
+
+    def touch_playlist(self, url, file_type, quality):
+        with self.lock, self.db:
+            self.db.execute("UPDATE playlists SET last_synced = ? WHERE url = ? AND file_type = ? AND quality = ?",
+                            (time.time(), url, file_type, quality))
+
+    def playlists(self):
+        """Return (url, file_type, quality) for every remembered playlist."""
+        with self.lock:
+            return self.db.execute("SELECT url, file_type, quality FROM playlists ORDER BY last_synced").fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+            for path in self.exports.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.exports = {}
+
+ARCHIVE = None
+ARCHIVE_SETTING = os.getenv("QUICKTUBE_ARCHIVE", "").strip()
+YTDLP_BREAK_ON_EXISTING = False
+
+def get_download_archive():
+    """Open the download archive (QUICKTUBE_ARCHIVE=path, or 'off'; default output/.quicktube-archive.sqlite3)."""
+    global ARCHIVE
+    if ARCHIVE is None and ARCHIVE_SETTING.lower() not in ("off", "0", "false", "no"):
+        path = ARCHIVE_SETTING or os.path.join(get_base_output_dir(), ".quicktube-archive.sqlite3")
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            ARCHIVE = DownloadArchive(path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️  Download archive unavailable ({e}), nothing will be skipped.")
+            ARCHIVE = False
+    return ARCHIVE or None
+
+def get_archive_key(url):
+    """Get (extractor, video_id) for a single-video URL without network access, or None.
+    Works for YouTube links and for anything with cached info JSON."""
+    key = normalize_url(url)
+    if key.startswith("youtube:v="):
+        return "youtube", key[len("youtube:v="):]
+    _, info = lookup_cached_info(url)
+    if info and info.get("id") and info.get("extractor_key") and info.get("_type", "video") == "video":
+        return info["extractor_key"].lower(), info["id"]
+    return None
+
+def find_archived_file(url, file_type, quality, is_playlist):
+    """Return the path of an already downloaded copy of a single video, if any."""
+    archive = get_download_archive()
+    if archive is None or is_playlist:
+        return None
+    key = get_archive_key(url)
+    if key is None:
+        return None
+    return archive.lookup(key[0], key[1], file_type, quality)
+
+def archive_download(url, file_type, quality, is_playlist, records):
+    """Add the files of a finished download (and its playlist, for sync) to the archive."""
+    archive = get_download_archive()
+    if archive is None:
+        return
+    for record in records:
+        archive.add(record, file_type, quality)
+    if is_playlist:
+        playlist_id = next((record.get("playlist_id") for record in records if record.get("playlist_id")), None)
+        if playlist_id:
+            archive.add_playlist(url, file_type, quality, playlist_id)
+        else:
+            # Nothing new (or not a playlist after all), only refresh a known playlist
+            archive.touch_playlist(url, file_type, quality)
+
+class JobJournal:
+    """SQLite journal of headless jobs and the stage each one reached
+    (queued, downloading, merging, converting, done or failed), so 'resume' can pick up
+    whatever a crashed or preempted run left unfinished."""
+
+    KEEP_DONE = 7 * 24 * 60 * 60  # finished jobs are forgotten after a week
+    UNFINISHED = ("queued", "downloading", "merging", "converting")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                url TEXT NOT NULL, file_type TEXT NOT NULL, quality TEXT NOT NULL, convert TEXT NOT NULL,
+                is_playlist INTEGER, conversion TEXT, stream INTEGER, priority REAL,
+                state TEXT NOT NULL, files TEXT, error TEXT, updated_at REAL,
+                PRIMARY KEY (url, file_type, quality, convert))""")
+            self.db.execute("DELETE FROM jobs WHERE state = 'done' AND updated_at < ?", (time.time() - self.KEEP_DONE,))
+
+    @staticmethod
+    def key(job):
+        return job["url"], job["file_type"], job["quality"], job["convert"] or ""
+
+    def record(self, job, state, files=None, error=None):
+        """Move a job to state. files (the downloaded or converted paths) are kept until replaced."""
+        with self.lock, self.db:
+            self.db.execute("""INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url, file_type, quality, convert) DO UPDATE SET
+                state = excluded.state, files = COALESCE(excluded.files, files), error = excluded.error,
+                updated_at = excluded.updated_at""", self.key(job) + (
+                int(job["is_playlist"]), job["conversion"], int(job["stream"]), job["priority"], state,
+                None if files is None else json.dumps(files), error, time.time()))
+
+    def state(self, job):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM jobs WHERE url = ? AND file_type = ? AND quality = ? AND convert = ?",
+                                  self.key(job)).fetchone()
+        return row[0] if row else None
+
+    def unfinished(self, failed=False):
+        """Return the jobs that didn't finish (and failed ones, with failed), oldest first.
+        A job that got as far as converting carries its downloaded "files"."""
+        states = self.UNFINISHED + (("failed",) if failed else ())
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT url, file_type, quality, convert, is_playlist, conversion, stream, priority, state, files "
+                f"FROM jobs WHERE state IN ({', '.join('?' * len(states))}) ORDER BY updated_at", states).fetchall()
+        jobs = []
+        for url, file_type, quality, convert, is_playlist, conversion, stream, priority, state, files in rows:
+            job = make_job(url, file_type, quality, bool(is_playlist), convert or None, conversion, bool(stream), priority)
+            if state == "converting" and files:
+                job["files"] = json.loads(files)
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+JOURNAL = None
+JOURNAL_SETTING = os.getenv("QUICKTUBE_JOURNAL", "").strip()
+
+def get_job_journal():
+    """Open the job journal (QUICKTUBE_JOURNAL=path, or 'off'; default output/.quicktube-journal.sqlite3)."""
+    global JOURNAL
+    if JOURNAL is None and JOURNAL_SETTING.lower() not in ("off", "0", "false", "no"):
+        path = JOURNAL_SETTING or os.path.join(get_base_output_dir(), ".quicktube-journal.sqlite3")
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            JOURNAL = JobJournal(path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️  Job journal unavailable ({e}), interrupted jobs can't be resumed.")
+            JOURNAL = False
+    return JOURNAL or None
+
+def journal_job(job, state, files=None, error=None):
+    """Record a job's stage in the journal, if there is one."""
+    journal = get_job_journal()
+    if journal is not None:
+        journal.record(job, state, files, error)
+
+STREAMABLE_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
+
+def resolve_stream_formats(video_url, file_type, quality):
+    """Let yt-dlp pick the formats for a download without downloading anything.
+    Returns the processed info dict (with requested_formats for split streams) or None.
+    A freshly extracted info is cached, so the stream fetches load it instead of
+    extracting the page again."""
+    default_selector = get_format_selector(file_type, quality)
+    selector = get_planned_format_selector(video_url, file_type, quality) or default_selector
+    info_json = get_cached_info_for_download(video_url, False)
+    try:
+        if get_ytdlp_engine() == "module":
+            ydl, _ = get_warm_ytdl(("resolve", default_selector), {
+                "quiet": True, "no_warnings": True, "nocheckcertificate": True, "noplaylist": True,
+                "format": default_selector, "http_headers": {"User-Agent": USER_AGENT},
+            })
+            warm_selector = ydl.format_selector
+            if selector != default_selector:
+                ydl.format_selector = ydl.build_format_selector(selector)
+            try:
+                if info_json:
+                    with open(info_json, encoding="utf-8") as f:
+                        info = ydl.process_ie_result(json.load(f), download=False)
+                else:
+                    info = ydl.extract_info(video_url, download=False)
+            finally:
+                ydl.format_selector = warm_selector
+            info = ydl.sanitize_info(info)
+            text = None if info_json else json.dumps(info)
+        else:
+            command = [get_ytdlp_path(), "-J", "--no-playlist", "--no-warnings", "--no-check-certificate",
+                       "--user-agent", USER_AGENT, "-f", selector]
+            command += ["--load-info-json", info_json] if info_json else [video_url]
+            result = subprocess.run(command, capture_output=True, text=True, timeout=60)
+            if result.returncode != 0:
+                return None
+            info = json.loads(result.stdout)
+            text = None if info_json else result.stdout
+    except Exception:
+        return None
+    if text and info.get("id") and info.get("_type", "video") == "video":
+        store_cached_info(video_url, text)
+    return info
+
+def get_stream_output_path(info, output_dir, target_format):
+    """Build the output path for a streamed conversion from the video title."""
+    title = info.get("title") or info.get("id") or "video"
+    # Same characters yt-dlp replaces in file names
+    safe_title = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", title).strip(" .") or "video"
+    return os.path.join(output_dir, f"{safe_title[:200]}.{target_format}")
+
+def stream_convert(video_url, quality, output_dir, target_format, conversion="smart", job=None, priority=1.0):
+    """Download and convert in one pass: ffmpeg reads the media straight from the network
+    (or from a 'yt-dlp -o -' pipe) and only the final file is written to disk. With a
+    bandwidth budget set, ffmpeg gets its priority's share of it like a download does.
+    Returns {"returncode", "error", "files"}, or None when the formats can't be streamed
+    (e.g. DASH fragments split into separate audio/video) so the caller can fall back."""
+    if BANDWIDTH.total and not can_pause_processes():
+        # ffmpeg has no byte rate limit of its own, only yt-dlp can keep to the budget here
+        return None
+    info = resolve_stream_formats(video_url, "mp4", quality)
+    if not info:
+        return None
+    formats = info.get("requested_formats") or [info]
+    if not all(fmt.get("url") for fmt in formats):
+        return None
+    direct = all(fmt.get("protocol") in STREAMABLE_PROTOCOLS for fmt in formats)
+    if not direct and len(formats) != 1:
+        return None
+
+    # Codecs of the selected streams decide what can be copied (same rules as plan_conversion)
+    vcodec = next((fmt.get("vcodec") for fmt in formats if fmt.get("vcodec") not in (None, "none")), None)
+    acodec = next((fmt.get("acodec") for fmt in formats if fmt.get("acodec") not in (None, "none")), None)
+    copy_video = conversion == "quick" or (conversion == "smart" and (vcodec or "").startswith(("avc1", "h264")))
+    copy_audio = conversion == "quick" or (conversion == "smart" and (acodec or "").startswith(("mp4a", "aac")))
+
+    ffmpeg_cmd = get_ffmpeg_path()
+    output_file = get_stream_output_path(info, output_dir, target_format)
+    # Hold the encoder threads for the whole transfer, a copy needs next to none
+    with CPU_BUDGET.reserve(1 if copy_video and copy_audio else None) as threads, atomic_output(output_file) as partial_file:
+        thread_count = str(threads)
+        command = [ffmpeg_cmd, "-y"]
+        feeder = None
+        if direct:
+            for fmt in formats:
+                headers = "".join(f"{key}: {value}\r\n" for key, value in (fmt.get("http_headers") or {}).items())
+                if headers:
+                    command += ["-headers", headers]
+                if fmt.get("protocol") in ("http", "https"):
+                    command += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+                command += ["-i", fmt["url"]]
+        else:
+            # Single stream over a protocol ffmpeg can't read itself - let yt-dlp pipe it in
+            feeder = [get_ytdlp_path(), "-f", formats[0].get("format_id") or "best", "-o", "-", "--no-warnings",
+                      "--no-check-certificate", "--no-playlist", "--user-agent", USER_AGENT, "--no-progress", video_url]
+            command += ["-i", "pipe:0"]
+        video_input = next((i for i, fmt in enumerate(formats) if fmt.get("vcodec") not in (None, "none")), 0)
+        audio_input = next((i for i, fmt in enumerate(formats) if fmt.get("acodec") not in (None, "none")), None)
+        if not direct:
+            video_input, audio_input = 0, (0 if acodec else None)
+        command += ["-map", f"{video_input}:v:0"]
+        if audio_input is not None:
+            command += ["-map", f"{audio_input}:a:0"]
+        command += ["-c:v", "copy"] if copy_video else get_video_encode_args(target_format, thread_count)
+        if audio_input is not None:
+            command += ["-c:a", "copy"] if copy_audio else ["-c:a", "aac"]
+        if target_format == "mp4":
+            command += ["-movflags", "+faststart"]
+        command += ["-loglevel", "error", "-nostats", "-progress", "pipe:1", partial_file]
+
+        if DEBUG_MODE:
+            print("🐛 Debug mode: streaming ffmpeg command" + (" (fed by yt-dlp)" if feeder else ""))
+            print(format_command(command))
+        job = job or video_url
+        feeder_process = None
+        try:
+            with BANDWIDTH.register(job, priority) as bandwidth_slot, METRICS.span(job, "stream_convert", target=target_format, mode=conversion, direct=direct) as span:
+                stdin = None
+                if feeder:
+                    feeder_process = subprocess.Popen(feeder, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    stdin = feeder_process.stdout
+                # Network-bound, so allow far longer than a local conversion. Pausing ffmpeg also
+                # holds back a yt-dlp feeding it through the pipe.
+                returncode = run_ffmpeg(command, 6 * 60 * 60, job=job, show_progress=True, duration=info.get("duration"),
+                                        stdin=stdin, progress_hooks=[bandwidth_slot])
+                if feeder_process is not None:
+                    feeder_process.stdout.close()
+                    if feeder_process.wait() != 0:
+                        returncode = returncode or 1
+                span["exit_code"] = returncode
+        except (OSError, subprocess.TimeoutExpired) as e:
+            if feeder_process is not None:
+                feeder_process.kill()
+            return {"returncode": 1, "error": f"streaming conversion failed: {e}", "files": []}
+        if returncode != 0:
+            return {"returncode": returncode, "error": "streaming conversion failed", "files": []}
+        os.replace(partial_file, output_file)
+        record = make_file_record(info)
+        record["filepath"] = output_file
+        return {"returncode": 0, "error": None, "files": [record]}
+
+STREAM_CACHE_ENABLED = os.getenv("QUICKTUBE_STREAM_CACHE", "").strip().lower() in ("1", "on", "true", "yes")
+STREAM_CACHE_MAX_BYTES = int(get_env_number("QUICKTUBE_STREAM_CACHE_MAX_MB", 4096) * 1024 * 1024)
+STREAM_CACHE_LOCK = threading.Lock()
+STREAM_CACHE_INDEX = "streams.json"
+
+def get_stream_cache_dir(info):
+    """Cache folder holding the raw streams of one video."""
+    name = f"{(info.get('extractor_key') or 'generic').lower()}-{info.get('id')}"
+    return get_cache_dir("streams", re.sub(r"[^\w.-]", "_", name))
+
+def list_cached_streams(info):
+    """Formats of this video that are in the stream cache, each with its "path"."""
+    cache_dir = get_stream_cache_dir(info)
+    try:
+        with open(os.path.join(cache_dir, STREAM_CACHE_INDEX), encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return []
+    streams = []
+    for fmt in index.values():
+        path = os.path.join(cache_dir, f"{fmt['format_id']}.{fmt['ext']}")
+        if os.path.exists(path):
+            streams.append(dict(fmt, path=path))
+    return streams
+
+def add_cached_stream(info, fmt):
+    """Record a downloaded format in the video's stream cache index."""
+    cache_dir = get_stream_cache_dir(info)
+    index_path = os.path.join(cache_dir, STREAM_CACHE_INDEX)
+    entry = {key: fmt.get(key) for key in ("format_id", "ext", "vcodec", "acodec", "height", "width", "abr", "tbr")}
+    with STREAM_CACHE_LOCK:
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index[entry["format_id"]] = entry
+        write_file_atomic(index_path, json.dumps(index))
+
+def prune_stream_cache(keep=()):
+    """Remove least recently used streams until the cache fits QUICKTUBE_STREAM_CACHE_MAX_MB.
+    Paths in keep (the streams of the running job) are never removed."""
+    root = get_cache_dir("streams")
+    entries = []
+    with STREAM_CACHE_LOCK:
+        for folder in os.listdir(root):
+            folder_path = os.path.join(root, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            if not any(name != STREAM_CACHE_INDEX for name in os.listdir(folder_path)):
+                # Every stream of this video was evicted
+                shutil.rmtree(folder_path, ignore_errors=True)
+                continue
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                if name == STREAM_CACHE_INDEX or name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= STREAM_CACHE_MAX_BYTES:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
 
-    print(f"🔄 Converting to {target_format.upper()} (using {thread_count} CPU threads)...")
-    try:
-        # Don't capture output so user can see ffmpeg progress
-        result = subprocess.run(command, timeout=600)  # 10 minute timeout for larger files
-        
-        if result.returncode == 0:
-            print(f"✅ Successfully converted to {target_format.upper()}!")
-            return output_file
+def fetch_source_stream(video_url, info, fmt, show_progress=True, progress_hooks=(), job=None):
+    """Download one format, as is, into the stream cache. Returns its path or None."""
+    cache_dir = get_stream_cache_dir(info)
+    path = os.path.join(cache_dir, f"{fmt['format_id']}.{fmt['ext']}")
+    template = os.path.join(cache_dir.replace("%", "%%"), "%(format_id)s.%(ext)s")
+    info_json = get_cached_info_for_download(video_url, False)
+    engine = get_ytdlp_engine()
+    fragments = FRAGMENT_TUNER.choose(video_url)
+    with METRICS.span(job, "fetch_source", engine=engine, format_id=fmt["format_id"]) as span:
+        if engine == "module":
+            params = {
+                "outtmpl": template, "format": fmt["format_id"], "noplaylist": True,
+                "quiet": not show_progress, "noprogress": True, "no_warnings": True, "nocheckcertificate": True,
+                "retries": 3, "fragment_retries": 3,
+                "http_headers": {"User-Agent": USER_AGENT},
+            }
+            outcome = run_warm_download(("source", fmt["format_id"], show_progress), params, video_url, info_json, progress_hooks, job,
+                                        fragments=fragments)
         else:
-            print(f"❌ Conversion failed.")
-            return None
-    except subprocess.TimeoutExpired:
-        print("❌ Conversion timeout (exceeded 10 minutes).")
+            command = [get_ytdlp_path(), "-o", template, "-f", fmt["format_id"], "--no-warnings", "--no-check-certificate",
+                       "--concurrent-fragments", str(fragments), "--progress", "--newline"]
+            for progress_template in get_progress_template():
+                command += ["--progress-template", progress_template]
+            command += ["--user-agent", USER_AGENT, "--retries", "3", "--fragment-retries", "3", "--no-playlist"]
+            command += ["--load-info-json", info_json] if info_json else [video_url]
+            if DEBUG_MODE:
+                print("\n🐛 Debug mode: yt-dlp command (stream cache)")
+                print(format_command(command), flush=True)
+            outcome = run_ytdlp_process(command, show_progress, progress_hooks, job)
+        span["exit_code"] = outcome["returncode"]
+    if outcome["returncode"] != 0 or not os.path.exists(path):
         return None
-    except Exception as e:
-        print(f"❌ Conversion error: {str(e)}")
+    add_cached_stream(info, fmt)
+    return path
+
+def pick_cached_stream(streams, kind, format_id=None, min_height=None):
+    """Pick a cached stream with video or audio: the exact format when cached, otherwise
+    the best audio or the smallest video at least min_height tall."""
+    codec_key = "vcodec" if kind == "video" else "acodec"
+    candidates = [fmt for fmt in streams if fmt.get(codec_key) not in (None, "none")]
+    for fmt in candidates:
+        if fmt["format_id"] == format_id:
+            return fmt
+    if kind == "audio":
+        return max(candidates, key=lambda fmt: fmt.get("abr") or fmt.get("tbr") or 0, default=None)
+    candidates = [fmt for fmt in candidates if (fmt.get("height") or 0) >= (min_height or 0)]
+    return min(candidates, key=lambda fmt: fmt.get("height") or 0, default=None)
+
+def download_via_stream_cache(video_url, file_type, quality, output_dir, show_progress=True, progress_hooks=(), job=None):
+    """Build the requested output from raw streams in the stream cache, downloading only
+    the streams that aren't cached yet. An MP3 after an MP4 (or a lower resolution after a
+    higher one) is then derived locally with ffmpeg. Returns {"returncode", "error", "files"},
+    or None when the cache can't be used so the caller downloads normally."""
+    info = resolve_stream_formats(video_url, file_type, quality)
+    if not info or not info.get("id"):
+        return None
+    selected = info.get("requested_formats") or [info]
+    if not all(fmt.get("format_id") and fmt.get("ext") for fmt in selected):
         return None
+    wanted_video = next((fmt for fmt in selected if fmt.get("vcodec") not in (None, "none")), None)
+    wanted_audio = next((fmt for fmt in selected if fmt.get("acodec") not in (None, "none")), None)
+    if wanted_audio is None or (file_type == "mp4" and wanted_video is None):
+        return None
+    target_height = (wanted_video or {}).get("height") or int(VIDEO_QUALITY_MAP.get(quality, "720"))
+
+    cached = list_cached_streams(info)
+    sources = {}
+    for kind, wanted in (("video", wanted_video if file_type == "mp4" else None), ("audio", wanted_audio)):
+        if wanted is None:
+            continue
+        fmt = pick_cached_stream(cached, kind, wanted["format_id"], target_height)
+        if fmt is None:
+            path = fetch_source_stream(video_url, info, wanted, show_progress, progress_hooks, job)
+            if path is None:
+                return None
+            fmt = dict(wanted, path=path)
+            cached.append(fmt)
+        elif show_progress:
+            print(f"♻️  Using cached {kind} stream {fmt['format_id']} ({fmt.get('height') or fmt.get('abr') or '?'})")
+        sources[kind] = fmt
+    for fmt in sources.values():
+        # Mark as recently used for the LRU eviction
+        try:
+            os.utime(fmt["path"], None)
+        except OSError:
+            pass
 
-def remux_video(input_file, target_format):
-    """Remux video to another container without re-encoding (fast, no quality loss)."""
-    current_ext = os.path.splitext(input_file)[1][1:].lower()
-    
-    if current_ext == target_format.lower():
-        print(f"⚠️  File is already in {target_format.upper()} format. No remux needed.")
-        return input_file
-    
-    base_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(os.path.dirname(input_file), f"{base_name}_remuxed.{target_format}")
-    
     ffmpeg_cmd = get_ffmpeg_path()
-    
-    # Copy streams without re-encoding - very fast, no quality loss
-    command = [
-        ffmpeg_cmd, "-y", "-i", input_file,
-        "-c", "copy",  # Copy all streams without re-encoding
-        "-movflags", "+faststart" if target_format == "mp4" else "",
-        "-loglevel", "error", "-stats",
-        output_file
-    ]
-    # Remove empty arguments
-    command = [arg for arg in command if arg]
-    
-    print(f"🔄 Remuxing to {target_format.upper()} (no re-encoding, instant)...")
-    try:
-        result = subprocess.run(command, timeout=120)  # 2 minute timeout (remux is fast)
-        
-        if result.returncode == 0:
-            print(f"✅ Successfully remuxed to {target_format.upper()}!")
-            return output_file
+    passthrough = is_audio_passthrough(file_type, quality)
+    output_ext = get_native_audio_ext(sources["audio"].get("acodec")) if passthrough else file_type
+    output_file = get_stream_output_path(info, output_dir, output_ext)
+    inputs = []
+    for fmt in sources.values():
+        if fmt["path"] not in inputs:
+            inputs.append(fmt["path"])
+    audio_input = inputs.index(sources["audio"]["path"])
+    if passthrough:
+        mode = "copy_audio"
+    elif file_type == "mp3":
+        mode = "extract_audio"
+    elif (sources["video"].get("height") or 0) > target_height:
+        # Only a taller stream is cached: scale it down instead of downloading again
+        mode = "downscale"
+    else:
+        mode = "merge"
+
+    # MP3 encoding is single-threaded and a merge only copies, a downscale gets its share of the CPU budget
+    with CPU_BUDGET.reserve(None if mode == "downscale" else 1) as threads, atomic_output(output_file) as partial_file:
+        command = [ffmpeg_cmd, "-y"]
+        for path in inputs:
+            command += ["-i", path]
+        if mode == "copy_audio":
+            command += ["-map", f"{audio_input}:a:0", "-c:a", "copy"]
+        elif mode == "extract_audio":
+            bitrate = AUDIO_QUALITY_MAP.get(quality, "128k")
+            command += ["-map", f"{audio_input}:a:0", "-c:a", "libmp3lame", "-b:a", bitrate]
         else:
-            print(f"❌ Remux failed.")
-            return None
-    except subprocess.TimeoutExpired:
-        print("❌ Remux timeout.")
-        return None
-    except Exception as e:
-        print(f"❌ Remux error: {str(e)}")
-        return None
+            command += ["-map", f"{inputs.index(sources['video']['path'])}:v:0", "-map", f"{audio_input}:a:0"]
+            if mode == "downscale":
+                command += ["-vf", f"scale=-2:{target_height}"] + get_video_encode_args("mp4", str(threads))
+            else:
+                command += ["-c:v", "copy"]
+            command += ["-c:a", "copy", "-movflags", "+faststart"]
+        command += ["-loglevel", "error", "-nostats", "-progress", "pipe:1", partial_file]
+
+        if DEBUG_MODE:
+            print(f"🐛 Debug mode: deriving {file_type} from cached streams ({mode})")
+            print(format_command(command))
+        try:
+            with METRICS.span(job, "derive", mode=mode, target=file_type) as span:
+                returncode = run_ffmpeg(command, 6 * 60 * 60, job=job, show_progress=show_progress, duration=info.get("duration"))
+                span["exit_code"] = returncode
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return {"returncode": 1, "error": f"building {file_type} from cached streams failed: {e}", "files": []}
+        finally:
+            prune_stream_cache(keep={fmt["path"] for fmt in sources.values()})
+        if returncode == 0:
+            os.replace(partial_file, output_file)
+    if returncode != 0:
+        return {"returncode": returncode, "error": f"building {file_type} from cached streams failed", "files": []}
+    record = make_file_record(info)
+    record["filepath"] = output_file
+    return {"returncode": 0, "error": None, "files": [record]}
 
 def download_media(video_url, file_type, quality, is_playlist):
     """Downloads media (MP3 or MP4) based on user choices and offers conversion afterward."""
     # Determine output directory based on platform and execution context
-    if getattr(sys, 'frozen', False):
-        # Running as compiled executable
-        if sys.platform == 'darwin':
-            # macOS: For .app bundles, save to output folder next to the .app
-            # sys.executable is inside QuickTube.app/Contents/MacOS/QuickTube
-            # We need to go up 3 levels to get to the parent directory of the .app
-            executable_path = os.path.abspath(sys.executable)
-            if '.app/Contents/MacOS' in executable_path:
-                # Inside an app bundle - go to parent of .app
-                app_bundle = executable_path.split('.app/Contents/MacOS')[0] + '.app'
-                base_dir = os.path.dirname(app_bundle)
-            else:
-                # Not in app bundle (shouldn't happen, but fallback)
-                base_dir = os.path.dirname(executable_path)
-            output_dir = os.path.join(base_dir, "output")
-        else:
-            # Windows/Linux: Use executable's directory
-            base_dir = os.path.dirname(sys.executable)
-            output_dir = os.path.join(base_dir, "output")
-    else:
-        # Running as script - use script's directory
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        output_dir = os.path.join(base_dir, "output")
-    
-    # Try to create output directory, handle read-only filesystem error
     try:
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = prepare_output_dir(file_type)
     except (OSError, PermissionError) as e:
-        print("\n" + "="*60)
-        print("❌ ERROR: Cannot create output folder")
-        print("="*60)
-        print(f"\n⚠️  Could not create folder: {output_dir}")
-        print(f"\n💡 Error: {e}")
-        print("\n📋 SOLUTION:")
-        print("   1. Check folder permissions")
-        print("   2. Try running from a different location\n")
-        print("="*60 + "\n")
+        show_output_dir_error(e.filename, e)
         input("Press Enter to exit...")
         sys.exit(1)
 
-    # Quality is now the actual resolution/bitrate value
-    audio_quality_map = {"64": "64k", "128": "128k", "192": "192k", "320": "320k"}
-    video_quality_map = {"144": "144", "240": "240", "360": "360", "480": "480", "720": "720", "1080": "1080", "1440": "1440", "2160": "2160"}
-
-    # Store the base output directory as fallback
-    base_output_dir = output_dir
-    
-    # Try to create subdirectory based on file type
-    if file_type == "mp3":
-        output_dir = os.path.join(output_dir, "mp3")
-    elif file_type == "mp4":
-        output_dir = os.path.join(output_dir, "mp4")
-    
-    # Try to create the subdirectory
-    try:
-        os.makedirs(output_dir, exist_ok=True)
-    except (OSError, PermissionError) as e:
-        # Fallback to base output directory
-        print(f"\n⚠️  Could not create subfolder: {output_dir}")
-        print(f"    Falling back to: {base_output_dir}")
-        output_dir = base_output_dir
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-        except (OSError, PermissionError) as e2:
-            print("\n" + "="*60)
-            print("❌ ERROR: Cannot create output folder")
-            print("="*60)
-            print(f"\n⚠️  Could not create folder: {output_dir}")
-            print(f"\n💡 Error: {e2}")
-            print("\n📋 SOLUTION:")
-            print("   1. Check folder permissions")
-            print("   2. Try running from a different location\n")
-            print("="*60 + "\n")
-            input("Press Enter to exit...")
-            sys.exit(1)
-
-    # Filename template uses YouTube video title and extension
-    filename = os.path.join(output_dir, "%(title)s.%(ext)s")
-    
-    # Get yt-dlp path (bundled or system)
-    ytdlp_cmd = get_ytdlp_path()
-    thread_count = get_cpu_thread_count()
-    
-    # Enhanced command with:
-    # - Cleaner progress bar (single line updates)
-    # - Anti-blocking measures
-    # - Reduced CPU usage for merging
-    # - Concurrent downloads for faster speeds
-    command = [
-        ytdlp_cmd, "-o", filename,
-        "--no-warnings",
-        "--no-check-certificate",
-        # Concurrent fragment downloads (faster for DASH/HLS streams)
-        "--concurrent-fragments", "4",
-        # Progress bar settings - use default yt-dlp progress (updates in place)
-        "--progress",
-        "--console-title",
-        # Add user agent to avoid blocking
-        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        # Retry on failures
-        "--retries", "3",
-        "--fragment-retries", "3",
-    ]
-
-    if file_type == "mp3":
-        bitrate = audio_quality_map.get(quality, "128K")
-        command += ["-x", "--audio-format", "mp3", "--audio-quality", bitrate]
-    elif file_type == "mp4":
-        resolution = video_quality_map.get(quality, "720")
-        # IMPROVED FORMAT SELECTION with fallback for platforms with limited formats:
-        # 1. Prefer split video/audio streams at or below the requested resolution
-        # 2. Fall back to combined mp4 if needed
-        # 3. Use any available format only as a last resort
-        command += [
-            "-f", (
-                f"bestvideo[height<={resolution}]+140/"
-                f"bestvideo[height<={resolution}]+bestaudio[ext=m4a]/"
-                f"bestvideo[height<={resolution}]+bestaudio"
-            ),
-            "--merge-output-format", "mp4",
-        ]
-
-    if not is_playlist:
-        command.append("--no-playlist")
-
-    # Use yt-dlp's --print after_move:filepath to capture the output filename (suppress this output)
-    command.append(video_url)
-    
     # Display quality in user-friendly format
-    quality_display = f"{quality}p" if file_type == "mp4" else f"{quality} kbps"
+    label = file_type.upper()
+    if is_audio_passthrough(file_type, quality):
+        label = "audio"
+        quality_display = "original codec, no re-encoding"
+    else:
+        quality_display = f"{quality}p" if file_type == "mp4" else f"{quality} kbps"
 
-    if DEBUG_MODE:
-        print("\n🐛 Debug mode: yt-dlp command")
-        print(format_command(command))
-    
-    print(f"\n⏳ Downloading {file_type.upper()} ({quality_display})...")
+    print(f"\n⏳ Downloading {label} ({quality_display})...")
     print("=" * 60)
-    
-    # Run command without capturing output to show real-time progress
-    result = subprocess.run(command, capture_output=False, text=True)
-    
+
+    started = time.monotonic()
+    # MP3s are encoded after the download, every file of a playlist at the same time
+    result = run_ytdlp_download(video_url, file_type, quality, is_playlist, output_dir, defer_encode=True)
+    if result.get("encode"):
+        print(f"🎵 Encoding {len(result['files'])} file(s) to MP3 ({quality} kbps)...")
+        result["files"], failed = encode_audio_records(video_url, quality, is_playlist, result["files"])
+        if failed:
+            print(f"⚠️  {failed} file(s) could not be encoded to MP3.")
+            if not result["files"]:
+                result["returncode"] = 1
+    METRICS.record_job(video_url, result["returncode"] == 0, time.monotonic() - started)
+
     print("=" * 60)
 
     # Check if download was successful
-    if result.returncode != 0:
+    if result["returncode"] != 0:
         print(f"❌ Download failed!")
         print("\n💡 Troubleshooting tips:")
         print("   1. Update yt-dlp: pip install --upgrade yt-dlp")
@@ -342,41 +2929,44 @@ def download_media(video_url, file_type, quality, is_playlist):
         print("   4. For age-restricted videos, make sure you're logged into Chrome")
         return
 
-    # Find the downloaded file in the output directory
-    output_files = []
-    for file in os.listdir(output_dir):
-        if file.lower().endswith(f".{file_type}"):
-            output_files.append(os.path.join(output_dir, file))
-    
+    # yt-dlp reports the final path of every item, no need to scan the output folder
+    output_files = [record["filepath"] for record in result["files"]]
     if not output_files:
-        print(f"❌ No {file_type.upper()} file found.")
+        print(f"❌ No {label} file found.")
         return
-    
-    # Get the most recently created file
-    output_file = max(output_files, key=os.path.getctime)
-    
-    print(f"🎉 Successfully downloaded {file_type.upper()}: {os.path.basename(output_file)}")
-    print(f"📁 Saved to: {output_file}")
-    
+
+    if len(output_files) == 1:
+        print(f"🎉 Successfully downloaded {label}: {os.path.basename(output_files[0])}")
+        print(f"📁 Saved to: {output_files[0]}")
+    else:
+        print(f"🎉 Successfully downloaded {len(output_files)} {label} files:")
+        for output_file in output_files:
+            print(f"   • {os.path.basename(output_file)}")
+        print(f"📁 Saved to: {os.path.dirname(output_files[0])}")
+
     # Conversion step for video files only
     if file_type == "mp4":
         print("\n🎬 Convert to another format?")
-        print("   1. Yes (full conversion - slower, may fix playback issues)")
+        print("   1. Yes (smart conversion - only re-encodes streams that need it)")
         print("   2. Yes (quick copy - instant, same quality)")
         print("   3. No")
-        convert_choice = input("Enter your choice (1-3, default: 3): ").strip().lower() or "3"
-        if convert_choice in ["1", "2", "yes", "y", "full", "quick", "copy"]:
+        print("   4. Yes (full conversion - slowest, re-encodes everything, may fix playback issues)")
+        convert_choice = input("Enter your choice (1-4, default: 3): ").strip().lower() or "3"
+        if convert_choice in ["1", "2", "4", "yes", "y", "smart", "full", "quick", "copy"]:
             # Determine conversion type
             if convert_choice in ["2", "quick", "copy"]:
-                is_quick = True
-            elif convert_choice in ["1", "full"]:
-                is_quick = False
+                conversion = "quick"
+            elif convert_choice in ["1", "smart"]:
+                conversion = "smart"
+            elif convert_choice in ["4", "full"]:
+                conversion = "full"
             else:  # "yes" or "y" - ask which type
                 print("\n⚡ Conversion type:")
-                print("   1. Full conversion (slower, may fix issues)")
+                print("   1. Smart conversion (re-encodes only what's needed)")
                 print("   2. Quick copy (instant, same quality)")
-                type_choice = input("Enter your choice (1-2, default: 2): ").strip().lower() or "2"
-                is_quick = type_choice in ["2", "quick", "copy"]
+                print("   3. Full conversion (slowest, may fix issues)")
+                type_choice = input("Enter your choice (1-3, default: 2): ").strip().lower() or "2"
+                conversion = {"1": "smart", "smart": "smart", "3": "full", "full": "full"}.get(type_choice, "quick")
             
             print("\n📦 Select target format:")
             print("   1. MP4")
@@ -391,17 +2981,929 @@ def download_media(video_url, file_type, quality, is_playlist):
                     break
                 print("⚠️  Invalid choice! Please enter 1, 2, or type 'mp4'/'mkv'.")
             
-            if is_quick:
-                # Quick remux - just copy streams without re-encoding
-                converted_file = remux_video(output_file, target_format)
-            else:
-                converted_file = convert_video(output_file, target_format)
-            
-            if converted_file:
-                print(f"🎉 Conversion complete!")
-                print(f"📁 Saved to: {converted_file}")
+            for output_file in output_files:
+                if conversion == "quick":
+                    # Quick remux - just copy streams without re-encoding
+                    converted_file = remux_video(output_file, target_format, job=video_url)
+                else:
+                    converted_file = convert_video(output_file, target_format, job=video_url, full=conversion == "full")
+
+                if converted_file:
+                    print(f"🎉 Conversion complete!")
+                    print(f"📁 Saved to: {converted_file}")
     
-if __name__ == "__main__":
+def convert_file(input_file, target_format, conversion="smart", job=None):
+    """Run the chosen conversion (smart, full or quick remux) on a downloaded file."""
+    if conversion == "quick":
+        return remux_video(input_file, target_format, job=job)
+    return convert_video(input_file, target_format, job=job, full=conversion == "full")
+
+def make_job(url, file_type, quality, is_playlist=False, convert=None, conversion="smart", stream=False, priority=1.0):
+    """Describe a headless download job. convert (mp4/mkv) only applies to MP4 downloads;
+    with stream, conversion happens while downloading when the formats allow it.
+    priority weighs the job's share of the bandwidth budget."""
+    return {
+        "url": url, "file_type": file_type, "quality": quality, "is_playlist": is_playlist,
+        "convert": convert if file_type == "mp4" else None, "conversion": conversion, "stream": stream,
+        "priority": priority,
+    }
+
+def expand_playlist_jobs(jobs, resume=False):
+    """Turn each playlist job into one job per entry while the playlist is still being
+    enumerated, so the first items download before the last page of a large playlist
+    is fetched. Playlists are remembered in the download archive for sync.
+    Every job is queued in the journal; with resume, jobs the journal has as done
+    (or that were already yielded) are skipped."""
+    journal = get_job_journal()
+    seen = set()
+
+    def wanted(job):
+        if resume and journal is not None:
+            key = JobJournal.key(job)
+            if key in seen or journal.state(job) == "done":
+                return False
+            seen.add(key)
+        return True
+
+    for job in jobs:
+        if not wanted(job):
+            continue
+        journal_job(job, "queued")
+        if not job["is_playlist"]:
+            yield job
+            continue
+        archive = get_download_archive()
+        playlist_id = None
+        enumerated = complete = False
+        entries = iter_playlist_entries(job["url"])
+        try:
+            for entry in entries:
+                if not is_playlist_entry(entry):
+                    # Not a playlist after all, keep its info for the download
+                    store_cached_info(job["url"], json.dumps(entry))
+                    break
+                enumerated = True
+                entry_url = entry.get("webpage_url") or entry.get("url")
+                if not entry_url:
+                    continue
+                playlist_id = playlist_id or entry.get("playlist_id")
+                # Flat entries carry the extractor and ID, so archived items cost no yt-dlp run
+                if (archive and entry.get("ie_key") and entry.get("id")
+                        and archive.lookup(entry["ie_key"], entry["id"], job["file_type"], job["quality"])):
+                    METRICS.count("archive_hits")
+                    if YTDLP_BREAK_ON_EXISTING:
+                        complete = True
+                        break
+                    continue
+                entry_job = dict(job, url=entry_url, is_playlist=False)
+                if wanted(entry_job):
+                    journal_job(entry_job, "queued")
+                    yield entry_job
+            else:
+                complete = True
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"🐛 Debug mode: enumerating {job['url']} failed: {e}", flush=True)
+        finally:
+            entries.close()
+        if not enumerated:
+            # Single video, empty playlist or enumeration error: let yt-dlp handle the URL itself
+            yield job
+        else:
+            if complete:
+                # Every entry is in the journal on its own now; an interrupted
+                # enumeration stays queued so 'resume' lists the playlist again
+                journal_job(job, "done")
+            if archive and playlist_id:
+                archive.add_playlist(job["url"], job["file_type"], job["quality"], playlist_id)
+
+def run_download_stage(job):
+    """Download stage of a job. Returns a result dict; result["pending_convert"] is set
+    when the downloaded files still need the post-processing stage."""
+    video_url = job["url"]
+    result = {"url": video_url, "ok": False, "returncode": None, "error": None, "elapsed": 0.0, "files": [],
+              "pending_convert": False, "started": time.monotonic()}
+    downloaded = job.get("files") or []
+    if downloaded and all(os.path.exists(path) for path in downloaded):
+        # Resumed after the download finished: only the conversion (or MP3 encode) is left
+        pending = bool(job["convert"]) or needs_mp3_encode(job, downloaded)
+        result.update(ok=True, returncode=0, files=list(downloaded), pending_convert=pending)
+        if pending:
+            result["records"] = [{"id": None, "filepath": path} for path in downloaded]
+        journal_job(job, "converting", downloaded)
+        return result
+
+    def track_merge(event):
+        if event["event"] == "postprocess" and event.get("postprocessor") == "Merger" and event.get("status") == "started":
+            journal_job(job, "merging")
+
+    journal_job(job, "downloading")
+    try:
+        output_dir = prepare_output_dir(job["file_type"])
+        outcome = None
+        if job["convert"] and job["stream"] and not job["is_playlist"]:
+            # Streamed output is archived under its own format, it's what ends up on disk
+            archived = find_archived_file(video_url, job["convert"], job["quality"], False)
+            if archived:
+                METRICS.count("archive_hits")
+                outcome = {"returncode": 0, "error": None, "files": [{"filepath": archived}]}
+            else:
+                outcome = stream_convert(video_url, job["quality"], output_dir, job["convert"], job["conversion"],
+                                         job=video_url, priority=job["priority"])
+                if outcome is not None and outcome["returncode"] == 0:
+                    archive_download(video_url, job["convert"], job["quality"], False, outcome["files"])
+        if outcome is None:
+            # MP3s are encoded in the post-processing pool, so downloads never wait on the encoder
+            outcome = run_ytdlp_download(video_url, job["file_type"], job["quality"], job["is_playlist"], output_dir,
+                                         show_progress=False, progress_hooks=[track_merge], job=video_url,
+                                         priority=job["priority"], defer_encode=True)
+            # Streamed files are already in the target format
+            result["pending_convert"] = (bool(job["convert"]) or outcome.get("encode", False)) and outcome["returncode"] == 0
+            if outcome.get("encode"):
+                result["records"] = outcome["files"]
+        result["returncode"] = outcome["returncode"]
+        result["ok"] = outcome["returncode"] == 0
+        result["error"] = outcome["error"]
+        result["files"] = [record["filepath"] for record in outcome["files"]]
+        if result["pending_convert"]:
+            journal_job(job, "converting", result["files"])
+    except FileNotFoundError as e:
+        result["error"] = f"yt-dlp not found: {e}"
+    except (OSError, PermissionError) as e:
+        result["error"] = str(e)
+    return result
+
+def needs_mp3_encode(job, files):
+    """True when an MP3 job's files are still the source audio of a deferred encode."""
+    return (job["file_type"] == "mp3" and not is_audio_passthrough(job["file_type"], job["quality"])
+            and any(not path.lower().endswith(".mp3") for path in files))
+
+def run_postprocess_stage(job, result):
+    """Post-processing stage of a job: convert the downloaded files, or encode them to MP3."""
+    try:
+        if "records" in result:
+            records, failed = encode_audio_records(job["url"], job["quality"], job["is_playlist"],
+                                                   result.pop("records"), show_progress=False)
+            if failed:
+                result["ok"] = False
+                result["error"] = "MP3 encoding failed"
+            result["files"] = [record["filepath"] for record in records]
+        else:
+            converted = [convert_file(path, job["convert"], job["conversion"], job=job["url"]) for path in result["files"]]
+            if None in converted:
+                result["ok"] = False
+                result["error"] = "conversion failed"
+            result["files"] = [path for path in converted if path]
+    except OSError as e:
+        result["ok"] = False
+        result["error"] = str(e)
+    result["pending_convert"] = False
+    return result
+
+def finish_job(job, result):
+    """Record a finished job's total time (download + post-processing) and its outcome in the journal."""
+    result["elapsed"] = time.monotonic() - result.pop("started")
+    METRICS.record_job(result["url"], result["ok"], result["elapsed"])
+    journal_job(job, "done" if result["ok"] else "failed", result["files"], result["error"])
+    return result
+
+def run_download_job(job):
+    """Run both stages of one job back to back and return its result dict."""
+    result = run_download_stage(job)
+    if result["pending_convert"]:
+        result = run_postprocess_stage(job, result)
+    return finish_job(job, result)
+
+def run_pipeline(jobs, download_workers, postprocess_workers, queue_size, on_result, output_dir=None, min_free_bytes=0):
+    """Run jobs through two independently sized worker pools: downloads, then post-processing.
+    Item N+1 downloads while item N converts. Up to download_workers downloads run at once; a
+    finished download is handed off only when there is room in the hand-off queue (queue_size
+    finished downloads waiting + the ones being converted), and its worker waits for that room
+    before taking the next job. When min_free_bytes is set, a download only starts while
+    output_dir has that much free space or nothing is waiting to be converted. jobs may be
+    any iterable, including a generator."""
+    job_iter = iter(jobs)
+    iter_lock = threading.Lock()
+    job_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(queue_size + postprocess_workers)
+    handoff = queue.Queue()
+    pending = [0]
+
+    def next_job():
+        # jobs may block (e.g. a playlist still being enumerated), so it has its own lock
+        with iter_lock:
+            return next(job_iter, None)
+
+    def wait_for_disk_space():
+        while min_free_bytes and output_dir and pending[0]:
+            try:
+                if shutil.disk_usage(output_dir).free >= min_free_bytes:
+                    return
+            except OSError:
+                return
+            time.sleep(1)
+
+    def download_worker():
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            wait_for_disk_space()
+            try:
+                result = run_download_stage(job)
+            except Exception as e:
+                result = {"url": job["url"], "ok": False, "returncode": None, "error": str(e), "elapsed": 0.0,
+                          "files": [], "pending_convert": False, "started": time.monotonic()}
+            if result["pending_convert"] and postprocess_workers:
+                # Only the conversion backlog is bounded; downloads themselves are limited by download_workers
+                slots.acquire()
+                with job_lock:
+                    pending[0] += 1
+                handoff.put((job, result))
+                continue
+            if result["pending_convert"]:
+                result = run_postprocess_stage(job, result)
+            on_result(finish_job(job, result))
+
+    def postprocess_worker():
+        while True:
+            entry = handoff.get()
+            if entry is None:
+                return
+            job, result = entry
+            try:
+                result = run_postprocess_stage(job, result)
+            finally:
+                with job_lock:
+                    pending[0] -= 1
+                slots.release()
+            on_result(finish_job(job, result))
+
+    downloaders = [threading.Thread(target=download_worker, daemon=True) for _ in range(download_workers)]
+    converters = [threading.Thread(target=postprocess_worker, daemon=True) for _ in range(postprocess_workers)]
+    for thread in downloaders + converters:
+        thread.start()
+    for thread in downloaders:
+        thread.join()
+    for _ in converters:
+        handoff.put(None)
+    for thread in converters:
+        thread.join()
+
+def read_url_list(path):
+    """Read URLs from a text file (or '-' for stdin), skipping blank lines and # comments.
+    A line may end with a bandwidth priority ("URL 2"). Returns (url, priority) pairs."""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    urls = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            url, _, priority = line.partition(" ")
+            try:
+                urls.append((url, float(priority) if priority.strip() else 1.0))
+            except ValueError:
+                urls.append((line, 1.0))
+    return urls
+
+def normalize_quality(file_type, quality):
+    """Turn a quality like 720p, 192k or None (default) into a quality map key; raises ValueError."""
+    quality_map = AUDIO_QUALITY_MAP if file_type == "mp3" else VIDEO_QUALITY_MAP
+    normalized = str(quality or ("128" if file_type == "mp3" else "720")).lower().rstrip("pk")
+    if is_audio_passthrough(file_type, normalized):
+        return normalized
+    if normalized not in quality_map:
+        choices = list(quality_map) + ([AUDIO_PASSTHROUGH] if file_type == "mp3" else [])
+        raise ValueError(f"invalid quality {quality!r} for {file_type} (choose from {', '.join(choices)})")
+    return normalized
+
+def add_job_arguments(parser):
+    """Options shared by the batch and sync commands."""
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="number of parallel downloads (default: 4)")
+    parser.add_argument("-t", "--type", dest="file_type", choices=["mp3", "mp4"], default="mp4", help="output type (default: mp4)")
+    parser.add_argument("-q", "--quality", help="resolution for mp4 (e.g. 720) or bitrate for mp3 (e.g. 128, or 'original' to keep the source audio without re-encoding)")
+    parser.add_argument("--convert", choices=["mp4", "mkv"], help="convert downloaded videos to this format")
+    parser.add_argument("--convert-mode", choices=["smart", "full", "quick"], default="smart",
+                        help="smart re-encodes only what's needed, full re-encodes everything, quick only remuxes (default: smart)")
+    parser.add_argument("--stream", action="store_true", help="with --convert, convert while downloading when the formats allow it (no intermediate file)")
+    parser.add_argument("--convert-jobs", type=int, help="number of parallel conversions or MP3 encodes, separate from --jobs (default: CPU budget / 4, at least 1; for mp3, the CPU budget)")
+    parser.add_argument("--queue-size", type=int, default=2, help="downloaded files allowed to wait for conversion before downloads pause (default: 2)")
+    parser.add_argument("--min-free-mb", type=float, default=0, help="pause new downloads while conversions are pending and free disk space is below this")
+    parser.add_argument("--engine", choices=["auto", "module", "binary"], help="run yt-dlp in-process (module) or as a subprocess (binary)")
+    parser.add_argument("--limit-rate", metavar="RATE", help="total download speed shared by all jobs, e.g. 5M (a URL line may end with a priority weight)")
+    parser.add_argument("--fragments", type=int, help="DASH/HLS fragments fetched at once (default: tuned per site from measured throughput)")
+    parser.add_argument("--cpus", type=int, help="CPU threads shared by all jobs (default: container CPU quota, or half the cores)")
+    parser.add_argument("--threads", type=int, help="encoder threads per conversion (default: as many as the shared budget allows)")
+    parser.add_argument("--chunked", choices=["off", "on", "auto"],
+                        help="split full conversions into chunks encoded in parallel; auto only for videos over 2 minutes (default: QUICKTUBE_CHUNKED or off)")
+    parser.add_argument("--no-archive", action="store_true", help="don't skip or record items in the download archive")
+    parser.add_argument("--stream-cache", action="store_true", help="keep raw downloaded streams and build other formats/resolutions from them locally")
+    parser.add_argument("--progress-log", metavar="TARGET", help="also write progress events as JSON lines to a file, tcp://host:port, udp://host:port or unix:/path")
+    parser.add_argument("--metrics-jsonl", metavar="PATH", help="append stage timing spans as JSON lines to PATH")
+    parser.add_argument("--metrics-prom", metavar="PATH", help="write totals as a Prometheus textfile to PATH")
+    parser.add_argument("--debug", action="store_true", help="print the yt-dlp commands and a stage timing table")
+
+def apply_job_arguments(parser, args):
+    """Validate the shared options and apply the global ones. Returns the normalized quality."""
+    global YTDLP_ENGINE, ARCHIVE_SETTING, STREAM_CACHE_ENABLED, CHUNKED_TRANSCODE
+    if args.engine:
+        YTDLP_ENGINE = args.engine
+    if args.chunked:
+        CHUNKED_TRANSCODE = args.chunked
+    if args.stream_cache:
+        STREAM_CACHE_ENABLED = True
+    if args.no_archive:
+        ARCHIVE_SETTING = "off"
+
+    try:
+        quality = normalize_quality(args.file_type, args.quality)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if any(value is not None and value < 1 for value in (args.cpus, args.threads, args.fragments)):
+        parser.error("--cpus, --threads and --fragments must be at least 1")
+    FRAGMENT_TUNER.fixed = args.fragments or FRAGMENT_TUNER.fixed
+    if args.limit_rate:
+        try:
+            BANDWIDTH.total = parse_rate(args.limit_rate) or None
+        except ValueError as e:
+            parser.error(str(e))
+    CPU_BUDGET.total = args.cpus or CPU_BUDGET.total
+    CPU_BUDGET.job_threads = args.threads or CPU_BUDGET.job_threads
+    if args.convert_jobs is None:
+        # MP3 encodes are single-threaded: one per CPU thread, video encodes split it four ways
+        args.convert_jobs = CPU_BUDGET.total if args.file_type == "mp3" else max(1, CPU_BUDGET.total // 4)
+    if not CPU_BUDGET.job_threads:
+        # Parallel conversions split the budget instead of the first one taking it all
+        CPU_BUDGET.job_threads = max(1, CPU_BUDGET.total // args.convert_jobs)
+    if args.convert_jobs < 1 or args.queue_size < 0:
+        parser.error("--convert-jobs must be at least 1 and --queue-size can't be negative")
+
+    METRICS.jsonl_path = args.metrics_jsonl or METRICS.jsonl_path
+    METRICS.prom_path = args.metrics_prom or METRICS.prom_path
+    return quality
+
+def execute_jobs(args, jobs, total, playlists=False, resume=False):
+    """Run jobs through the download/convert pipeline and report each result.
+    Playlist jobs are expanded into one job per entry, so with playlists the number
+    of results isn't known up front and total only counts the URLs given.
+    With resume, jobs the journal already has as done are skipped.
+    Returns the process exit code (0 = all succeeded, 1 = some jobs failed, 2 = bad input)."""
+    if args.progress_log and not open_progress_sink(args.progress_log):
+        return 2
+    removed = cleanup_partial_outputs(get_base_output_dir())
+    if removed:
+        print(f"🧹 Removed {removed} partial output(s) left by an interrupted run.", flush=True)
+
+    # One summary line for all running jobs instead of interleaved progress bars
+    PROGRESS_DISPLAY.mode = "aggregate"
+    print(f"⏳ Downloading {total} URL(s) with {args.jobs} parallel job(s)...", flush=True)
+    if args.convert and args.file_type == "mp4":
+        print(f"🔄 Converting videos to {args.convert.upper()} with {args.convert_jobs} parallel job(s) while downloads continue...", flush=True)
+    elif args.file_type == "mp3" and str(args.quality).lower() != AUDIO_PASSTHROUGH:
+        print(f"🎵 Encoding MP3s with {args.convert_jobs} parallel job(s) while downloads continue...", flush=True)
+    results = []
+    results_lock = threading.Lock()
+
+    def report(result):
+        with results_lock:
+            results.append(result)
+            position = len(results) if playlists else f"{len(results)}/{total}"
+            if result["ok"]:
+                PROGRESS_DISPLAY.print_line(f"✅ [{position}] {result['url']} ({result['elapsed']:.1f}s)")
+                for path in result["files"]:
+                    PROGRESS_DISPLAY.print_line(f"   📁 {path}")
+            else:
+                PROGRESS_DISPLAY.print_line(f"❌ [{position}] {result['url']}: {result['error']}")
+
+    run_pipeline(expand_playlist_jobs(jobs, resume), args.jobs, args.convert_jobs, args.queue_size, report,
+                 output_dir=get_base_output_dir(), min_free_bytes=int(args.min_free_mb * 1024 * 1024))
+
+    PROGRESS_DISPLAY.clear()
+    METRICS.flush()
+    for store in (get_download_archive(), get_job_journal()):
+        if store:
+            store.close()
+    failed = [r for r in results if not r["ok"]]
+    print("=" * 60)
+    print(f"🎉 Done: {len(results) - len(failed)} succeeded, {len(failed)} failed.")
+    return 1 if failed else 0
+
+def run_batch(argv):
+    """Non-interactive batch mode: download every URL in a list with a bounded worker pool.
+    Returns the process exit code (0 = all succeeded, 1 = some jobs failed, 2 = bad input)."""
+    parser = argparse.ArgumentParser(prog="quicktube.py batch", description="Download a list of URLs without prompts.")
+    parser.add_argument("url_file", help="text file with one URL per line ('-' reads stdin)")
+    parser.add_argument("--playlist", action="store_true", help="download whole playlists instead of single items")
+    add_job_arguments(parser)
+    args = parser.parse_args(argv)
+    quality = apply_job_arguments(parser, args)
+
+    try:
+        urls = read_url_list(args.url_file)
+    except OSError as e:
+        print(f"❌ Cannot read URL list: {e}")
+        return 2
+    if not urls:
+        print("⚠️  No URLs to download.")
+        return 0
+
+    jobs = (make_job(url, args.file_type, quality, args.playlist, args.convert, args.convert_mode, args.stream, priority)
+            for url, priority in urls)
+    return execute_jobs(args, jobs, len(urls), args.playlist)
+
+def run_sync(argv):
+    """Incremental playlist sync: download only the entries that aren't in the archive yet.
+    Without URLs, every playlist downloaded before is synced with its original type and quality."""
+    parser = argparse.ArgumentParser(prog="quicktube.py sync", description="Download new items of playlists downloaded before.")
+    parser.add_argument("urls", nargs="*", help="playlist URLs to sync (default: every playlist in the archive)")
+    parser.add_argument("--break-on-existing", action="store_true",
+                        help="stop a playlist at the first archived item (for playlists where new items come first)")
+    add_job_arguments(parser)
+    args = parser.parse_args(argv)
+    quality = apply_job_arguments(parser, args)
+    if args.no_archive:
+        parser.error("sync needs the download archive")
+
+    global YTDLP_BREAK_ON_EXISTING
+    YTDLP_BREAK_ON_EXISTING = args.break_on_existing
+    archive = get_download_archive()
+    if archive is None:
+        print("❌ The download archive is unavailable (QUICKTUBE_ARCHIVE=off?).")
+        return 2
+
+    if args.urls:
+        playlists = [(url, args.file_type, quality) for url in args.urls]
+    else:
+        playlists = archive.playlists()
+    if not playlists:
+        print("⚠️  No playlists to sync. Download a playlist first or pass its URL.")
+        return 0
+
+    jobs = (make_job(url, file_type, playlist_quality, True, args.convert, args.convert_mode)
+            for url, file_type, playlist_quality in playlists)
+    return execute_jobs(args, jobs, len(playlists), playlists=True)
+
+def run_resume(argv):
+    """Resume the jobs an interrupted batch or sync left unfinished, from the job journal.
+    Downloads continue from yt-dlp's .part files, finished items are skipped and jobs that
+    were converting go straight back to conversion."""
+    parser = argparse.ArgumentParser(prog="quicktube.py resume", description="Resume interrupted batch and sync jobs.")
+    parser.add_argument("--failed", action="store_true", help="also retry jobs that failed")
+    add_job_arguments(parser)
+    args = parser.parse_args(argv)
+    apply_job_arguments(parser, args)
+
+    journal = get_job_journal()
+    if journal is None:
+        print("❌ The job journal is unavailable (QUICKTUBE_JOURNAL=off?).")
+        return 2
+    jobs = journal.unfinished(args.failed)
+    if not jobs:
+        print("✅ Nothing to resume.")
+        return 0
+    # Type, quality and conversion come from the journal, not from the options
+    return execute_jobs(args, jobs, len(jobs), playlists=any(job["is_playlist"] for job in jobs), resume=True)
+
+class JobServer:
+    """Local HTTP/JSON job server built on asyncio. yt-dlp and ffmpeg run as asyncio
+    subprocesses, so any number of jobs can be in flight without a thread each; the
+    download and conversion limits only bound how many transfer or encode at once.
+
+        POST   /jobs              submit {"url", "type", "quality", "convert", "conversion", "playlist", "priority"}
+        GET    /jobs              list jobs
+        GET    /jobs/<id>         job status
+        DELETE /jobs/<id>         cancel (kills its yt-dlp/ffmpeg process)
+        GET    /jobs/<id>/events  progress as Server-Sent Events
+    """
+
+    HISTORY = 200  # events replayed to a client that subscribes late
+    KEEP_FINISHED = 500  # finished jobs kept for status queries
+    FINISHED = ("done", "failed", "cancelled")
+    PUBLIC_FIELDS = ("id", "url", "file_type", "quality", "is_playlist", "convert", "conversion", "priority",
+                     "state", "progress", "files", "error", "created", "updated")
+    MAX_BODY = 64 * 1024
+
+    def __init__(self, download_workers, convert_workers, cors_origin=None):
+        self.jobs = {}
+        self.download_workers = download_workers
+        self.convert_workers = convert_workers
+        self.cors_origin = cors_origin
+        self.downloads = self.conversions = None
+
+    async def serve(self, host, port):
+        import asyncio
+        # Created here so they belong to the server's event loop
+        self.downloads = asyncio.Semaphore(self.download_workers)
+        self.conversions = asyncio.Semaphore(self.convert_workers)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"🌐 QuickTube job server listening on http://{host}:{port}/jobs", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for job in self.jobs.values():
+                if job["process"] is not None:
+                    job["process"].kill()
+
+    # Jobs
+
+    def submit(self, spec):
+        """Validate a job request and start it. Returns the job; raises ValueError on bad input."""
+        import asyncio
+        if not isinstance(spec, dict) or not isinstance(spec.get("url"), str) or not spec["url"].strip():
+            raise ValueError("a job needs a \"url\"")
+        file_type = spec.get("type") or "mp4"
+        if file_type not in ("mp3", "mp4"):
+            raise ValueError("\"type\" must be mp3 or mp4")
+        quality = normalize_quality(file_type, spec.get("quality"))
+        convert = spec.get("convert")
+        if convert not in (None, "mp4", "mkv"):
+            raise ValueError("\"convert\" must be mp4 or mkv")
+        conversion = spec.get("conversion") or "smart"
+        if conversion not in ("smart", "full", "quick"):
+            raise ValueError("\"conversion\" must be smart, full or quick")
+        try:
+            priority = max(0.01, float(spec.get("priority") or 1.0))
+        except (TypeError, ValueError):
+            raise ValueError("\"priority\" must be a number")
+        now = time.time()
+        job = dict(make_job(spec["url"].strip(), file_type, quality, bool(spec.get("playlist")), convert, conversion,
+                            priority=priority),
+                   id=uuid.uuid4().hex[:12], state="queued", progress=None, files=[], error=None, created=now,
+                   updated=now, events=[], subscribers=set(), process=None)
+        self.jobs[job["id"]] = job
+        job["task"] = asyncio.ensure_future(self.run_job(job))
+        return job
+
+    def describe(self, job):
+        return {field: job[field] for field in self.PUBLIC_FIELDS}
+
+    def publish(self, job, event):
+        """Send an event to the job's SSE subscribers (and the progress log)."""
+        event["job"] = job["id"]
+        if event["event"] in ("download", "convert"):
+            job["progress"] = event
+        job["events"].append(event)
+        del job["events"][:-self.HISTORY]
+        for subscriber in job["subscribers"]:
+            subscriber.put_nowait(event)
+        emit_progress(event, show=False)
+
+    def set_state(self, job, state, **fields):
+        job.update(fields, state=state, updated=time.time())
+        self.publish(job, {"event": "state", "time": job["updated"], "state": state,
+                           "files": job["files"], "error": job["error"]})
+
+    async def run_job(self, job):
+        import asyncio
+        started = time.monotonic()
+        try:
+            async with self.downloads:
+                self.set_state(job, "downloading")
+                outcome = await self.download(job)
+            if outcome["returncode"] != 0:
+                self.set_state(job, "failed", error=outcome["error"])
+                return
+            files = [record["filepath"] for record in outcome["files"]]
+            if job["convert"]:
+                async with self.conversions:
+                    self.set_state(job, "converting", files=files)
+                    converted = [await self.convert(job, path) for path in files]
+                if None in converted:
+                    self.set_state(job, "failed", files=[path for path in converted if path], error="conversion failed")
+                    return
+                files = converted
+            self.set_state(job, "done", files=files)
+        except asyncio.CancelledError:
+            self.set_state(job, "cancelled")
+        except Exception as e:
+            self.set_state(job, "failed", error=str(e))
+        finally:
+            METRICS.record_job(job["url"], job["state"] == "done", time.monotonic() - started)
+            for subscriber in job["subscribers"]:
+                subscriber.put_nowait(None)
+            self.forget_finished()
+
+    def forget_finished(self):
+        finished = [job for job in self.jobs.values() if job["state"] in self.FINISHED]
+        for job in sorted(finished, key=lambda job: job["updated"])[:-self.KEEP_FINISHED]:
+            del self.jobs[job["id"]]
+
+    async def run_process(self, job, command, on_line, progress_hooks=()):
+        """Run a subprocess as the job's current process, passing each output line to on_line
+        (which returns True for progress lines). Returns (returncode, last other lines)."""
+        import asyncio
+        if DEBUG_MODE:
+            print(format_command(command), flush=True)
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        job["process"] = process
+        for hook in progress_hooks:
+            if hasattr(hook, "attach_process"):
+                hook.attach_process(process)
+        tail = collections.deque(maxlen=20)
+        try:
+            async for raw in process.stdout:
+                line = raw.decode("utf-8", "replace")
+                if not on_line(line) and line.strip():
+                    tail.append(line.rstrip())
+            detach_process_hooks(progress_hooks)
+            return await process.wait(), tail
+        except BaseException:
+            # Cancelled or timed out
+            detach_process_hooks(progress_hooks)
+            if process.returncode is None:
+                process.kill()
+            raise
+        finally:
+            job["process"] = None
+
+    async def download(self, job):
+        """Download stage: the yt-dlp binary with the same options as batch mode.
+        Returns {"returncode", "error", "files"}."""
+        import asyncio
+        url, file_type, quality = job["url"], job["file_type"], job["quality"]
+        archived = find_archived_file(url, file_type, quality, job["is_playlist"])
+        if archived:
+            METRICS.count("archive_hits")
+            return {"returncode": 0, "error": None, "files": [{"filepath": archived}]}
+        output_dir = prepare_output_dir(file_type)
+        info_json = None
+        if not job["is_playlist"] and METADATA_CACHE_ENABLED:
+            # One extraction, used by the format planner and loaded by the download
+            await asyncio.get_running_loop().run_in_executor(None, check_if_playlist, url)
+            info_json = get_cached_info_for_download(url, False)
+        archive = get_download_archive()
+        archive_file = archive.ytdlp_archive_file(file_type, quality) if archive else None
+        fragments = FRAGMENT_TUNER.choose(url)
+        meter = FRAGMENT_TUNER.meter(url, fragments)
+        format_selector = None if job["is_playlist"] else get_planned_format_selector(url, file_type, quality)
+        retries = [0]
+        fd, print_file = tempfile.mkstemp(prefix="quicktube-", suffix=".jsonl")
+        os.close(fd)
+        try:
+            with BANDWIDTH.register(job["id"], job["priority"]) as bandwidth_slot:
+                progress_hooks = [METRICS.on_progress, meter, bandwidth_slot]
+
+                def on_line(line):
+                    event = parse_ytdlp_progress_line(line, job["id"])
+                    if event is None:
+                        if is_ytdlp_retry(line):
+                            retries[0] += 1
+                            METRICS.count("retries")
+                        return False
+                    for hook in progress_hooks:
+                        hook(event)
+                    self.publish(job, event)
+                    return True
+
+                for attempt_info_json in ([info_json, None] if info_json else [None]):
+                    command = build_ytdlp_command(url, file_type, quality, job["is_playlist"], output_dir, False,
+                                                  attempt_info_json, print_file, archive_file, format_selector,
+                                                  fragments, bandwidth_slot.start_rate())
+                    with METRICS.span(job["id"], "download", engine="server", cached_info=bool(attempt_info_json)) as span:
+                        returncode, tail = await self.run_process(job, command, on_line, progress_hooks)
+                        span["exit_code"] = returncode
+                    if returncode == 0 or not attempt_info_json:
+                        break
+                    # Cached stream URLs may have expired - extract again from the page
+                    invalidate_cached_info(url)
+                    METRICS.count("retries")
+            with open(print_file, encoding="utf-8", errors="replace") as f:
+                outcome = {"returncode": returncode, "error": get_ytdlp_error(returncode, tail),
+                           "retries": retries[0], "files": parse_file_records(f.read())}
+        finally:
+            try:
+                os.remove(print_file)
+            except OSError:
+                pass
+        meter.finish(outcome)
+        if returncode == 0:
+            # Hashing the files for the archive would block the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, archive_download, url, file_type, quality, job["is_playlist"], outcome["files"])
+        return outcome
+
+    async def convert(self, job, input_file):
+        """Conversion stage for one file, same plans as convert_file(). Returns the output path or None."""
+        import asyncio
+        target_format = job["convert"]
+        if os.path.splitext(input_file)[1][1:].lower() == target_format:
+            return input_file
+        quick = job["conversion"] == "quick"
+        plan = None
+        if not quick:
+            probe = await asyncio.get_running_loop().run_in_executor(None, probe_media_streams, input_file)
+            plan = plan_conversion(probe) if probe else None
+            if plan and job["conversion"] == "full":
+                plan["copy_video"] = plan["copy_audio"] = False
+        copy_only = quick or (bool(plan) and plan["copy_video"] and (plan["copy_audio"] or plan["audio"] is None))
+        threads = 1 if copy_only else CPU_BUDGET.job_threads or CPU_BUDGET.total
+        output_file = get_converted_path(input_file, target_format, "_remuxed" if quick else "_converted")
+        with atomic_output(output_file) as partial_file:
+            if quick:
+                mode, command = "quick", build_remux_command(input_file, partial_file, target_format)
+            else:
+                mode, command = build_convert_command(input_file, partial_file, target_format, str(threads), plan)
+            duration = plan["duration"] if plan else None
+            block = {}
+
+            def on_line(line):
+                event = parse_ffmpeg_progress_line(block, line, job["id"])
+                if event is not None:
+                    event["duration"] = duration
+                    self.publish(job, event)
+                return bool(re.match(r"\w+=", line))
+
+            with METRICS.span(job["id"], "remux" if quick else "convert", target=target_format, threads=threads, mode=mode) as span:
+                try:
+                    # Same limits as remux_video()/convert_video()
+                    returncode, tail = await asyncio.wait_for(self.run_process(job, command, on_line), 120 if quick else 600)
+                except asyncio.TimeoutError:
+                    returncode, tail = 1, ["timed out"]
+                span["exit_code"] = returncode
+            if returncode != 0:
+                if tail:
+                    self.publish(job, {"event": "log", "time": time.time(), "line": tail[-1]})
+                return None
+            os.replace(partial_file, output_file)
+        return output_file
+
+    # HTTP
+
+    async def handle_connection(self, reader, writer):
+        import asyncio
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > self.MAX_BODY:
+                await self.send_json(writer, 413, {"error": "request body too large"})
+                return
+            body = await reader.readexactly(length) if length else b""
+            parts = [part for part in urlsplit(target).path.split("/") if part]
+            await self.route(method.upper(), parts, headers, body, writer)
+        except (ValueError, asyncio.IncompleteReadError):
+            await self.send_json(writer, 400, {"error": "malformed request"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, parts, headers, body, writer):
+        import asyncio
+        if method == "OPTIONS":
+            await self.send(writer, 204, b"")
+            return
+        if not parts or parts[0] != "jobs" or len(parts) > 3 or (len(parts) == 3 and parts[2] != "events"):
+            await self.send_json(writer, 404, {"error": "not found"})
+            return
+        if len(parts) == 1:
+            if method == "GET":
+                await self.send_json(writer, 200, {"jobs": [self.describe(job) for job in self.jobs.values()]})
+            elif method == "POST":
+                # A form or text/plain POST from any web page needs no preflight, a JSON one does
+                if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+                    await self.send_json(writer, 415, {"error": "send the job as application/json"})
+                    return
+                try:
+                    job = self.submit(json.loads(body.decode("utf-8") or "null"))
+                except ValueError as e:
+                    await self.send_json(writer, 400, {"error": str(e)})
+                    return
+                await self.send_json(writer, 201, self.describe(job))
+            else:
+                await self.send_json(writer, 405, {"error": "use GET or POST"})
+            return
+        job = self.jobs.get(parts[1])
+        if job is None:
+            await self.send_json(writer, 404, {"error": "no such job"})
+        elif len(parts) == 3 and method == "GET":
+            await self.stream_events(job, writer)
+        elif len(parts) == 2 and method == "GET":
+            await self.send_json(writer, 200, self.describe(job))
+        elif len(parts) == 2 and method == "DELETE":
+            if job["state"] not in self.FINISHED:
+                job["task"].cancel()
+                await asyncio.wait([job["task"]])
+                if job["state"] not in self.FINISHED:
+                    # Cancelled before it got to run
+                    self.set_state(job, "cancelled")
+                    for subscriber in job["subscribers"]:
+                        subscriber.put_nowait(None)
+            await self.send_json(writer, 200, self.describe(job))
+        else:
+            await self.send_json(writer, 405, {"error": "method not allowed"})
+
+    async def stream_events(self, job, writer):
+        """Replay the job's recent events, then push new ones until the job finishes."""
+        import asyncio
+        queue = asyncio.Queue()
+        for event in job["events"]:
+            queue.put_nowait(event)
+        if job["state"] in self.FINISHED:
+            queue.put_nowait(None)
+        else:
+            job["subscribers"].add(queue)
+        try:
+            await self.send(writer, 200, None, "text/event-stream", {"Cache-Control": "no-cache"})
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    # A comment line keeps proxies and EventSource from timing out
+                    writer.write(b": keep-alive\n\n")
+                    await writer.drain()
+                    continue
+                if event is None:
+                    return
+                data = json.dumps(event, ensure_ascii=False)
+                writer.write(f"event: {event['event']}\ndata: {data}\n\n".encode("utf-8"))
+                await writer.drain()
+        finally:
+            job["subscribers"].discard(queue)
+
+    async def send(self, writer, status, body, content_type="application/json", headers=None):
+        """Write a response; without a body the connection stays open for streaming."""
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}", "Connection: close"]
+        if self.cors_origin:
+            # Without it browsers keep other web pages from reading or driving the API
+            lines += [f"Access-Control-Allow-Origin: {self.cors_origin}",
+                      "Access-Control-Allow-Methods: GET, POST, DELETE, OPTIONS",
+                      "Access-Control-Allow-Headers: Content-Type"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await writer.drain()
+
+    async def send_json(self, writer, status, payload):
+        await self.send(writer, status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+def run_server(argv):
+    """HTTP/JSON job server for other services and web pages (see JobServer)."""
+    import asyncio
+
+    parser = argparse.ArgumentParser(prog="quicktube.py serve", description="Accept download jobs over a local HTTP API.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("--cors-origin", help="web page origin allowed to call the API, e.g. http://localhost:8000 (default: none)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="downloads running at once (default: 4)")
+    parser.add_argument("--convert-jobs", type=int, help="conversions running at once (default: CPU budget / 4, at least 1)")
+    parser.add_argument("--limit-rate", metavar="RATE", help="total download speed shared by all jobs, e.g. 5M")
+    parser.add_argument("--fragments", type=int, help="DASH/HLS fragments fetched at once (default: tuned per site)")
+    parser.add_argument("--cpus", type=int, help="CPU threads shared by all conversions (default: container CPU quota, or half the cores)")
+    parser.add_argument("--no-archive", action="store_true", help="don't skip or record items in the download archive")
+    parser.add_argument("--progress-log", metavar="TARGET", help="also write progress events as JSON lines to a file or socket")
+    parser.add_argument("--debug", action="store_true", help="print the yt-dlp and ffmpeg commands")
+    args = parser.parse_args(argv)
+
+    global ARCHIVE_SETTING
+    if args.no_archive:
+        ARCHIVE_SETTING = "off"
+    if any(value is not None and value < 1 for value in (args.jobs, args.convert_jobs, args.cpus, args.fragments)):
+        parser.error("--jobs, --convert-jobs, --cpus and --fragments must be at least 1")
+    if args.limit_rate:
+        try:
+            BANDWIDTH.total = parse_rate(args.limit_rate) or None
+        except ValueError as e:
+            parser.error(str(e))
+    FRAGMENT_TUNER.fixed = args.fragments or FRAGMENT_TUNER.fixed
+    CPU_BUDGET.total = args.cpus or CPU_BUDGET.total
+    convert_jobs = args.convert_jobs or max(1, CPU_BUDGET.total // 4)
+    CPU_BUDGET.job_threads = CPU_BUDGET.job_threads or max(1, CPU_BUDGET.total // convert_jobs)
+    if args.progress_log and not open_progress_sink(args.progress_log):
+        return 2
+
+    server = JobServer(args.jobs, convert_jobs, args.cors_origin)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except OSError as e:
+        print(f"❌ Cannot listen on {args.host}:{args.port}: {e}")
+        return 2
+    finally:
+        METRICS.flush()
+    return 0
+
+def preload_ytdlp_module():
+    """Import yt_dlp in the background (it takes a moment) while the user is still typing."""
+    if YTDLP_ENGINE != "binary":
+        threading.Thread(target=load_ytdlp_module, daemon=True).start()
+
+def run_interactive():
+    """Interactive terminal loop."""
+    preload_ytdlp_module()
     while True:
         print("=" * 60)
         print("⚡ QuickTube - Universal Media Downloader ⚡")
@@ -467,9 +3969,10 @@ if __name__ == "__main__":
                 print("   2. 128 kbps (Recommended)")
                 print("   3. 192 kbps")
                 print("   4. 320 kbps (Highest)")
+                print("   5. Original (M4A/Opus as published, no re-encoding - fastest)")
                 print("   B. Back to file type")
                 while True:
-                    choice = input("Enter your choice (1-4, default: 2, or B to go back): ").strip().lower() or "2"
+                    choice = input("Enter your choice (1-5, default: 2, or B to go back): ").strip().lower() or "2"
                     if choice in ["b", "back"]:
                         go_back = True
                         break
@@ -485,7 +3988,10 @@ if __name__ == "__main__":
                     elif choice in ["4", "320"]:
                         quality = "320"
                         break
-                    print("⚠️  Invalid choice! Please enter 1-4, bitrate (64/128/192/320), or B.")
+                    elif choice in ["5", AUDIO_PASSTHROUGH]:
+                        quality = AUDIO_PASSTHROUGH
+                        break
+                    print("⚠️  Invalid choice! Please enter 1-5, bitrate (64/128/192/320), original, or B.")
             else:  # mp4
                 print("\n🎬 Select video resolution:")
                 print("   1. 144p")
@@ -538,6 +4044,7 @@ if __name__ == "__main__":
 
         print("\n" + "=" * 60)
         download_media(url, file_type, quality, is_playlist)
+        METRICS.flush()
         print("=" * 60)
         
         # Ask if user wants to download another video
@@ -550,3 +4057,90 @@ if __name__ == "__main__":
             print("=" * 60)
             break
         print("\n")  # Add spacing for next download
+
+def get_process_age(pid="self"):
+    """Seconds since a process started, from Linux /proc; None elsewhere."""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+            # Fields after the parenthesized name; starttime (field 22) is in clock ticks since boot
+            started = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime", encoding="utf-8") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def print_startup_profile():
+    """Report what startup cost (--profile-startup): interpreter start, imports and module setup,
+    then the work that is deferred until first use - tool lookup, ffmpeg capability discovery
+    (cached on disk after the first run) and importing yt_dlp."""
+    profiled = time.perf_counter()
+    frozen = getattr(sys, 'frozen', False)
+    # A one-file build unpacks in a parent bootloader process, so measure from its start
+    onefile = frozen and os.path.basename(getattr(sys, "_MEIPASS", "")).startswith("_MEI")
+    rows = []
+    age = get_process_age(os.getppid() if onefile else "self")
+    if age is not None:
+        before_script = age - (profiled - STARTUP_STARTED)
+        rows.append(("process start → script", before_script, "interpreter start" + (" and unpacking" if onefile else "")))
+    rows.append(("imports", STARTUP_IMPORTED - STARTUP_STARTED, "standard library modules loaded up front"))
+    rows.append(("module setup", STARTUP_READY - STARTUP_IMPORTED, "definitions, settings and CPU budget"))
+
+    def measure(label, function):
+        started = time.perf_counter()
+        detail = function()
+        rows.append((label, time.perf_counter() - started, detail))
+
+    def describe_ffmpeg():
+        info = get_tool_info("ffmpeg")
+        if not info:
+            return "ffmpeg not found"
+        return f"version {info.get('version') or '?'}, {len(info.get('encoders') or ())} encoders, {len(info.get('muxers') or ())} muxers"
+
+    def describe_module():
+        module = load_ytdlp_module()
+        if module is None:
+            return "not installed (the yt-dlp program is used)"
+        return f"version {getattr(getattr(module, 'version', None), '__version__', '?')}"
+
+    measure("tool paths", lambda: f"ffmpeg={get_ffmpeg_path()}, ffprobe={get_ffprobe_path()}, yt-dlp={get_ytdlp_path()}")
+    measure("ffmpeg capabilities", describe_ffmpeg)
+    measure("yt-dlp version", lambda: get_tool_info("yt-dlp").get("version") or "yt-dlp not found")
+    measure("yt_dlp module import", describe_module)
+
+    print("⏱️  Startup profile")
+    for label, seconds, detail in rows:
+        print(f"   {label:26} {seconds * 1000:9.1f} ms   {detail}")
+
+STARTUP_READY = time.perf_counter()
+
+def main(argv):
+    """Dispatch to batch mode, playlist sync, resume, the job server or the interactive loop."""
+    progress_log = os.getenv("QUICKTUBE_PROGRESS_LOG", "").strip()
+    if progress_log:
+        open_progress_sink(progress_log)
+    args = list(argv)
+    if "--profile-startup" in args:
+        args.remove("--profile-startup")
+        print_startup_profile()
+        if not args:
+            return 0
+    if args and args[0] == "--debug":
+        args = args[1:] + ["--debug"]
+    if args and args[0] == "batch":
+        return run_batch(args[1:])
+    if args and args[0] == "sync":
+        return run_sync(args[1:])
+    if args and args[0] == "resume":
+        return run_resume(args[1:])
+    if args and args[0] == "serve":
+        return run_server(args[1:])
+    run_interactive()
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print("\n👋 Cancelled.")
+        sys.exit(130)